@@ -0,0 +1,183 @@
+import asyncio
+import logging
+
+from calsync.calendar import Calendar
+from calsync.calendar import find_calendar
+from calsync.calendar import IMPORT_RESPONSE_FIELDS
+from calsync.calendar import record_import
+from calsync.event import Event
+from calsync.service import get_events_fields_mask
+from calsync.service import SyncTokenExpiredError
+from calsync.state import get_state_store
+from calsync.util import split_window
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncCalendar(Calendar):
+    """Async counterpart to Calendar, whose API calls go through an
+    AsyncCalendarService. See Calendar for what each method does."""
+
+    def __init__(self, service, **attributes):
+        super().__init__(**attributes)
+        self.service = service
+
+    async def iter_events(
+        self,
+        timeMin=None,
+        timeMax=None,
+        maxResults=None,
+        singleEvents=True,
+        orderBy="startTime",
+        shards=1,
+        fields=None,
+        updatedMin=None,
+    ):
+        if shards > 1 and timeMin is not None and timeMax is not None:
+            async for event in self.__iter_shards(
+                shards,
+                timeMin=timeMin,
+                timeMax=timeMax,
+                maxResults=maxResults,
+                singleEvents=singleEvents,
+                orderBy=orderBy,
+                fields=fields,
+                updatedMin=updatedMin,
+            ):
+                yield event
+            return
+
+        events_result = self.service.list_events(
+            calendarId=self.id,
+            timeMin=timeMin,
+            timeMax=timeMax,
+            maxResults=maxResults,
+            singleEvents=singleEvents,
+            orderBy=orderBy,
+            fields=get_events_fields_mask(fields),
+            updatedMin=updatedMin,
+            showDeleted=True if updatedMin is not None else None,
+        )
+        async for evt in events_result:
+            yield Event.from_api(self.id, evt)
+
+    async def __iter_shards(self, shards, timeMin, timeMax, **kwargs):
+        tasks = [
+            asyncio.ensure_future(
+                self.list_events(timeMin=shard_min, timeMax=shard_max, **kwargs)
+            )
+            for shard_min, shard_max in split_window(timeMin, timeMax, shards)
+        ]
+
+        seen = set()
+        try:
+            for task in tasks:
+                for event in await task:
+                    if event.id not in seen:
+                        seen.add(event.id)
+                        yield event
+
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def list_events(
+        self,
+        timeMin=None,
+        timeMax=None,
+        maxResults=None,
+        singleEvents=True,
+        orderBy="startTime",
+        shards=1,
+        fields=None,
+        updatedMin=None,
+    ):
+        return [
+            evt
+            async for evt in self.iter_events(
+                timeMin=timeMin,
+                timeMax=timeMax,
+                maxResults=maxResults,
+                singleEvents=singleEvents,
+                orderBy=orderBy,
+                shards=shards,
+                fields=fields,
+                updatedMin=updatedMin,
+            )
+        ]
+
+    async def sync_events(
+        self,
+        syncToken=None,
+        timeMin=None,
+        timeMax=None,
+        singleEvents=True,
+        fields=None,
+    ):
+        if syncToken is not None:
+            try:
+                events_result, next_sync_token = await self.service.sync_events(
+                    calendarId=self.id,
+                    syncToken=syncToken,
+                    singleEvents=singleEvents,
+                    showDeleted=True,
+                    fields=get_events_fields_mask(fields),
+                )
+                return (
+                    [Event.from_api(self.id, evt) for evt in events_result],
+                    next_sync_token,
+                )
+
+            except SyncTokenExpiredError:
+                logger.warning(
+                    f"sync token for {self.get_name()} expired, doing a full sync"
+                )
+
+        events_result, next_sync_token = await self.service.sync_events(
+            calendarId=self.id,
+            timeMin=timeMin,
+            timeMax=timeMax,
+            singleEvents=singleEvents,
+            fields=get_events_fields_mask(fields),
+        )
+        return (
+            [Event.from_api(self.id, evt) for evt in events_result],
+            next_sync_token,
+        )
+
+    async def delete_event(self, event):
+        await self.service.delete_event(calendarId=self.id, eventId=event.id)
+        get_state_store().delete_event_mapping(self.id, event.id)
+
+    async def import_event(self, event, source=None):
+        new_event = event.copy()
+
+        events_result = await self.service.import_event(
+            calendarId=self.id,
+            body=new_event.attributes,
+            fields=IMPORT_RESPONSE_FIELDS,
+        )
+        return record_import(self, new_event, events_result, source)
+
+    async def patch_event(self, eventId, event, changes, source=None):
+        new_event = event.copy()
+
+        events_result = await self.service.patch_event(
+            calendarId=self.id,
+            eventId=eventId,
+            body=changes,
+            fields=IMPORT_RESPONSE_FIELDS,
+        )
+        return record_import(self, new_event, events_result, source)
+
+
+async def get_async_calendars(service):
+    """Returns every calendar in the user's calendar list, as AsyncCalendars."""
+    return [AsyncCalendar(service, **cal) async for cal in service.list_calendars()]
+
+
+async def get_async_calendar_resolver(service):
+    """Lists the user's calendars once, and returns a function that resolves a
+    calendar name (summary) or ID to its AsyncCalendar, like resolve_calendar."""
+    calendars = await get_async_calendars(service)
+    return lambda input: find_calendar(calendars, input)
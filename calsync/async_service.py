@@ -0,0 +1,206 @@
+import asyncio
+from urllib.parse import quote
+
+from calsync.credentials import get_credential_manager
+from calsync.ratelimit import call_with_retries_async
+from calsync.ratelimit import get_rate_limiter
+from calsync.ratelimit import MAX_ATTEMPTS
+from calsync.service import CALENDARS_PAGE_SIZE
+from calsync.service import EVENTS_PAGE_SIZE
+from calsync.service import get_api_base_url
+from calsync.service import SyncTokenExpiredError
+
+# optional, and only needed for the async backend, so imported by
+# AsyncCalendarService rather than up front; it's slow to import
+aiohttp = None
+
+# The most connections (and so requests in flight) to have open at once
+MAX_CONNECTIONS = 100
+
+# How long to keep idle connections open for reuse, in seconds
+KEEPALIVE_TIMEOUT = 30
+
+
+class AsyncHttpError(Exception):
+    """Raised when the API responds to a request with an error status."""
+
+    def __init__(self, status, content):
+        super().__init__(f"HTTP {status}: {content}")
+        self.status = status
+        self.content = content
+
+
+class AsyncCalendarService:
+    """Async counterpart to CalendarService. Rather than wrapping the synchronous
+    googleapiclient, this calls the Calendar REST API directly through a single
+    aiohttp session, so one event loop can keep many requests in flight over a
+    pool of kept-alive connections. Requests are rate limited and retried just
+    as CalendarService's are.
+
+    Use as an async context manager, which opens and closes the session:
+
+        async with AsyncCalendarService(credentials) as service:
+            async for evt in service.list_events(calendarId="primary"):
+                ...
+    """
+
+    def __init__(
+        self,
+        credentials,
+        base_url=None,
+        max_connections=MAX_CONNECTIONS,
+        rate_limiter=None,
+        max_attempts=MAX_ATTEMPTS,
+    ):
+        global aiohttp
+        if aiohttp is None:
+            try:
+                import aiohttp
+            except ImportError:
+                raise ImportError(
+                    "the async backend needs aiohttp; pip install calsync[async]"
+                ) from None
+
+        self.credentials = credentials
+        # the API to use; defaults to Google's, or the one set by set_api_endpoint
+        self.base_url = base_url if base_url is not None else get_api_base_url()
+        self.max_connections = max_connections
+        if rate_limiter is None:
+            rate_limiter = get_rate_limiter()
+
+        self.rate_limiter = rate_limiter
+        self.max_attempts = max_attempts
+        self.session = None
+        self.refresh_lock = None
+
+    async def __aenter__(self):
+        self.refresh_lock = asyncio.Lock()
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.max_connections,
+                keepalive_timeout=KEEPALIVE_TIMEOUT,
+            )
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.session.close()
+        self.session = None
+
+    async def __get_headers(self):
+        # refresh at most once however many requests notice the expiry, and
+        # through the CredentialManager, so the refresh is single-flight across
+        # threads and processes, and the token is saved
+        async with self.refresh_lock:
+            if not self.credentials.valid:
+                self.credentials = await asyncio.to_thread(get_credential_manager().get)
+
+        headers = {}
+        self.credentials.apply(headers)
+        return headers
+
+    async def __request(self, method, path, params=None, body=None):
+        return await call_with_retries_async(
+            lambda: self.__send(method, path, params, body),
+            rate_limiter=self.rate_limiter,
+            max_attempts=self.max_attempts,
+        )
+
+    async def __send(self, method, path, params, body):
+        async with self.session.request(
+            method,
+            self.base_url + path,
+            params=self.__encode_params(params or {}),
+            json=body,
+            headers=await self.__get_headers(),
+        ) as resp:
+            if resp.status >= 400:
+                raise AsyncHttpError(resp.status, await resp.text())
+
+            if resp.status == 204:
+                return None
+
+            return await resp.json()
+
+    def __encode_params(self, params):
+        """Converts params to query string values as googleapiclient would,
+        dropping any that are None."""
+        encoded = {}
+        for k, v in params.items():
+            if v is None:
+                continue
+            if type(v) is bool:
+                v = "true" if v else "false"
+            encoded[k] = str(v)
+
+        return encoded
+
+    async def __pages(self, path, params):
+        """Executes a list request, following nextPageToken, and yields the result
+        of each page as it arrives."""
+        params = dict(params)
+        while True:
+            result = await self.__request("GET", path, params=params)
+            yield result
+
+            page_token = result.get("nextPageToken")
+            if not page_token:
+                return
+
+            params["pageToken"] = page_token
+
+    async def list_calendars(self, **kwargs):
+        """Yields every calendar in the user's calendar list, across all pages."""
+        if kwargs.get("maxResults") is None:
+            kwargs["maxResults"] = CALENDARS_PAGE_SIZE
+
+        async for page in self.__pages("/users/me/calendarList", kwargs):
+            for item in page.get("items", []):
+                yield item
+
+    async def list_events(self, calendarId, **kwargs):
+        """Yields every event matching the query, across all pages."""
+        if kwargs.get("maxResults") is None:
+            kwargs["maxResults"] = EVENTS_PAGE_SIZE
+
+        path = f"/calendars/{quote(calendarId, safe='')}/events"
+        async for page in self.__pages(path, kwargs):
+            for item in page.get("items", []):
+                yield item
+
+    async def sync_events(self, calendarId, **kwargs):
+        """Lists events, following every page, and returns (items, nextSyncToken).
+        See CalendarService.sync_events."""
+        if kwargs.get("maxResults") is None:
+            kwargs["maxResults"] = EVENTS_PAGE_SIZE
+
+        path = f"/calendars/{quote(calendarId, safe='')}/events"
+        items = []
+        try:
+            async for page in self.__pages(path, kwargs):
+                items.extend(page.get("items", []))
+
+        except AsyncHttpError as ex:
+            if ex.status == 410:
+                raise SyncTokenExpiredError(str(ex)) from ex
+            raise
+
+        return items, page.get("nextSyncToken")
+
+    async def import_event(self, calendarId, body, fields=None):
+        path = f"/calendars/{quote(calendarId, safe='')}/events/import"
+        return await self.__request("POST", path, params={"fields": fields}, body=body)
+
+    async def patch_event(self, calendarId, eventId, body, fields=None):
+        path = (
+            f"/calendars/{quote(calendarId, safe='')}"
+            f"/events/{quote(eventId, safe='')}"
+        )
+        return await self.__request("PATCH", path, params={"fields": fields}, body=body)
+
+    async def delete_event(self, calendarId, eventId):
+        path = (
+            f"/calendars/{quote(calendarId, safe='')}"
+            f"/events/{quote(eventId, safe='')}"
+        )
+        return await self.__request("DELETE", path)
@@ -0,0 +1,317 @@
+import argparse
+from datetime import datetime
+from datetime import timedelta
+from importlib.metadata import PackageNotFoundError
+from importlib.metadata import version
+import json
+import logging
+import multiprocessing
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+from calsync.calendar import clear_calendars
+from calsync.fake_server import FakeCalendarServer
+from calsync.rules.rules import run_rules
+from calsync.service import set_api_endpoint
+from calsync.state import set_state_store
+from calsync.state import StateStore
+from calsync.util import datetime_to_rfc3339
+
+try:
+    import resource
+except ImportError:  # not available on Windows; peak RSS isn't reported there
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+BENCH_SIZES = [1000, 10000, 100000]
+BENCH_METHODS = ["copy", "remove_deleted"]
+BENCH_OUTPUT = "bench-results.json"
+
+SRC_CALENDAR = "src@calsync.bench"
+DST_CALENDAR = "dst@calsync.bench"
+
+# the window the benchmark rules work on; events are generated inside it
+LOOK_BACK = "4 weeks"
+LOOK_FORWARD = "12 weeks"
+EVENTS_START = timedelta(weeks=-4)
+EVENTS_END = timedelta(weeks=12) - timedelta(days=1)
+
+# the mix of synthetic events; the rest are one-off timed events
+ALL_DAY_FRACTION = 0.1
+RECURRING_FRACTION = 0.05
+# copy rules filter these out by summary
+SKIPPED_FRACTION = 0.05
+# these have a few attendees, which copies leave out
+MEETING_FRACTION = 0.3
+MEETING_ATTENDEES = 4
+# remove_deleted finds this many extra dst events (per src event) to delete
+DELETED_FRACTION = 0.1
+
+# how many fresh processes startup is measured in, taking the median
+STARTUP_REPEAT = 5
+
+# run in a fresh process by measure_startup(), timing what a run of py-calsync
+# does before its first request; building the service needs no network
+STARTUP_SCRIPT = """
+import json, time
+start = time.perf_counter()
+from calsync.rules.rules import run_rules
+imported = time.perf_counter()
+from calsync.service import get_calendar_service, set_api_endpoint
+set_api_endpoint("http://127.0.0.1:1/")
+get_calendar_service()
+built = time.perf_counter()
+print(json.dumps({"import": imported - start, "service": built - imported}))
+"""
+
+
+def generate_events(count, now, seed=0, prefix="event"):
+    """Returns count synthetic events, with start times spread over the benchmark
+    window around now, in the mix of timed, all-day and recurring events set by
+    the *_FRACTION constants. The same seed always gives the same events."""
+    rand = random.Random(seed)
+    span = int((EVENTS_END - EVENTS_START).total_seconds() // 60)
+    events = []
+
+    for i in range(count):
+        start = now + EVENTS_START + timedelta(minutes=rand.randrange(span))
+        start = start.replace(second=0, microsecond=0)
+
+        summary = f"Event {i}"
+        if rand.random() < SKIPPED_FRACTION:
+            summary = f"Skipped {i}"
+
+        event = {
+            "iCalUID": f"{prefix}-{i}@calsync.bench",
+            "summary": summary,
+            "description": f"Synthetic event {i} for benchmarking.",
+            "location": f"Room {rand.randrange(100)}",
+            "organizer": {"email": SRC_CALENDAR, "displayName": "Bench source"},
+        }
+
+        if rand.random() < MEETING_FRACTION:
+            event["attendees"] = [
+                {
+                    "email": f"attendee{rand.randrange(1000)}@calsync.bench",
+                    "responseStatus": "accepted",
+                }
+                for _ in range(MEETING_ATTENDEES)
+            ]
+
+        kind = rand.random()
+        if kind < ALL_DAY_FRACTION:
+            event["start"] = {"date": start.date().isoformat()}
+            event["end"] = {"date": (start.date() + timedelta(days=1)).isoformat()}
+        else:
+            end = start + timedelta(minutes=rand.choice([30, 60, 90, 120]))
+            event["start"] = {"dateTime": datetime_to_rfc3339(start)}
+            event["end"] = {"dateTime": datetime_to_rfc3339(end)}
+
+            if kind < ALL_DAY_FRACTION + RECURRING_FRACTION:
+                event["recurrence"] = ["RRULE:FREQ=WEEKLY;COUNT=10"]
+
+        events.append(event)
+
+    return events
+
+
+def get_bench_rule(method):
+    """Returns the rule benchmarked for method."""
+    rule = {
+        "method": method,
+        "src": "Bench source",
+        "dst": "Bench destination",
+        "look_back": LOOK_BACK,
+        "look_forward": LOOK_FORWARD,
+    }
+
+    if method == "copy":
+        rule["filter"] = {"not": {"summary": "Skipped*"}}
+        rule["transform"] = [
+            {"description_append": "From $calendar_name ($calendar_id)."}
+        ]
+
+    return rule
+
+
+def seed_server(server, size, method, now):
+    """Adds the calendars and events benchmarking method with size source events
+    needs to server."""
+    server.add_calendar(SRC_CALENDAR, summary="Bench source")
+    server.add_calendar(DST_CALENDAR, summary="Bench destination")
+
+    events = generate_events(size, now)
+    for event in events:
+        server.add_event(SRC_CALENDAR, **event)
+
+    if method == "remove_deleted":
+        # dst holds a copy of every src event, plus copies of events since
+        # deleted from src
+        deleted = generate_events(
+            int(size * DELETED_FRACTION), now, seed=1, prefix="deleted"
+        )
+        for event in events + deleted:
+            server.add_event(DST_CALENDAR, **event)
+
+
+def __serve(conn, size, method, latency):
+    """Runs a seeded FakeCalendarServer until told to stop over conn. Run in its
+    own process, so serving requests doesn't compete with the code being
+    benchmarked for the GIL, or add to its memory use."""
+    # the spawned process sets logging up afresh; logging every request would
+    # slow the server down
+    logging.getLogger().setLevel(logging.WARNING)
+
+    server = FakeCalendarServer(latency=latency)
+    seed_server(server, size, method, datetime.utcnow())
+
+    with server:
+        conn.send(server.url)
+
+        while conn.recv() == "stats":
+            conn.send(server.stats)
+
+
+def run_benchmark(size, method, backend="sync", latency=0):
+    """Runs method's benchmark rule through run_rules() against a fake server
+    seeded with size source events, and returns its results."""
+    mp = multiprocessing.get_context("spawn")
+    conn, server_conn = mp.Pipe()
+    server = mp.Process(target=__serve, args=(server_conn, size, method, latency))
+    server.start()
+
+    try:
+        set_api_endpoint(conn.recv())
+        clear_calendars()
+        set_state_store(StateStore(":memory:"))
+
+        config = {
+            "backend": backend,
+            # measure calsync itself, not the rate limiter
+            "requests_per_second": 0,
+            "rules": [get_bench_rule(method)],
+        }
+
+        start = time.perf_counter()
+        context = run_rules(config)
+        seconds = time.perf_counter() - start
+
+        conn.send("stats")
+        stats = conn.recv()
+
+    finally:
+        conn.send("stop")
+        server.join()
+
+        set_api_endpoint(None)
+        clear_calendars()
+        set_state_store(None)
+
+    return {
+        "method": method,
+        "backend": backend,
+        "events": size,
+        "seconds": seconds,
+        "events_per_second": size / seconds,
+        "api_calls": stats["calls"],
+        "api_calls_per_event": stats["calls"] / size,
+        "http_requests": stats["requests"],
+        "bytes_received": stats["bytes_sent"],
+        "bytes_sent": stats["bytes_received"],
+        # the peak for the whole process so far, so run sizes in increasing order
+        # (kilobytes on Linux, bytes on macOS)
+        "peak_rss": (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None
+        ),
+        "phases": context.timings.as_dict(),
+    }
+
+
+def measure_startup(repeat=STARTUP_REPEAT):
+    """Returns how long a fresh process takes to get ready to make its first API
+    request, in seconds: in total (including starting the interpreter), and
+    spent importing calsync and building the API service. Each is the median
+    of repeat runs."""
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, "-c", STARTUP_SCRIPT],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        runs.append(dict(json.loads(output), total=time.perf_counter() - start))
+
+    return {k: statistics.median(run[k] for run in runs) for k in runs[0]}
+
+
+def run_benchmarks(sizes=BENCH_SIZES, methods=BENCH_METHODS, backend="sync", latency=0):
+    """Runs the benchmark for every method at every size, and returns the
+    results along with details of the version and platform they ran on."""
+    try:
+        calsync_version = version("calsync")
+    except PackageNotFoundError:
+        calsync_version = None
+
+    results = []
+    for size in sorted(sizes):
+        for method in methods:
+            logger.warning(f"benchmarking {method} with {size} events")
+            results.append(run_benchmark(size, method, backend, latency))
+
+    return {
+        "version": calsync_version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started": datetime_to_rfc3339(datetime.utcnow()),
+        "latency": latency,
+        "startup": measure_startup(),
+        "results": results,
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog="py-calsync bench",
+        description="Benchmarks rules against a local fake Calendar API server.",
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=BENCH_SIZES)
+    parser.add_argument("--methods", nargs="+", default=BENCH_METHODS)
+    parser.add_argument("--backend", choices=["sync", "async"], default="sync")
+    parser.add_argument(
+        "--latency", type=float, default=0, help="seconds to delay each request"
+    )
+    parser.add_argument("--output", default=BENCH_OUTPUT)
+    options = parser.parse_args(args)
+
+    # logging every event would swamp the timings
+    logging.getLogger().setLevel(logging.WARNING)
+
+    report = run_benchmarks(
+        options.sizes, options.methods, options.backend, options.latency
+    )
+
+    with open(options.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for result in report["results"]:
+        phases = ", ".join(f"{k} {v:.2f}s" for k, v in result["phases"].items())
+        print(
+            f"{result['method']} x {result['events']}: "
+            f"{result['events_per_second']:.0f} events/s, "
+            f"{result['api_calls_per_event']:.3f} calls/event ({phases})"
+        )
+
+    startup = report["startup"]
+    print(
+        f"startup: {startup['total']:.3f}s ({startup['import']:.3f}s importing, "
+        f"{startup['service']:.3f}s building the service)"
+    )
+
+    print(f"results written to {options.output}")
@@ -0,0 +1,260 @@
+import asyncio
+import threading
+
+from calsync.service import EVENTS_PAGE_SIZE
+from calsync.stream import async_chunked
+from calsync.stream import chunked
+from calsync.stream import prefetch
+from calsync.util import rfc3339_to_datetime
+
+
+def event_in_window(event, timeMin, timeMax):
+    """Mirrors the API's window: an event is in it if it ends after timeMin and
+    starts before timeMax. Recurring events are kept if they start before
+    timeMax, as whether a later instance ends after timeMin can't be told
+    without expanding the recurrence. Events without usable times are kept."""
+    start = event.start_time
+    end = event.end_time
+
+    if timeMax is not None and start is not None:
+        if start >= rfc3339_to_datetime(timeMax):
+            return False
+
+    if event.recurrence is not None:
+        return True
+
+    if timeMin is not None and end is not None:
+        if end <= rfc3339_to_datetime(timeMin):
+            return False
+
+    return True
+
+
+class EventCache:
+    """Caches the events listed from each calendar during a run, so rules that
+    read the same calendar share a single fetch. A cached window also satisfies
+    requests for any narrower window, by filtering the cached events locally.
+
+    Entries are keyed by (calendarId, singleEvents, orderBy), since results
+    listed with different values for those can't stand in for each other.
+    Events listed with only some fields (a partial response) only satisfy
+    requests for some of those fields.
+
+    Safe to share between threads; concurrent requests for the same key wait for
+    a single fetch rather than each fetching.
+
+    iter_events() streams events instead, and only caches those of calendars in
+    shared_calendars, which the run expects more than one rule to read. It maps
+    their ids to the fields those rules need between them (None for all
+    fields), which are listed whichever of them is asked for, so one fetch
+    serves every rule."""
+
+    def __init__(self):
+        self.entries = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+        self.shared_calendars = {}
+
+    def list_events(
+        self,
+        calendar,
+        timeMin=None,
+        timeMax=None,
+        singleEvents=True,
+        orderBy="startTime",
+        shards=1,
+        fields=None,
+    ):
+        """Returns calendar.list_events() for the given window, from the cache
+        where possible. shards only affects how events are listed, so doesn't
+        stop cached events being reused."""
+        key = (calendar.id, singleEvents, orderBy)
+        fields = self.get_fields(calendar, fields)
+
+        with self.lock:
+            key_lock = self.locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            events = self.lookup(key, timeMin, timeMax, fields)
+            if events is None:
+                events = calendar.list_events(
+                    timeMin=timeMin,
+                    timeMax=timeMax,
+                    singleEvents=singleEvents,
+                    orderBy=orderBy,
+                    shards=shards,
+                    fields=fields,
+                )
+                self.store(key, timeMin, timeMax, fields, events)
+
+            return events
+
+    def iter_events(
+        self,
+        calendar,
+        timeMin=None,
+        timeMax=None,
+        singleEvents=True,
+        orderBy="startTime",
+        shards=1,
+        fields=None,
+        chunk_size=None,
+    ):
+        """Yields the events list_events() would return, in lists of up to
+        chunk_size (by default, a page). Unless the calendar is shared or a
+        cached window covers this one, events are streamed from the API without
+        being cached, and the next chunk is fetched while the caller works on
+        this one, so only a few chunks are held at once however large the window
+        is."""
+        if chunk_size is None:
+            chunk_size = EVENTS_PAGE_SIZE
+
+        key = (calendar.id, singleEvents, orderBy)
+        kwargs = dict(
+            timeMin=timeMin,
+            timeMax=timeMax,
+            singleEvents=singleEvents,
+            orderBy=orderBy,
+            shards=shards,
+            fields=fields,
+        )
+
+        if calendar.id in self.shared_calendars:
+            yield from chunked(self.list_events(calendar, **kwargs), chunk_size)
+            return
+
+        with self.lock:
+            key_lock = self.locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            events = self.lookup(
+                key, timeMin, timeMax, self.get_fields(calendar, fields)
+            )
+
+        if events is not None:
+            yield from chunked(events, chunk_size)
+        else:
+            yield from prefetch(chunked(calendar.iter_events(**kwargs), chunk_size))
+
+    def get_fields(self, calendar, fields):
+        """Returns the fields to list from calendar when fields are asked for, as
+        a frozenset, or None for all fields."""
+        if calendar.id in self.shared_calendars:
+            fields = self.shared_calendars[calendar.id]
+
+        return None if fields is None else frozenset(fields)
+
+    def lookup(self, key, timeMin, timeMax, fields=None):
+        """Returns the cached events under key for the window, or None if no
+        cached entry covers both the window and fields."""
+        for entry_min, entry_max, entry_fields, events in self.entries.get(key, []):
+            if entry_fields is not None and (
+                fields is None or not fields <= entry_fields
+            ):
+                continue
+
+            if entry_min == timeMin and entry_max == timeMax:
+                return events
+
+            if self.__window_contains(entry_min, entry_max, timeMin, timeMax):
+                return [e for e in events if event_in_window(e, timeMin, timeMax)]
+
+        return None
+
+    def store(self, key, timeMin, timeMax, fields, events):
+        self.entries.setdefault(key, []).append((timeMin, timeMax, fields, events))
+
+    def invalidate(self, calendar_id):
+        """Drops the cached events of calendar_id, e.g. once it's been written
+        to, so later rules list it afresh."""
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == calendar_id]:
+                del self.entries[key]
+
+    def __window_contains(self, outer_min, outer_max, inner_min, inner_max):
+        """Returns True if the outer window covers the whole of the inner window.
+        Bounds of None are unbounded."""
+        outer_min, outer_max = map(rfc3339_to_datetime, (outer_min, outer_max))
+        inner_min, inner_max = map(rfc3339_to_datetime, (inner_min, inner_max))
+
+        if outer_min is not None and (inner_min is None or inner_min < outer_min):
+            return False
+
+        if outer_max is not None and (inner_max is None or inner_max > outer_max):
+            return False
+
+        return True
+
+
+class AsyncEventCache(EventCache):
+    """EventCache for AsyncCalendars, for use from a single event loop."""
+
+    async def list_events(
+        self,
+        calendar,
+        timeMin=None,
+        timeMax=None,
+        singleEvents=True,
+        orderBy="startTime",
+        shards=1,
+        fields=None,
+    ):
+        key = (calendar.id, singleEvents, orderBy)
+        fields = self.get_fields(calendar, fields)
+        key_lock = self.locks.setdefault(key, asyncio.Lock())
+
+        async with key_lock:
+            events = self.lookup(key, timeMin, timeMax, fields)
+            if events is None:
+                events = await calendar.list_events(
+                    timeMin=timeMin,
+                    timeMax=timeMax,
+                    singleEvents=singleEvents,
+                    orderBy=orderBy,
+                    shards=shards,
+                    fields=fields,
+                )
+                self.store(key, timeMin, timeMax, fields, events)
+
+            return events
+
+    async def iter_events(
+        self,
+        calendar,
+        timeMin=None,
+        timeMax=None,
+        singleEvents=True,
+        orderBy="startTime",
+        shards=1,
+        fields=None,
+        chunk_size=None,
+    ):
+        if chunk_size is None:
+            chunk_size = EVENTS_PAGE_SIZE
+
+        key = (calendar.id, singleEvents, orderBy)
+        kwargs = dict(
+            timeMin=timeMin,
+            timeMax=timeMax,
+            singleEvents=singleEvents,
+            orderBy=orderBy,
+            shards=shards,
+            fields=fields,
+        )
+
+        if calendar.id in self.shared_calendars:
+            events = await self.list_events(calendar, **kwargs)
+        else:
+            async with self.locks.setdefault(key, asyncio.Lock()):
+                events = self.lookup(
+                    key, timeMin, timeMax, self.get_fields(calendar, fields)
+                )
+
+        if events is not None:
+            for chunk in chunked(events, chunk_size):
+                yield chunk
+        else:
+            async for chunk in async_chunked(
+                calendar.iter_events(**kwargs), chunk_size
+            ):
+                yield chunk
@@ -1,11 +1,29 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
 from calsync.service import get_calendar_service
+from calsync.service import get_events_fields_mask
+from calsync.service import SyncTokenExpiredError
+from calsync.state import get_state_store
+from calsync.tenant import get_current_tenant
+from calsync.tenant import submit
 from calsync.util import now
+from calsync.util import split_window
 from calsync.event import Event
 
+logger = logging.getLogger(__name__)
 
 # Values for Calendar that we ignore (treat as if they weren't there)
 DISALLOWED_SUMMARIES = ["Calendar"]
 
+# the most shards of sharded event listings (see Calendar.iter_events) to list
+# at once, across every calendar
+MAX_SHARD_WORKERS = 8
+
+# the partial response mask for imports and patches; only the event's id is used
+IMPORT_RESPONSE_FIELDS = "id"
+
 # list of fields to clear for import/insert operations
 READ_ONLY_EVENT_ATTRIBUTES = [
     #   "anyoneCanAddSelf",
@@ -56,14 +74,39 @@ class Calendar:
 
         return self.id
 
-    def list_events(
+    def iter_events(
         self,
         timeMin=now(),
         timeMax=None,
-        maxResults=30,
+        maxResults=None,
         singleEvents=True,
         orderBy="startTime",
+        shards=1,
+        fields=None,
+        updatedMin=None,
     ):
+        """Yields events in the calendar, fetching pages from the API as they are
+        needed. maxResults is the page size, and defaults to the largest the API
+        allows. If fields (a collection of Event field names) is given, only
+        those fields are fetched. If updatedMin is given, only events changed
+        since then are listed, including those cancelled.
+
+        If shards is more than 1 and the window is bounded, the window is split
+        into that many sub-windows, which are listed concurrently; see
+        __iter_shards."""
+        if shards > 1 and timeMin is not None and timeMax is not None:
+            yield from self.__iter_shards(
+                shards,
+                timeMin=timeMin,
+                timeMax=timeMax,
+                maxResults=maxResults,
+                singleEvents=singleEvents,
+                orderBy=orderBy,
+                fields=fields,
+                updatedMin=updatedMin,
+            )
+            return
+
         # Call the Calendar API
         events_result = get_calendar_service().list_events(
             calendarId=self.id,
@@ -72,28 +115,282 @@ class Calendar:
             maxResults=maxResults,
             singleEvents=singleEvents,
             orderBy=orderBy,
+            fields=get_events_fields_mask(fields),
+            updatedMin=updatedMin,
+            showDeleted=True if updatedMin is not None else None,
+        )
+        for evt in events_result:
+            yield Event.from_api(self.id, evt)
+
+    def __iter_shards(self, shards, timeMin, timeMax, **kwargs):
+        """Lists each of shards sub-windows of the window on the shard executor,
+        and yields their events in window order, so sub-windows are still being
+        listed while earlier ones are yielded. Events spanning a boundary
+        between sub-windows are listed in both, so are de-duplicated by id."""
+        futures = [
+            submit(
+                get_shard_executor(),
+                self.list_events,
+                timeMin=shard_min,
+                timeMax=shard_max,
+                **kwargs,
+            )
+            for shard_min, shard_max in split_window(timeMin, timeMax, shards)
+        ]
+
+        seen = set()
+        try:
+            for future in futures:
+                for event in future.result():
+                    if event.id not in seen:
+                        seen.add(event.id)
+                        yield event
+
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def list_events(
+        self,
+        timeMin=now(),
+        timeMax=None,
+        maxResults=None,
+        singleEvents=True,
+        orderBy="startTime",
+        shards=1,
+        fields=None,
+        updatedMin=None,
+    ):
+        """Returns a list of all events in the calendar, across all pages."""
+        return list(
+            self.iter_events(
+                timeMin=timeMin,
+                timeMax=timeMax,
+                maxResults=maxResults,
+                singleEvents=singleEvents,
+                orderBy=orderBy,
+                shards=shards,
+                fields=fields,
+                updatedMin=updatedMin,
+            )
+        )
+
+    def sync_events(
+        self,
+        syncToken=None,
+        timeMin=None,
+        timeMax=None,
+        singleEvents=True,
+        fields=None,
+    ):
+        """Incrementally lists events. If syncToken is None, a full sync of the
+        timeMin/timeMax window is done; otherwise only events changed since the
+        sync that produced the token are returned (including cancelled events,
+        which have status "cancelled"). Changes are not limited to the original
+        window, as the API does not allow timeMin/timeMax with a sync token.
+
+        If the server has expired the token, a full sync is done instead.
+
+        Returns (events, nextSyncToken).
+        """
+        if syncToken is not None:
+            try:
+                events_result, next_sync_token = get_calendar_service().sync_events(
+                    calendarId=self.id,
+                    syncToken=syncToken,
+                    singleEvents=singleEvents,
+                    showDeleted=True,
+                    fields=get_events_fields_mask(fields),
+                )
+                return (
+                    [Event.from_api(self.id, evt) for evt in events_result],
+                    next_sync_token,
+                )
+
+            except SyncTokenExpiredError:
+                logger.warning(
+                    f"sync token for {self.get_name()} expired, doing a full sync"
+                )
+
+        events_result, next_sync_token = get_calendar_service().sync_events(
+            calendarId=self.id,
+            timeMin=timeMin,
+            timeMax=timeMax,
+            singleEvents=singleEvents,
+            fields=get_events_fields_mask(fields),
+        )
+        return (
+            [Event.from_api(self.id, evt) for evt in events_result],
+            next_sync_token,
         )
-        return [Event(calendarId=self.id, **evt) for evt in events_result]
 
     def delete_event(
         self,
         event,
+        batch=None,
+        callback=None,
     ):
+        """Deletes event from this calendar. If batch is given, the delete is
+        queued on it instead, and callback is called with (None, exception) once
+        the batch has been sent."""
+        if batch is not None:
+
+            def batch_callback(response, exception):
+                if exception is None:
+                    get_state_store().delete_event_mapping(self.id, event.id)
+                if callback is not None:
+                    callback(None, exception)
+
+            batch.delete_event(
+                callback=batch_callback,
+                calendarId=self.id,
+                eventId=event.id,
+            )
+            return
+
         # Call the Calendar API
         events_result = get_calendar_service().delete_event(
             calendarId=self.id,
             eventId=event.id,
         )
-        return [Event(calendarId=self.id, **evt) for evt in events_result]
+        get_state_store().delete_event_mapping(self.id, event.id)
+
+        return [Event.from_api(self.id, evt) for evt in events_result]
+
+    def watch_events(self, channel_id, address, token=None, ttl=None):
+        """Opens a watch channel with id channel_id on this calendar's events, so
+        the API sends a push notification to address (an HTTPS URL) whenever
+        they change. token is sent with every notification, and ttl is how long
+        the channel should last, in seconds. Returns the channel, including its
+        resourceId and expiration (in milliseconds since the epoch)."""
+        body = {"id": channel_id, "type": "web_hook", "address": address}
+        if token is not None:
+            body["token"] = token
+        if ttl is not None:
+            body["params"] = {"ttl": str(ttl)}
 
-    def import_event(self, event):
+        return get_calendar_service().watch_events(calendarId=self.id, body=body)
+
+    def import_event(self, event, source=None, batch=None, callback=None):
+        """Imports event into this calendar. If source is given, it is the event
+        that event was copied from, and the copy is recorded in the state store
+        so it can be found again later.
+
+        If batch is given, the import is queued on it instead, and callback is
+        called with (imported event, exception) once the batch has been sent."""
         new_event = event.copy()
 
+        if batch is not None:
+
+            def batch_callback(response, exception):
+                result = None
+                if exception is None:
+                    result = record_import(self, new_event, response, source)
+                if callback is not None:
+                    callback(result, exception)
+
+            batch.import_event(
+                callback=batch_callback,
+                calendarId=self.id,
+                body=new_event.attributes,
+                fields=IMPORT_RESPONSE_FIELDS,
+            )
+            return
+
         events_result = get_calendar_service().import_event(
             calendarId=self.id,
             body=new_event.attributes,
+            fields=IMPORT_RESPONSE_FIELDS,
         )
-        return Event(calendarId=self.id, **events_result)
+        return record_import(self, new_event, events_result, source)
+
+    def patch_event(
+        self, eventId, event, changes, source=None, batch=None, callback=None
+    ):
+        """Brings the event eventId in this calendar up to date with event, by
+        patching it with changes, the fields in which it differs from event (see
+        event_patch). Otherwise, works like import_event; event is recorded as
+        the copy of source."""
+        new_event = event.copy()
+
+        if batch is not None:
+
+            def batch_callback(response, exception):
+                result = None
+                if exception is None:
+                    result = record_import(self, new_event, response, source)
+                if callback is not None:
+                    callback(result, exception)
+
+            batch.patch_event(
+                callback=batch_callback,
+                calendarId=self.id,
+                eventId=eventId,
+                body=changes,
+                fields=IMPORT_RESPONSE_FIELDS,
+            )
+            return
+
+        events_result = get_calendar_service().patch_event(
+            calendarId=self.id,
+            eventId=eventId,
+            body=changes,
+            fields=IMPORT_RESPONSE_FIELDS,
+        )
+        return record_import(self, new_event, events_result, source)
+
+
+def record_import(calendar, new_event, events_result, source):
+    """Returns the Event for an import (or patch) into calendar, given the API's
+    response, recording the copy in the state store if the source event is
+    known. Writes only ask for the fields of the response they need, so the
+    rest are filled in from the event written."""
+    result = Event(
+        **{**new_event.attributes, **events_result, "calendarId": calendar.id}
+    )
+
+    if source is not None:
+        get_state_store().set_event_mapping(
+            source.calendarId,
+            source.id,
+            calendar.id,
+            result.id,
+            new_event.fingerprint(),
+            new_event.attributes,
+        )
+
+    return result
+
+
+__shard_executor = None
+__shard_executor_lock = threading.Lock()
+
+
+def get_shard_executor():
+    """Returns the thread pool that shards of event listings are listed on. It
+    lasts as long as the process, so its threads build their API service
+    objects (see get_calendar_service) just once."""
+    global __shard_executor
+
+    with __shard_executor_lock:
+        if __shard_executor is None:
+            __shard_executor = ThreadPoolExecutor(
+                max_workers=MAX_SHARD_WORKERS, thread_name_prefix="calsync-shard"
+            )
+
+        return __shard_executor
+
+
+def new_batch():
+    """Returns a batch for queueing imports and deletes; see CalendarBatch."""
+    return get_calendar_service().new_batch()
+
+
+def stop_channel(channel):
+    """Closes a watch channel opened by Calendar.watch_events()."""
+    get_calendar_service().stop_channel(
+        body={"id": channel["id"], "resourceId": channel["resourceId"]}
+    )
 
 
 __cached_callist = None
@@ -102,23 +399,45 @@ __cached_callist = None
 def get_calendars():
     global __cached_callist
 
-    if __cached_callist is None:
-        callist = get_calendar_service().list_calendars(maxResults=50)
+    # each tenant has a calendar list of its own
+    tenant = get_current_tenant()
+    if tenant is not None:
+        if tenant.calendars is None:
+            callist = get_calendar_service().list_calendars()
+            tenant.calendars = [Calendar(**cal) for cal in callist]
+
+        return tenant.calendars
 
-        if not callist:
-            __cached_callist = []
-        else:
-            __cached_callist = [Calendar(**cal) for cal in callist]
+    if __cached_callist is None:
+        callist = get_calendar_service().list_calendars()
+        __cached_callist = [Calendar(**cal) for cal in callist]
 
     return __cached_callist
 
 
+def clear_calendars():
+    """Forgets the cached calendar list (the current tenant's, if there is one),
+    so get_calendars() lists it again."""
+    global __cached_callist
+
+    tenant = get_current_tenant()
+    if tenant is not None:
+        tenant.calendars = None
+    else:
+        __cached_callist = None
+
+
 def resolve_calendar(input):
     """Resolves the input to either a calendar name (summary) or ID"""
+    return find_calendar(get_calendars(), input)
+
+
+def find_calendar(calendars, input):
+    """Finds the calendar in calendars whose name (summary) or ID is input"""
     if input in DISALLOWED_SUMMARIES:
         raise ValueError(f"disallowed summary input: {input}")
 
-    for calendar in get_calendars():
+    for calendar in calendars:
         if calendar.summary == input:
             return calendar
         if calendar.summaryOverride == input:
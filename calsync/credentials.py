@@ -0,0 +1,235 @@
+from contextlib import contextmanager
+from datetime import datetime
+from datetime import timedelta
+import logging
+import os
+import os.path
+import threading
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows; only threads are kept in step there
+    fcntl = None
+
+from calsync.tenant import get_current_tenant
+
+logger = logging.getLogger(__name__)
+
+# If modifying these scopes, delete the file token.json.
+SCOPES = [
+    "https://www.googleapis.com/auth/calendar",
+    "https://www.googleapis.com/auth/calendar.events",
+]
+
+CREDENTIALS_FILE = "credentials.json"
+TOKEN_FILE = "token.json"
+CALLBACK_LISTEN_PORT = 56133
+
+# access tokens are refreshed this long before they expire, so requests never
+# wait on a refresh; it's longer than google-auth's own threshold, so its
+# unsynchronised refreshes don't get the chance to happen first
+REFRESH_MARGIN = timedelta(minutes=10)
+
+# the shortest time between the background refresher's attempts, in seconds,
+# so a failing refresh isn't retried in a tight loop
+MIN_REFRESH_INTERVAL = 30
+
+
+class CredentialManager:
+    """Loads the user's OAuth credentials from token_file, and keeps their
+    access token fresh.
+
+    The token is refreshed on a background thread, REFRESH_MARGIN ahead of its
+    expiry, into the same Credentials object every service holds, so requests
+    don't wait on refreshes. Refreshes are single-flight: a thread wanting one
+    takes an in-process lock and then an exclusive lock on token_file's lock
+    file, and re-reads token_file before refreshing, so if another thread or
+    py-calsync process has just refreshed, its token is used rather than
+    refreshing again. Refreshed tokens are written back atomically.
+
+    If there's no usable token, the user is asked to log in (through the
+    browser, as set up by credentials_file), again with the file locked, so
+    several processes starting together only ask once."""
+
+    def __init__(
+        self,
+        token_file=TOKEN_FILE,
+        credentials_file=CREDENTIALS_FILE,
+        scopes=SCOPES,
+        refresh_margin=REFRESH_MARGIN,
+    ):
+        self.token_file = token_file
+        self.credentials_file = credentials_file
+        self.scopes = scopes
+        self.refresh_margin = refresh_margin
+
+        self.credentials = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.refresher = None
+
+    def get(self):
+        """Returns the Credentials, loading them on first use. They're only
+        refreshed here if already expired; otherwise that's left to the
+        background refresher, which this starts."""
+        with self.lock:
+            if self.credentials is None:
+                with self.__file_lock():
+                    credentials = self.__read()
+                    # if there are no usable credentials, let the user log in
+                    if credentials is None or not (
+                        credentials.valid or credentials.refresh_token
+                    ):
+                        credentials = self.__log_in()
+
+                    self.credentials = credentials
+
+        if not self.credentials.valid:
+            self.refresh()
+
+        self.__start_refresher()
+        return self.credentials
+
+    def refresh(self):
+        """Refreshes the access token, unless it's already fresh, or another
+        thread or process has refreshed it since it was read."""
+        from google.auth.transport.requests import Request
+
+        with self.lock, self.__file_lock():
+            if self.__is_fresh(self.credentials):
+                return
+
+            latest = self.__read()
+            if self.__is_fresh(latest):
+                logger.debug("using token refreshed by another process")
+                # every service holds self.credentials, so it's updated in place
+                # rather than replaced; all of it, as the refresh token may have
+                # been rotated too
+                vars(self.credentials).update(vars(latest))
+                return
+
+            logger.debug("refreshing access token")
+            self.credentials.refresh(Request())
+            self.__write(self.credentials)
+
+    def stop(self):
+        """Stops the background refresher."""
+        self.stopping.set()
+        if self.refresher is not None:
+            self.refresher.join()
+            self.refresher = None
+
+    def get_refresh_wait(self):
+        """Returns how many seconds until the token needs refreshing, or None if
+        it can't be refreshed."""
+        credentials = self.credentials
+        if credentials is None or credentials.expiry is None:
+            return None
+        if not credentials.refresh_token:
+            return None
+
+        due = credentials.expiry - self.refresh_margin
+        return max(0, (due - datetime.utcnow()).total_seconds())
+
+    def __start_refresher(self):
+        with self.lock:
+            if self.refresher is not None or self.get_refresh_wait() is None:
+                return
+
+            self.refresher = threading.Thread(
+                target=self.__refresh_forever, daemon=True
+            )
+            self.refresher.start()
+
+    def __refresh_forever(self):
+        while not self.stopping.wait(self.get_refresh_wait()):
+            try:
+                self.refresh()
+            except Exception as ex:
+                # tried again shortly; until then, requests refresh by themselves
+                # once the token expires
+                logger.warning(f"failed to refresh access token: {ex}")
+
+            # however the refresh went, don't retry in a tight loop
+            if self.stopping.wait(MIN_REFRESH_INTERVAL):
+                return
+
+    def __is_fresh(self, credentials):
+        if credentials is None or not credentials.token:
+            return False
+        if credentials.expiry is None:
+            return True
+
+        return credentials.expiry - self.refresh_margin > datetime.utcnow()
+
+    def __read(self):
+        from google.oauth2.credentials import Credentials
+
+        # token_file stores the user's access and refresh tokens, and is created
+        # when the authorization flow completes for the first time
+        if not os.path.exists(self.token_file):
+            return None
+
+        return Credentials.from_authorized_user_file(self.token_file, self.scopes)
+
+    def __write(self, credentials):
+        # written to a temporary file and moved into place, so other processes
+        # never read half a token file
+        temporary = f"{self.token_file}.tmp"
+        with open(temporary, "w") as f:
+            f.write(credentials.to_json())
+
+        os.replace(temporary, self.token_file)
+
+    def __log_in(self):
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
+        flow = InstalledAppFlow.from_client_secrets_file(
+            self.credentials_file, self.scopes
+        )
+        credentials = flow.run_local_server(port=CALLBACK_LISTEN_PORT)
+        self.__write(credentials)
+        return credentials
+
+    @contextmanager
+    def __file_lock(self):
+        """Holds an exclusive lock on token_file's lock file, shared with other
+        processes."""
+        if fcntl is None:
+            yield
+            return
+
+        with open(f"{self.token_file}.lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+__cached_credential_manager = None
+__credential_manager_lock = threading.Lock()
+
+
+def get_credential_manager():
+    """Returns the CredentialManager shared by every service in the process, or
+    the current tenant's, if there is one."""
+    global __cached_credential_manager
+
+    tenant = get_current_tenant()
+    if tenant is not None:
+        return tenant.credential_manager
+
+    with __credential_manager_lock:
+        if __cached_credential_manager is None:
+            __cached_credential_manager = CredentialManager()
+
+    return __cached_credential_manager
+
+
+def set_credential_manager(credential_manager):
+    """Replaces the shared CredentialManager, e.g. with one for other files.
+    Passing None makes the next get_credential_manager() create a default one."""
+    global __cached_credential_manager
+    with __credential_manager_lock:
+        __cached_credential_manager = credential_manager
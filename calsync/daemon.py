@@ -0,0 +1,325 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import logging
+import secrets
+import signal
+import sys
+import threading
+import time
+import uuid
+
+from calsync.calendar import clear_calendars
+from calsync.calendar import resolve_calendar
+from calsync.calendar import stop_channel
+from calsync.config import get_config
+from calsync.rules.planner import get_rule_calendars
+from calsync.rules.rules import CONFIG_FILE
+from calsync.rules.rules import run_rules
+from calsync.rules.rules import RUN_DEFAULTS
+from calsync.rules.scheduler import ChangeScheduler
+from calsync.rules.scheduler import SCHEDULER_DEFAULTS
+
+logger = logging.getLogger(__name__)
+
+DAEMON_DEFAULTS = {
+    # where to listen for push notifications
+    "listen_host": "127.0.0.1",
+    "listen_port": 8080,
+    # if True, watch every calendar the rules read, so the API pushes a
+    # notification to the listener whenever one changes
+    "watch": True,
+    # the URL the API sends notifications to, which must reach the listener; the
+    # real API only sends to HTTPS URLs, so this is usually a reverse proxy in
+    # front of it. Defaults to the listener's own URL
+    "address": None,
+    # how long watch channels last before they're replaced, in seconds
+    "channel_ttl": 86400,
+    # how often to run every rule whether notified or not, in seconds, which
+    # catches changes whose notifications went missing
+    "poll_interval": 900,
+    # debounce and max_delay, for coalescing bursts of changes (see
+    # ChangeScheduler)
+    **SCHEDULER_DEFAULTS,
+}
+
+# the path notifications are received on
+NOTIFICATION_PATH = "/notifications"
+
+# watch channels are replaced this many seconds before they expire, or halfway
+# through their lifetime if that's sooner
+CHANNEL_RENEW_MARGIN = 600
+
+# the shortest channel_ttl allowed, in seconds, so channels aren't replaced
+# almost as soon as they're opened
+MIN_CHANNEL_TTL = 60
+
+
+class Daemon:
+    """Runs the rules in config continuously, in one long-running process, so
+    API services, the calendar list and the state store stay warm between runs.
+
+    Every calendar the rules read is watched through a push notification
+    channel, and when one changes, only the rules reading it are run, once its
+    changes have settled (see ChangeScheduler). Every rule is also run on start
+    and every poll_interval seconds, which covers any notifications that went
+    missing and calendars that couldn't be watched.
+    Rules run this way are best made incremental or delta, so each run only
+    reads what changed.
+
+    Use as a context manager, which starts and stops listening and watching:
+
+        with Daemon(config) as daemon:
+            daemon.run_forever()
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.options = {**DAEMON_DEFAULTS, **config.get("daemon", {})}
+        if self.options["channel_ttl"] < MIN_CHANNEL_TTL:
+            raise ValueError(
+                f"channel_ttl must be at least {MIN_CHANNEL_TTL} seconds, "
+                f"not {self.options['channel_ttl']}"
+            )
+
+        # sent with every notification, so forged ones can be told apart
+        self.token = secrets.token_urlsafe(16)
+
+        # open watch channels by id
+        self.channels = {}
+        self.scheduler = None
+        # the threads every run's rules run on, kept between runs so their API
+        # services and connections are too
+        self.executor = None
+
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.httpd = None
+        self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def url(self):
+        """The URL the listener receives notifications on."""
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}{NOTIFICATION_PATH}"
+
+    def start(self):
+        """Starts listening for notifications, and watches the calendars the
+        rules read. Returns self."""
+        self.httpd = ThreadingHTTPServer(
+            (self.options["listen_host"], self.options["listen_port"]),
+            self.__handler(),
+        )
+        self.httpd.daemon_threads = True
+
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+        concurrency = self.config.get("concurrency", RUN_DEFAULTS["concurrency"])
+        self.executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="calsync-rule"
+        )
+        self.scheduler = ChangeScheduler(
+            self.config["rules"],
+            resolve_calendar,
+            self.run,
+            concurrency=concurrency,
+            debounce=self.options["debounce"],
+            max_delay=self.options["max_delay"],
+        )
+
+        if self.options["watch"]:
+            self.watch()
+
+        return self
+
+    def stop(self):
+        """Stops run_forever(), closes every watch channel and stops listening."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+
+        for channel in list(self.channels.values()):
+            self.__close(channel)
+
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.thread.join()
+            self.httpd = None
+
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def run_forever(self):
+        """Runs every rule, then the rules reading each calendar as it changes,
+        and every rule again each poll_interval, until stop() is called. Rules
+        that fail are logged, and run again when next due."""
+        scheduler = threading.Thread(target=self.scheduler.run_forever)
+        scheduler.start()
+
+        next_poll = time.monotonic()
+
+        try:
+            while True:
+                with self.condition:
+                    wake = min(
+                        [next_poll] + [c["renew_at"] for c in self.channels.values()]
+                    )
+                    self.condition.wait_for(
+                        lambda: self.stopping, timeout=max(0, wake - time.monotonic())
+                    )
+                    if self.stopping:
+                        return
+
+                if time.monotonic() >= next_poll:
+                    # calendars may have been added or renamed since the last poll
+                    clear_calendars()
+                    self.scheduler.changed_all()
+                    next_poll = time.monotonic() + self.options["poll_interval"]
+
+                if self.options["watch"]:
+                    self.watch()
+
+        finally:
+            self.scheduler.stop()
+            scheduler.join()
+
+    def run(self, rules):
+        """Runs rules, a subset of config's."""
+        logger.info(f"running {len(rules)} rules")
+        run_rules({**self.config, "rules": rules}, executor=self.executor)
+
+    def get_sources(self):
+        """Returns the ids of the calendars the rules read."""
+        return {
+            calendar_id
+            for rule in self.config["rules"]
+            for calendar_id in get_rule_calendars(rule, resolve_calendar)[0]
+        }
+
+    def watch(self):
+        """Watches each calendar the rules read that isn't already watched, and
+        replaces channels about to expire. Calendars that can't be watched are
+        left to polling, and tried again next time."""
+        now = time.monotonic()
+        watched = {
+            c["calendarId"] for c in self.channels.values() if c["renew_at"] > now
+        }
+        address = self.options["address"] or self.url
+
+        for calendar_id in sorted(self.get_sources() - watched):
+            # the API sends a "sync" notification as soon as the channel opens,
+            # possibly before watch_events returns, so the channel is known
+            # beforehand rather than that notification being refused
+            channel_id = uuid.uuid4().hex
+            self.channels[channel_id] = {
+                "id": channel_id,
+                "calendarId": calendar_id,
+                "renew_at": float("inf"),
+            }
+
+            try:
+                channel = resolve_calendar(calendar_id).watch_events(
+                    channel_id,
+                    address,
+                    token=self.token,
+                    ttl=self.options["channel_ttl"],
+                )
+            except Exception as ex:
+                del self.channels[channel_id]
+                logger.warning(f"can't watch {calendar_id}, polling it instead: {ex}")
+                continue
+
+            # the old channel is only closed once the new one is open, so no
+            # change goes unnoticed in between
+            for old in [
+                c
+                for c in self.channels.values()
+                if c["calendarId"] == calendar_id and c["id"] != channel_id
+            ]:
+                self.__close(old)
+
+            # the API may grant a shorter lifetime than asked for
+            expires_in = int(channel["expiration"]) / 1000 - time.time()
+            renew_margin = min(CHANNEL_RENEW_MARGIN, expires_in / 2)
+            self.channels[channel_id] = dict(
+                channel,
+                calendarId=calendar_id,
+                renew_at=time.monotonic() + expires_in - renew_margin,
+            )
+
+    def __close(self, channel):
+        self.channels.pop(channel["id"], None)
+        try:
+            stop_channel(channel)
+        except Exception as ex:
+            # it expires by itself soon enough
+            logger.warning(f"couldn't close channel {channel['id']}: {ex}")
+
+    def notify(self, channel_id, token, state):
+        """Handles a push notification for channel_id. Returns False if it isn't
+        for one of our open channels."""
+        channel = self.channels.get(channel_id)
+        if channel is None or token != self.token:
+            return False
+
+        # "sync" just confirms the channel is open
+        if state != "sync":
+            self.scheduler.changed(channel["calendarId"])
+
+        return True
+
+    def __handler(self):
+        daemon = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                self.rfile.read(length)
+
+                if self.path != NOTIFICATION_PATH:
+                    status = 404
+                elif daemon.notify(
+                    self.headers.get("X-Goog-Channel-ID"),
+                    self.headers.get("X-Goog-Channel-Token"),
+                    self.headers.get("X-Goog-Resource-State"),
+                ):
+                    status = 200
+                else:
+                    status = 403
+
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        return Handler
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog="py-calsync daemon",
+        description="Runs rules continuously, as their calendars change.",
+    )
+    parser.add_argument("--config", default=CONFIG_FILE)
+    options = parser.parse_args(args)
+
+    # stop cleanly, closing watch channels, when asked to
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    with Daemon(get_config(options.config)) as daemon:
+        try:
+            daemon.run_forever()
+        except KeyboardInterrupt:
+            pass
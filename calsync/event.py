@@ -1,41 +1,205 @@
-COPY_SKIP_FIELDS = [
-    "anyoneCanAddSelf",  # deprecated
-    "attendees",  # to avoid triggering emails
-    "colorId",  # intentional so copied event appears different
-    "created",  # ro
-    "creator",  # ro
-    "etag",
-    "hangoutLink",  # ro
-    "htmlLink",
+import hashlib
+import json
+
+from calsync.util import event_time_to_datetime
+
+COPY_SKIP_FIELDS = frozenset(
+    [
+        "anyoneCanAddSelf",  # deprecated
+        "attendees",  # to avoid triggering emails
+        "colorId",  # intentional so copied event appears different
+        "created",  # ro
+        "creator",  # ro
+        "etag",
+        "hangoutLink",  # ro
+        "htmlLink",
+        "id",
+        "organizer",
+        "reminders",
+        "sequence",
+        "updated",  # ro
+        # "recurrence",  # causes 403 errors if used in imports
+    ]
+)
+
+# fields our code uses directly, which Events hold in slots of their own; every
+# other field is only needed when an event is copied or written out
+CORE_FIELDS = (
+    "calendarId",
     "id",
-    "organizer",
-    "reminders",
-    "sequence",
-    "updated",  # ro
-    # "recurrence",  # causes 403 errors if used in imports
-]
+    "iCalUID",
+    "summary",
+    "start",
+    "end",
+    "status",
+    "recurrence",
+    "updated",
+    "etag",
+)
+CORE_FIELD_SET = frozenset(CORE_FIELDS)
+
+# the extendedProperties.private key copies store their fingerprint under
+FINGERPRINT_PROPERTY = "calsyncFingerprint"
+
+# fields left out of fingerprints, as they don't describe the event's content
+FINGERPRINT_SKIP_FIELDS = ["calendarId"]
+
+# marks a start_time or end_time that hasn't been parsed yet
+UNPARSED = object()
+
+
+def event_patch(old, new):
+    """Returns the body of a patch turning an event with attributes old into one
+    with attributes new: fields that changed are set, and fields that are gone
+    are set to None, which clears them. Patches merge objects into the fields
+    they set, so objects are patched field by field too, while lists and other
+    values are replaced whole."""
+    patch = {}
+    for k, v in new.items():
+        if k not in old:
+            patch[k] = v
+        elif old[k] != v:
+            if type(v) is dict and type(old[k]) is dict:
+                patch[k] = event_patch(old[k], v)
+            else:
+                patch[k] = v
+
+    for k in old:
+        if k not in new:
+            patch[k] = None
+
+    return patch
 
 
 def event_short_repr(evt):
-    return f"Event(id={evt.id}, summary={evt.summary}, start={evt.start}, end={evt.end}, organizer={evt.attributes.get('organizer', {}).get('displayName')})"
+    return f"Event(id={evt.id}, summary={evt.summary}, start={evt.start}, end={evt.end}, organizer={evt.get('organizer', {}).get('displayName')})"
 
 
 class Event:
-    def __init__(self, **attributes):
-        self.attributes = attributes
+    """An event, as returned by the API. The fields in CORE_FIELDS are held in
+    slots, as our code uses them directly; missing ones are None. Every field,
+    core or not, is in the attributes dict.
+
+    Events listed from the API are built with from_api(), which keeps the fields
+    not in CORE_FIELDS encoded as JSON until attributes is first read, as a
+    string takes far less memory than the nested dicts it decodes to."""
 
-        # copy these attributes onto the class itself as our code uses them directly
-        for k in ["calendarId", "summary", "start", "end", "id"]:
+    __slots__ = CORE_FIELDS + (
+        "__attributes",
+        "__payload",
+        "__skipped_payload",
+        "__start_time",
+        "__end_time",
+    )
+
+    def __init__(self, **attributes):
+        for k in CORE_FIELDS:
             setattr(self, k, attributes.get(k))
 
+        self.__attributes = attributes
+        self.__payload = None
+        self.__skipped_payload = None
+        self.__start_time = UNPARSED
+        self.__end_time = UNPARSED
+
+    @classmethod
+    def from_api(cls, calendarId, data):
+        """Returns an Event in calendarId for data, an event resource from the
+        API. The fields copy() skips are encoded apart from the rest, so copies
+        can share the encoded rest without decoding it."""
+        event = cls.__new__(cls)
+        for k in CORE_FIELDS:
+            setattr(event, k, data.get(k))
+        event.calendarId = calendarId
+
+        payload = {}
+        skipped_payload = {}
+        for k, v in data.items():
+            if k in CORE_FIELD_SET:
+                continue
+            if k in COPY_SKIP_FIELDS:
+                skipped_payload[k] = v
+            else:
+                payload[k] = v
+
+        event.__attributes = None
+        event.__payload = cls.__encode(payload)
+        event.__skipped_payload = cls.__encode(skipped_payload)
+        event.__start_time = UNPARSED
+        event.__end_time = UNPARSED
+        return event
+
+    @staticmethod
+    def __encode(fields):
+        if not fields:
+            return None
+
+        return json.dumps(fields, separators=(",", ":"), ensure_ascii=False)
+
+    @property
+    def attributes(self):
+        """All of the event's fields. The first read decodes any fields held
+        encoded; from then on, changes made to the dict are kept."""
+        if self.__attributes is None:
+            attributes = {}
+            for k in CORE_FIELDS:
+                v = getattr(self, k)
+                if v is not None:
+                    attributes[k] = v
+
+            for payload in (self.__payload, self.__skipped_payload):
+                if payload is not None:
+                    attributes.update(json.loads(payload))
+
+            self.__attributes = attributes
+            self.__payload = None
+            self.__skipped_payload = None
+
+        return self.__attributes
+
+    def get(self, key, default=None):
+        """Returns field key, or default if the event doesn't have it. Unlike
+        attributes.get(), core fields are read without decoding anything."""
+        if self.__attributes is not None:
+            return self.__attributes.get(key, default)
+
+        if key in CORE_FIELD_SET:
+            v = getattr(self, key)
+            return default if v is None else v
+
+        if key in COPY_SKIP_FIELDS:
+            payload = self.__skipped_payload
+        else:
+            payload = self.__payload
+
+        if payload is None:
+            return default
+
+        return json.loads(payload).get(key, default)
+
+    @property
+    def start_time(self):
+        """start as an aware datetime (see event_time_to_datetime), parsed on
+        first use."""
+        if self.__start_time is UNPARSED:
+            self.__start_time = event_time_to_datetime(self.start)
+        return self.__start_time
+
+    @property
+    def end_time(self):
+        """end as an aware datetime (see event_time_to_datetime), parsed on
+        first use."""
+        if self.__end_time is UNPARSED:
+            self.__end_time = event_time_to_datetime(self.end)
+        return self.__end_time
+
     def __eq__(self, other):
         if type(other) is not Event:
             return False
 
-        for a in self.attributes:
-            if a not in other.attributes:
-                return False
-            if other.attributes[a] != self.attributes[a]:
+        other_attributes = other.attributes
+        for k, v in self.attributes.items():
+            if k not in other_attributes or other_attributes[k] != v:
                 return False
 
         return True
@@ -46,19 +210,74 @@ class Event:
         )
 
     def copy(self):
-        new_attrs = {}
-        for k in self.attributes:
-            if k not in COPY_SKIP_FIELDS:
-                new_attrs[k] = self.attributes[k]
+        if self.__attributes is not None:
+            return Event(
+                **{
+                    k: v
+                    for k, v in self.__attributes.items()
+                    if k not in COPY_SKIP_FIELDS
+                }
+            )
+
+        # the fields copy() skips are encoded separately, so a copy of an event
+        # that is still encoded can share the rest as is
+        new = Event.__new__(Event)
+        for k in CORE_FIELDS:
+            setattr(new, k, None if k in COPY_SKIP_FIELDS else getattr(self, k))
+
+        new.__attributes = None
+        new.__payload = self.__payload
+        new.__skipped_payload = None
+        new.__start_time = self.__start_time
+        new.__end_time = self.__end_time
+        return new
+
+    def get_private_property(self, key):
+        return self.attributes.get("extendedProperties", {}).get("private", {}).get(key)
+
+    def set_private_property(self, key, value):
+        extended_properties = dict(self.attributes.get("extendedProperties", {}))
+        private = dict(extended_properties.get("private", {}))
+        private[key] = value
 
-        return Event(**new_attrs)
+        extended_properties["private"] = private
+        self.attributes["extendedProperties"] = extended_properties
+
+    def fingerprint(self):
+        """Returns a stable hash of the event's content, for spotting whether a
+        copy has changed. The fingerprint stored on a copy is ignored, so a copy
+        carrying its own fingerprint hashes the same as it did without it."""
+        attrs = {
+            k: v for k, v in self.attributes.items() if k not in FINGERPRINT_SKIP_FIELDS
+        }
+
+        if self.get_private_property(FINGERPRINT_PROPERTY) is not None:
+            extended_properties = dict(attrs["extendedProperties"])
+            extended_properties["private"] = {
+                k: v
+                for k, v in extended_properties["private"].items()
+                if k != FINGERPRINT_PROPERTY
+            }
+            if not extended_properties["private"]:
+                del extended_properties["private"]
+
+            if extended_properties:
+                attrs["extendedProperties"] = extended_properties
+            else:
+                del attrs["extendedProperties"]
+
+        data = json.dumps(attrs, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
 
     def is_all_day(self):
-        _start = self.attributes.get("start", {})
-        _end = self.attributes.get("end", {})
+        _start = self.start or {}
+        _end = self.end or {}
         return (
             "dateTime" not in _start
             and "date" in _start
             and "dateTime" not in _end
             and "date" in _end
         )
+
+    def is_cancelled(self):
+        return self.status == "cancelled"
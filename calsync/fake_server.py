@@ -0,0 +1,738 @@
+from datetime import datetime
+from email.parser import Parser
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import json
+import logging
+import queue
+import random
+import threading
+import time
+from urllib.parse import parse_qs
+from urllib.parse import unquote
+from urllib.parse import urlsplit
+from urllib.request import Request
+from urllib.request import urlopen
+import uuid
+
+from calsync.util import datetime_to_rfc3339
+from calsync.util import event_time_to_datetime
+from calsync.util import rfc3339_to_datetime
+
+logger = logging.getLogger(__name__)
+
+SERVICE_PATH = "/calendar/v3"
+BATCH_PATH = "/batch/calendar/v3"
+
+# The largest page sizes the API allows, used when maxResults isn't given or is
+# larger
+MAX_EVENTS_PAGE_SIZE = 2500
+MAX_CALENDARS_PAGE_SIZE = 250
+
+# how long watch channels last when the request doesn't give a ttl, in seconds
+DEFAULT_CHANNEL_TTL = 604800
+
+# how long to wait for a notification to be accepted before giving up on it
+NOTIFICATION_TIMEOUT = 5
+
+STATUS_REASONS = {
+    200: "OK",
+    204: "No Content",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    410: "Gone",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+class FakeApiError(Exception):
+    """Raised while handling a call to have the server respond with an error."""
+
+    def __init__(self, status, reason, message=None):
+        super().__init__(message or reason)
+        self.status = status
+        self.reason = reason
+
+    def to_json(self):
+        message = str(self)
+        return {
+            "error": {
+                "code": self.status,
+                "message": message,
+                "errors": [
+                    {"domain": "global", "reason": self.reason, "message": message}
+                ],
+            }
+        }
+
+
+def parse_fields(mask):
+    """Parses a partial response mask, as passed in the fields parameter (such
+    as "nextPageToken,items(id,start/dateTime)"), into a dict mapping each field
+    selected to the fields selected within it, or None for all of them."""
+    fields, end = __parse_fields(mask, 0)
+    if end != len(mask):
+        raise FakeApiError(400, "invalidParameter", f"invalid fields mask {mask}")
+
+    return fields
+
+
+def __parse_fields(mask, pos):
+    """Parses the comma-separated selections in mask from pos, up to the end or
+    an unmatched ")". Returns (fields, the position parsing stopped at)."""
+    fields = {}
+    while pos < len(mask) and mask[pos] != ")":
+        end = pos
+        while end < len(mask) and mask[end] not in ",()":
+            end += 1
+
+        # a/b/c selects c within b within a
+        path = mask[pos:end].strip().split("/")
+        selected = fields
+        for name in path[:-1]:
+            # selections within a field that's selected in full change nothing
+            if selected is not None:
+                selected = selected.setdefault(name, {})
+        sub = None
+
+        if end < len(mask) and mask[end] == "(":
+            sub, end = __parse_fields(mask, end + 1)
+            if end >= len(mask) or mask[end] != ")":
+                raise FakeApiError(
+                    400, "invalidParameter", f"invalid fields mask {mask}"
+                )
+            end += 1
+
+        if selected is not None:
+            selected[path[-1]] = sub
+        pos = end + 1 if end < len(mask) and mask[end] == "," else end
+
+    return fields, pos
+
+
+def select_fields(value, fields):
+    """Returns value (a response, or part of one) with only the fields that
+    parse_fields() parsed into fields kept. Lists have the selection applied to
+    each item."""
+    if fields is None:
+        return value
+
+    if type(value) is list:
+        return [select_fields(v, fields) for v in value]
+
+    if type(value) is not dict:
+        return value
+
+    return {k: select_fields(value[k], sub) for k, sub in fields.items() if k in value}
+
+
+def merge_patch(value, patch):
+    """Returns value with patch applied as events.patch applies it: fields set
+    to None are removed, objects are merged field by field, and anything else
+    replaces the value."""
+    merged = dict(value)
+    for k, v in patch.items():
+        if v is None:
+            merged.pop(k, None)
+        elif type(v) is dict and type(merged.get(k)) is dict:
+            merged[k] = merge_patch(merged[k], v)
+        else:
+            merged[k] = v
+
+    return merged
+
+
+class FakeHTTPServer(ThreadingHTTPServer):
+    # clients such as the async backend open many connections at once, which
+    # the default listen backlog of 5 would drop (and the clients retry a second
+    # later)
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class FakeCalendarServer:
+    """A stand-in for the parts of the Calendar v3 API that calsync uses
+    (calendarList.list, events.list, events.import, events.patch, events.delete,
+    events.watch, channels.stop and batch requests), served over HTTP on
+    localhost from memory, for testing and benchmarking without a network or a
+    Google account. Watch channels are sent push notifications of changes, as
+    the real API sends them.
+
+    Point calsync at it with calsync.service.set_api_endpoint(server.url).
+
+    Behaviour can be degraded to exercise calsync's handling of a real server:
+
+    - latency delays every HTTP request by that many seconds
+    - error_rate fails that fraction of API calls with a 503
+    - fail_next() queues failures for the next API calls
+    - quota limits API calls per second, failing the rest with a rate limit 403
+    - expire_sync_tokens() and expire_updated_min() make listings of changes
+      fail with a 410, so a full listing is needed
+
+    Each call in a batch counts as an API call, as it does against the real API.
+    Partial responses (the fields parameter) are supported for every call.
+    Recurring events aren't expanded into instances, whatever singleEvents is.
+
+    Use as a context manager, which starts and stops the server:
+
+        with FakeCalendarServer() as server:
+            server.add_calendar("cal@example.com", summary="Main calendar")
+            set_api_endpoint(server.url)
+            ...
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0, error_rate=0, quota=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.quota = quota
+
+        self.calendars = {}
+        self.events = {}
+        self.failures = []
+        self.stats = self.__new_stats()
+
+        # every change to an event is numbered, so sync tokens can be the number
+        # of the last change seen; expiring tokens moves on to a new generation
+        self.sequence = 0
+        self.changes = {}
+        self.generation = 0
+        # listings with an updatedMin before this are rejected as too long ago
+        self.updated_min_limit = None
+
+        # when the current quota second started, and the calls made in it
+        self.quota_window = None
+        self.quota_used = 0
+
+        # watch channels by id, and push notifications waiting to be sent
+        self.channels = {}
+        self.notifications = queue.Queue()
+
+        self.lock = threading.RLock()
+        self.httpd = None
+        self.thread = None
+        self.notifier = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def url(self):
+        """The root URL of the server, for set_api_endpoint()."""
+        return f"http://{self.host}:{self.port}/"
+
+    def start(self):
+        """Starts serving on a background thread. Returns self."""
+        self.httpd = FakeHTTPServer((self.host, self.port), self.__handler())
+        self.port = self.httpd.server_address[1]
+
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+        self.notifier = threading.Thread(target=self.__send_notifications, daemon=True)
+        self.notifier.start()
+        return self
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.thread.join()
+            self.httpd = None
+
+        if self.notifier is not None:
+            self.notifications.put(None)
+            self.notifier.join()
+            self.notifier = None
+
+    def __send_notifications(self):
+        """Sends queued push notifications, in order, until stop() is called."""
+        while True:
+            notification = self.notifications.get()
+            if notification is None:
+                return
+
+            address, headers = notification
+            try:
+                request = Request(address, data=b"", headers=headers, method="POST")
+                with urlopen(request, timeout=NOTIFICATION_TIMEOUT):
+                    pass
+            except Exception as ex:
+                # the real API retries for a while, then gives up too
+                logger.warning(f"failed to send notification to {address}: {ex}")
+
+    def add_calendar(self, id, summary=None, **attributes):
+        """Adds a calendar to the user's calendar list, and returns it."""
+        with self.lock:
+            calendar = {
+                "kind": "calendar#calendarListEntry",
+                "id": id,
+                "summary": summary if summary is not None else id,
+                **attributes,
+            }
+            self.calendars[id] = calendar
+            self.events.setdefault(id, {})
+            return calendar
+
+    def add_event(self, calendarId, **event):
+        """Adds an event to a calendar, as if imported, and returns it."""
+        with self.lock:
+            return self.__import_event(calendarId, event)
+
+    def get_events(self, calendarId, showDeleted=False):
+        """Returns the events in a calendar, in the order they were added."""
+        with self.lock:
+            return [
+                dict(e)
+                for e in self.events[calendarId].values()
+                if showDeleted or e.get("status") != "cancelled"
+            ]
+
+    def fail_next(self, status=503, reason="backendError", count=1):
+        """Fails the next count API calls with the given status and reason."""
+        with self.lock:
+            self.failures.extend([(status, reason)] * count)
+
+    def expire_sync_tokens(self):
+        """Expires every sync token issued so far, so using one gets a 410."""
+        with self.lock:
+            self.generation += 1
+
+    def expire_updated_min(self, limit=None):
+        """Rejects listings with an updatedMin before limit (an RFC3339 time,
+        defaulting to now) with a 410, as the API rejects ones too long ago."""
+        with self.lock:
+            self.updated_min_limit = limit or datetime_to_rfc3339(datetime.utcnow())
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = self.__new_stats()
+
+    def __new_stats(self):
+        return {
+            # HTTP requests received, counting a batch request once
+            "requests": 0,
+            # API calls made, counting each call in a batch
+            "calls": 0,
+            "batches": 0,
+            "errors": 0,
+            "bytes_received": 0,
+            "bytes_sent": 0,
+            # API calls by method, e.g. "events.list"
+            "methods": {},
+        }
+
+    def __handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep connections alive between requests, as the real API does
+            protocol_version = "HTTP/1.1"
+            # headers and body are written separately, which Nagle's algorithm
+            # would hold up waiting for the client's delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                self.__handle()
+
+            def do_POST(self):
+                self.__handle()
+
+            def do_PATCH(self):
+                self.__handle()
+
+            def do_DELETE(self):
+                self.__handle()
+
+            def __handle(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length)
+                status, headers, content = server.handle_request(
+                    self.command, self.path, self.headers, body
+                )
+
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        return Handler
+
+    def handle_request(self, method, path, headers, body):
+        """Handles an HTTP request, returning (status, headers, content)."""
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["bytes_received"] += len(body)
+
+        if method == "POST" and urlsplit(path).path == BATCH_PATH:
+            status, headers, content = self.__handle_batch(headers, body)
+        else:
+            status, result = self.__call(method, path, body)
+            headers = {}
+            content = b""
+            if result is not None:
+                headers["Content-Type"] = "application/json; charset=UTF-8"
+                content = json.dumps(result).encode("utf-8")
+
+        with self.lock:
+            self.stats["bytes_sent"] += len(content)
+
+        return status, headers, content
+
+    def __handle_batch(self, headers, body):
+        """Handles a multipart/mixed batch request, in the format googleapiclient's
+        BatchHttpRequest sends, by making each call in turn."""
+        with self.lock:
+            self.stats["batches"] += 1
+
+        message = Parser().parsestr(
+            f"Content-Type: {headers['Content-Type']}\r\n\r\n" + body.decode("utf-8")
+        )
+
+        boundary = uuid.uuid4().hex
+        parts = []
+        for part in message.get_payload():
+            request = part.get_payload()
+            request_line, request = request.split("\n", 1)
+            method, path, _ = request_line.split(" ", 2)
+            call_body = Parser().parsestr(request).get_payload()
+
+            status, result = self.__call(method, path, call_body.encode("utf-8"))
+            content = json.dumps(result) if result is not None else ""
+            parts.append(
+                f"--{boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <response-{part['Content-ID'][1:-1]}>\r\n"
+                "\r\n"
+                f"HTTP/1.1 {status} {STATUS_REASONS.get(status, '')}\r\n"
+                "Content-Type: application/json; charset=UTF-8\r\n"
+                "\r\n"
+                f"{content}\r\n"
+            )
+
+        content = "".join(parts) + f"--{boundary}--\r\n"
+        headers = {"Content-Type": f"multipart/mixed; boundary={boundary}"}
+        return 200, headers, content.encode("utf-8")
+
+    def __call(self, method, path, body):
+        """Makes a single API call, returning (status, result)."""
+        url = urlsplit(path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        segments = [unquote(s) for s in url.path.split("/")]
+
+        try:
+            if segments[:3] != ["", "calendar", "v3"]:
+                raise FakeApiError(404, "notFound", f"no such path {url.path}")
+
+            route = (method, *segments[3:4], *segments[5:])
+            if route == ("GET", "users", "calendarList"):
+                name, call = "calendarList.list", self.__list_calendars
+
+            elif route == ("GET", "calendars", "events"):
+                name, call = "events.list", self.__list_events
+
+            elif route == ("POST", "calendars", "events", "import"):
+                name, call = "events.import", self.__call_import_event
+
+            elif route == ("POST", "calendars", "events", "watch"):
+                name, call = "events.watch", self.__watch_events
+
+            elif route == ("POST", "channels") and segments[4:] == ["stop"]:
+                name, call = "channels.stop", self.__stop_channel
+
+            elif route[:3] == ("PATCH", "calendars", "events") and len(route) == 4:
+                name, call = "events.patch", self.__patch_event
+
+            elif route[:3] == ("DELETE", "calendars", "events") and len(route) == 4:
+                name, call = "events.delete", self.__delete_event
+
+            else:
+                raise FakeApiError(404, "notFound", f"no such method {url.path}")
+
+            self.__count_call(name)
+
+            with self.lock:
+                result = call(segments, query, body)
+
+            if result is not None and "fields" in query:
+                result = select_fields(result, parse_fields(query["fields"]))
+
+            return (200, result) if result is not None else (204, None)
+
+        except FakeApiError as ex:
+            with self.lock:
+                self.stats["errors"] += 1
+            return ex.status, ex.to_json()
+
+    def __count_call(self, name):
+        """Counts an API call against the stats and the quota, raising any error
+        the call should fail with instead of being made."""
+        with self.lock:
+            self.stats["calls"] += 1
+            methods = self.stats["methods"]
+            methods[name] = methods.get(name, 0) + 1
+
+            if self.quota is not None:
+                now = time.monotonic()
+                if self.quota_window is None or now - self.quota_window >= 1:
+                    self.quota_window = now
+                    self.quota_used = 0
+
+                self.quota_used += 1
+                if self.quota_used > self.quota:
+                    raise FakeApiError(403, "rateLimitExceeded", "Rate Limit Exceeded")
+
+            if self.failures:
+                status, reason = self.failures.pop(0)
+                raise FakeApiError(status, reason, f"injected {status} error")
+
+            if self.error_rate and random.random() < self.error_rate:
+                raise FakeApiError(503, "backendError", "Backend Error")
+
+    def __get_calendar_events(self, calendarId):
+        if calendarId not in self.events:
+            raise FakeApiError(404, "notFound", f"no calendar {calendarId}")
+
+        return self.events[calendarId]
+
+    def __page(self, items, query, max_page_size):
+        """Returns the page of items asked for by query's maxResults and
+        pageToken (an offset), with nextPageToken set if there are more."""
+        page_size = min(int(query.get("maxResults", max_page_size)), max_page_size)
+        offset = int(query.get("pageToken", 0))
+
+        result = {"items": items[offset : offset + page_size]}
+        if offset + page_size < len(items):
+            result["nextPageToken"] = str(offset + page_size)
+
+        return result
+
+    def __list_calendars(self, segments, query, body):
+        result = self.__page(
+            list(self.calendars.values()), query, MAX_CALENDARS_PAGE_SIZE
+        )
+        result["kind"] = "calendar#calendarList"
+        return result
+
+    def __list_events(self, segments, query, body):
+        calendarId = segments[4]
+        events = self.__get_calendar_events(calendarId)
+
+        if "syncToken" in query:
+            if "timeMin" in query or "timeMax" in query:
+                raise FakeApiError(
+                    400, "invalid", "syncToken can't be used with timeMin/timeMax"
+                )
+
+            since = self.__parse_sync_token(query["syncToken"])
+            items = [
+                e
+                for e in events.values()
+                if self.changes[(calendarId, e["id"])] > since
+            ]
+
+        else:
+            # events deleted since updatedMin are listed whatever showDeleted is
+            show_deleted = query.get("showDeleted") == "true" or "updatedMin" in query
+            updated_min = rfc3339_to_datetime(query.get("updatedMin"))
+            if (
+                updated_min is not None
+                and self.updated_min_limit is not None
+                and updated_min < rfc3339_to_datetime(self.updated_min_limit)
+            ):
+                raise FakeApiError(
+                    410,
+                    "updatedMinTooLongAgo",
+                    "The requested minimum modification time lies too far in the past",
+                )
+            time_min = rfc3339_to_datetime(query.get("timeMin"))
+            time_max = rfc3339_to_datetime(query.get("timeMax"))
+            items = [
+                e
+                for e in events.values()
+                if (show_deleted or e.get("status") != "cancelled")
+                and self.__in_window(e, time_min, time_max)
+                and (
+                    updated_min is None
+                    or rfc3339_to_datetime(e["updated"]) >= updated_min
+                )
+            ]
+
+        if query.get("orderBy") == "startTime":
+            items.sort(key=lambda e: e["start"].get("dateTime", e["start"].get("date")))
+        elif query.get("orderBy") == "updated":
+            items.sort(key=lambda e: e["updated"])
+
+        result = self.__page(items, query, MAX_EVENTS_PAGE_SIZE)
+        result["kind"] = "calendar#events"
+        if "nextPageToken" not in result:
+            result["nextSyncToken"] = f"{self.generation}:{self.sequence}"
+
+        return result
+
+    def __parse_sync_token(self, token):
+        try:
+            generation, sequence = map(int, token.split(":"))
+        except ValueError:
+            raise FakeApiError(400, "invalid", f"invalid sync token {token}")
+
+        if generation != self.generation:
+            raise FakeApiError(410, "fullSyncRequired", "Sync token is no longer valid")
+
+        return sequence
+
+    def __in_window(self, event, time_min, time_max):
+        start = event_time_to_datetime(event.get("start"))
+        end = event_time_to_datetime(event.get("end"))
+
+        if time_max is not None and start is not None and start >= time_max:
+            return False
+
+        if time_min is not None and end is not None and end <= time_min:
+            return False
+
+        return True
+
+    def __call_import_event(self, segments, query, body):
+        return self.__import_event(segments[4], json.loads(body))
+
+    def __import_event(self, calendarId, event):
+        """Imports event, replacing any event in the calendar with the same
+        iCalUID, as the real events.import does."""
+        events = self.__get_calendar_events(calendarId)
+
+        if "start" not in event or "end" not in event:
+            raise FakeApiError(400, "required", "Missing start or end time")
+
+        event = dict(event)
+        event.setdefault("iCalUID", f"{uuid.uuid4().hex}@calsync.fake")
+        event.pop("calendarId", None)
+
+        existing = next(
+            (e for e in events.values() if e["iCalUID"] == event["iCalUID"]), None
+        )
+        event["id"] = existing["id"] if existing is not None else uuid.uuid4().hex
+        event["status"] = event.get("status", "confirmed")
+        event["kind"] = "calendar#event"
+
+        self.__record_change(calendarId, event)
+        events[event["id"]] = event
+        return event
+
+    def __patch_event(self, segments, query, body):
+        """Patches an event, as the real events.patch does: fields in the body
+        replace the event's, fields set to null are cleared, and objects are
+        merged into the event's field by field."""
+        calendarId, eventId = segments[4], segments[6]
+        events = self.__get_calendar_events(calendarId)
+
+        event = events.get(eventId)
+        if event is None:
+            raise FakeApiError(404, "notFound", "Not Found")
+        if event["status"] == "cancelled":
+            raise FakeApiError(410, "deleted", "Resource has been deleted")
+
+        patched = merge_patch(event, json.loads(body))
+        if "start" not in patched or "end" not in patched:
+            raise FakeApiError(400, "required", "Missing start or end time")
+
+        self.__record_change(calendarId, patched)
+        events[eventId] = patched
+        return patched
+
+    def __delete_event(self, segments, query, body):
+        calendarId, eventId = segments[4], segments[6]
+        events = self.__get_calendar_events(calendarId)
+
+        event = events.get(eventId)
+        if event is None:
+            raise FakeApiError(404, "notFound", "Not Found")
+        if event["status"] == "cancelled":
+            raise FakeApiError(410, "deleted", "Resource has been deleted")
+
+        # deleted events are kept, cancelled, so syncs can report the deletion
+        event["status"] = "cancelled"
+        self.__record_change(calendarId, event)
+        return None
+
+    def __watch_events(self, segments, query, body):
+        """Opens a watch channel on a calendar's events, which is sent a "sync"
+        notification straight away, and an "exists" one after every change."""
+        calendarId = segments[4]
+        self.__get_calendar_events(calendarId)
+
+        request = json.loads(body)
+        if request.get("type") != "web_hook" or not request.get("address"):
+            raise FakeApiError(400, "invalid", "channels must be web_hooks")
+        if request.get("id") in self.channels:
+            raise FakeApiError(400, "channelIdNotUnique", "Channel id not unique")
+
+        ttl = int(request.get("params", {}).get("ttl", DEFAULT_CHANNEL_TTL))
+        channel = {
+            "kind": "api#channel",
+            "id": request["id"],
+            "resourceId": uuid.uuid4().hex,
+            "resourceUri": f"{self.url}calendar/v3/calendars/{calendarId}/events",
+            "expiration": str(int((time.time() + ttl) * 1000)),
+        }
+        if "token" in request:
+            channel["token"] = request["token"]
+
+        self.channels[channel["id"]] = dict(
+            channel, calendarId=calendarId, address=request["address"], messages=0
+        )
+        self.__notify(self.channels[channel["id"]], "sync")
+        return channel
+
+    def __stop_channel(self, segments, query, body):
+        request = json.loads(body)
+
+        channel = self.channels.get(request.get("id"))
+        if channel is None or channel["resourceId"] != request.get("resourceId"):
+            raise FakeApiError(404, "notFound", "Channel not found")
+
+        del self.channels[channel["id"]]
+        return None
+
+    def __notify(self, channel, state):
+        """Queues a push notification to channel, with the headers the real API
+        sends."""
+        headers = {
+            "X-Goog-Channel-ID": channel["id"],
+            "X-Goog-Channel-Expiration": channel["expiration"],
+            "X-Goog-Message-Number": str(channel["messages"] + 1),
+            "X-Goog-Resource-ID": channel["resourceId"],
+            "X-Goog-Resource-State": state,
+            "X-Goog-Resource-URI": channel["resourceUri"],
+        }
+        if "token" in channel:
+            headers["X-Goog-Channel-Token"] = channel["token"]
+
+        channel["messages"] += 1
+        self.notifications.put((channel["address"], headers))
+
+    def __record_change(self, calendarId, event):
+        self.sequence += 1
+        self.changes[(calendarId, event["id"])] = self.sequence
+
+        event["updated"] = datetime_to_rfc3339(datetime.utcnow())
+        event["etag"] = f'"{self.sequence}"'
+
+        for channel in self.channels.values():
+            if channel["calendarId"] == calendarId:
+                self.__notify(channel, "exists")
@@ -1,38 +1,157 @@
-from fnmatch import fnmatch
+from fnmatch import translate
+from functools import cached_property
+import operator
+import os.path
+import re
 
+# Rough relative costs of evaluating each kind of filter, used to order the
+# children of any_of/all_of so that cheap checks can short-circuit costly ones
+ALL_DAY_EVENT_COST = 1
+SUMMARY_COST = 2
 
-def match_all_day_event(data, event):
+# summary globs match as fnmatch does, which ignores case where the OS does
+CASE_INSENSITIVE_SUMMARIES = os.path.normcase("A") == "a"
+
+
+class EventColumns:
+    """A batch of events stored column-wise, for matching filters against the
+    whole batch at once with match_many(). Each column is a list with an entry
+    per event, in the same order as events, and is only built when a filter
+    first needs it."""
+
+    def __init__(self, events):
+        self.events = events
+        self.size = len(events)
+
+    @cached_property
+    def summaries(self):
+        """Summaries as the summary filter compares them."""
+        summaries = [e.summary or "" for e in self.events]
+        if CASE_INSENSITIVE_SUMMARIES:
+            summaries = list(map(os.path.normcase, summaries))
+        return summaries
+
+    @cached_property
+    def all_day(self):
+        return [e.is_all_day() for e in self.events]
+
+    @cached_property
+    def starts(self):
+        return [e.start_time for e in self.events]
+
+    @cached_property
+    def ends(self):
+        return [e.end_time for e in self.events]
+
+
+class CompiledFilter:
+    """A filter compiled by compile_tree(): predicate(event) returns whether
+    event matches, and bulk(columns) returns a mask (a list of bools) of whether
+    each event in an EventColumns matches. If the filter always gives the same
+    answer, predicate and bulk are None and constant holds the answer."""
+
+    def __init__(self, predicate=None, bulk=None, constant=None, cost=0, globs=None):
+        self.predicate = predicate
+        self.bulk = bulk
+        self.constant = constant
+        self.cost = cost
+        # the summary globs of a summary filter, so any_of can merge them
+        self.globs = globs
+
+    def is_constant(self):
+        return self.predicate is None
+
+
+def __summary_regex(globs):
+    """Returns a regex matching summaries matching any of globs, as fnmatch
+    would match them."""
+    return re.compile("|".join(translate(os.path.normcase(g)) for g in globs))
+
+
+def compile_all_day_event(data):
     """Matches all-day events. Example config:
 
     filter:
         all_day_event: true
     """
-    assert type(data) is bool
-    return event.is_all_day() == data
+    if type(data) is not bool:
+        raise ValueError(f"all_day_event filter must be true or false, not {data!r}")
 
+    if data:
+        return CompiledFilter(
+            lambda event: event.is_all_day(),
+            lambda columns: list(columns.all_day),
+            cost=ALL_DAY_EVENT_COST,
+        )
 
-def match_summary(data, event):
+    return CompiledFilter(
+        lambda event: not event.is_all_day(),
+        lambda columns: list(map(operator.not_, columns.all_day)),
+        cost=ALL_DAY_EVENT_COST,
+    )
+
+
+def compile_summary(data):
     """Matches an event summary, which can contain globs. Example config:
 
     filter:
         summary: Your order from Amazon*
     """
-    assert type(data) is str
-    return fnmatch(event.summary, data)
+    if type(data) is not str:
+        raise ValueError(f"summary filter must be a string, not {data!r}")
+
+    return compile_summaries([data])
+
+
+def compile_summaries(globs):
+    """Matches event summaries matching any of globs, with a single regex."""
+    if "*" in globs:
+        return CompiledFilter(constant=True)
+
+    regex_match = __summary_regex(globs).match
+
+    if CASE_INSENSITIVE_SUMMARIES:
+
+        def match_summary(event):
+            return regex_match(os.path.normcase(event.summary or "")) is not None
 
+    else:
 
-def match_not(data, event):
+        def match_summary(event):
+            return regex_match(event.summary or "") is not None
+
+    def match_summaries(columns):
+        return [m is not None for m in map(regex_match, columns.summaries)]
+
+    return CompiledFilter(
+        match_summary, match_summaries, cost=SUMMARY_COST, globs=list(globs)
+    )
+
+
+def compile_not(data):
     """Matches the inverse of a nested match. Example config:
 
     filter:
         not:
             summary: Your order from Amazon*
     """
-    assert type(data) is dict
-    return not match(data, event)
+    if type(data) is not dict:
+        raise ValueError(f"not filter must hold a filter, not {data!r}")
 
+    compiled = compile_tree(data)
+    if compiled.is_constant():
+        return CompiledFilter(constant=not compiled.constant)
 
-def match_any_of(data, event):
+    predicate = compiled.predicate
+    bulk = compiled.bulk
+    return CompiledFilter(
+        lambda event: not predicate(event),
+        lambda columns: list(map(operator.not_, bulk(columns))),
+        cost=compiled.cost,
+    )
+
+
+def compile_any_of(data):
     """Matches if any nested matches succeed. Example config:
 
     filter:
@@ -40,17 +159,25 @@ def match_any_of(data, event):
             - summary: Your order from Amazon*
             - summary: Your Amazon order*
     """
-    assert type(data) is list
+    if type(data) is not list:
+        raise ValueError(f"any_of filter must hold a list of filters, not {data!r}")
+
+    children = [compile_tree(data_item) for data_item in data]
+    if any(c.is_constant() and c.constant for c in children):
+        return CompiledFilter(constant=True)
 
-    for data_item in data:
-        sub_match = match(data_item, event)
-        if sub_match:
-            return True
+    # constant False children can never make any_of match
+    children = [c for c in children if not c.is_constant()]
 
-    return False
+    # summary globs are checked together, in one pass of a combined regex
+    globs = [g for c in children if c.globs for g in c.globs]
+    if len(globs) > 1:
+        children = [c for c in children if not c.globs] + [compile_summaries(globs)]
 
+    return __combine(children, any, default=False)
 
-def match_all_of(data, event):
+
+def compile_all_of(data):
     """Matches if all nested matches succeed. Example config:
 
     filter:
@@ -58,30 +185,130 @@ def match_all_of(data, event):
             - summary: Your order from Amazon*
             - all_day_event: false
     """
-    assert type(data) is list
+    if type(data) is not list:
+        raise ValueError(f"all_of filter must hold a list of filters, not {data!r}")
+
+    children = [compile_tree(data_item) for data_item in data]
+    if any(c.is_constant() and not c.constant for c in children):
+        return CompiledFilter(constant=False)
+
+    # constant True children can never stop all_of matching
+    children = [c for c in children if not c.is_constant()]
+
+    return __combine(children, all, default=True)
+
+
+def __combine(children, combinator, default):
+    """Combines children's predicates with combinator (any or all), checking
+    the cheapest first, so it can short-circuit the rest."""
+    if not children:
+        return CompiledFilter(constant=default)
+
+    if len(children) == 1:
+        return children[0]
+
+    children = sorted(children, key=lambda c: c.cost)
+    predicates = [c.predicate for c in children]
+    bulks = [c.bulk for c in children]
+    cost = sum(c.cost for c in children)
 
-    for data_item in data:
-        sub_match = match(data_item, event)
-        if not sub_match:
+    if combinator is any:
+
+        def any_of(event):
+            for predicate in predicates:
+                if predicate(event):
+                    return True
             return False
 
-    return True
+        def bulk_any_of(columns):
+            mask = bulks[0](columns)
+            for bulk in bulks[1:]:
+                if all(mask):
+                    break
+                mask = list(map(operator.or_, mask, bulk(columns)))
+            return mask
 
+        return CompiledFilter(any_of, bulk_any_of, cost=cost)
 
-def match(data, event):
-    """Matches a nested match. Called by other modules to start matching."""
-    assert type(data) is dict
-    assert len(data) == 1
+    def all_of(event):
+        for predicate in predicates:
+            if not predicate(event):
+                return False
+        return True
+
+    def bulk_all_of(columns):
+        mask = bulks[0](columns)
+        for bulk in bulks[1:]:
+            if not any(mask):
+                break
+            mask = list(map(operator.and_, mask, bulk(columns)))
+        return mask
+
+    return CompiledFilter(all_of, bulk_all_of, cost=cost)
+
+
+def compile_tree(data):
+    """Compiles a nested match into a CompiledFilter, checking that it is
+    valid."""
+    if type(data) is not dict or len(data) != 1:
+        raise ValueError(f"filter must have exactly one key, not {data!r}")
 
     for k, v in data.items():
+        if k not in FILTERS:
+            raise ValueError(f'unknown filter "{k}"')
+
         # return straight away since there should just be one item
-        return FILTERS[k](v, event)
+        return FILTERS[k](v)
+
+
+def compile_filter(data):
+    """Compiles a filter from the config into a predicate, which takes an event
+    and returns True if it matches. The filter is validated and compiled once,
+    so the predicate is cheap to call for every event. Raises ValueError if the
+    filter is invalid."""
+    compiled = compile_tree(data)
+
+    if compiled.is_constant():
+        constant = compiled.constant
+        return lambda event: constant
+
+    return compiled.predicate
+
+
+def compile_bulk_filter(data):
+    """Like compile_filter(), but returns a function that matches a whole batch
+    of events at once: given an EventColumns, it returns a list of bools saying
+    whether each event matches. Each filter in the tree is evaluated over a
+    whole column in one go, and any_of/all_of combine the results, so there is
+    far less work per event than calling a predicate on each."""
+    compiled = compile_tree(data)
+
+    if compiled.is_constant():
+        constant = compiled.constant
+        return lambda columns: [constant] * columns.size
+
+    return compiled.bulk
+
+
+def match(data, event):
+    """Matches a nested match. Compiles the filter on every call, so when
+    matching many events, use compile_filter() once instead."""
+    return compile_filter(data)(event)
+
+
+def match_many(data, events):
+    """Matches a nested match against each of events (a list of Events or an
+    EventColumns) in bulk, returning a list of bools."""
+    if not isinstance(events, EventColumns):
+        events = EventColumns(events)
+
+    return compile_bulk_filter(data)(events)
 
 
 FILTERS = {
-    "all_day_event": match_all_day_event,
-    "summary": match_summary,
-    "all_of": match_all_of,
-    "any_of": match_any_of,
-    "not": match_not,
+    "all_day_event": compile_all_day_event,
+    "summary": compile_summary,
+    "all_of": compile_all_of,
+    "any_of": compile_any_of,
+    "not": compile_not,
 }
@@ -0,0 +1,137 @@
+import argparse
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os.path
+import sys
+
+from calsync.config import get_config
+from calsync.credentials import CREDENTIALS_FILE
+from calsync.credentials import CredentialManager
+from calsync.credentials import TOKEN_FILE
+from calsync.rules.rules import run_rules
+from calsync.state import STATE_FILE
+from calsync.state import StateStore
+from calsync.tenant import Tenant
+from calsync.tenant import use_tenant
+
+logger = logging.getLogger(__name__)
+
+TENANTS_FILE = "py-calsync-tenants.yaml"
+
+MULTITENANT_DEFAULTS = {
+    # worker threads shared by every tenant's rules; each tenant still runs no
+    # more than its own concurrency of them at once
+    "concurrency": 16,
+    # the most tenants whose rules are running at once
+    "max_tenants": 8,
+}
+
+
+def load_tenants(config):
+    """Returns a Tenant for each entry in config's tenants list, e.g.:
+
+        tenants:
+          - name: alice
+            config: alice/py-calsync.yaml
+
+    Each entry's config is a normal py-calsync.yaml. Its token_file and
+    state_file default to token.json and py-calsync.db in the same directory as
+    its config, and its credentials_file (the OAuth client) to the shared
+    credentials.json."""
+    tenants = []
+    names = set()
+
+    for entry in config["tenants"]:
+        name = entry["name"]
+        if name in names:
+            raise ValueError(f'tenant "{name}" is listed more than once')
+        names.add(name)
+
+        directory = os.path.dirname(entry["config"])
+        tenants.append(
+            Tenant(
+                name,
+                get_config(entry["config"]),
+                CredentialManager(
+                    token_file=entry.get(
+                        "token_file", os.path.join(directory, TOKEN_FILE)
+                    ),
+                    credentials_file=entry.get("credentials_file", CREDENTIALS_FILE),
+                ),
+                StateStore(
+                    entry.get("state_file", os.path.join(directory, STATE_FILE))
+                ),
+            )
+        )
+
+    return tenants
+
+
+def run_tenants(
+    tenants,
+    concurrency=MULTITENANT_DEFAULTS["concurrency"],
+    max_tenants=MULTITENANT_DEFAULTS["max_tenants"],
+):
+    """Runs every tenant's rules, up to max_tenants tenants at a time, with all
+    their work done on one pool of concurrency threads, so the process's
+    threads, API services and connections are shared between tenants rather
+    than each tenant needing a process of its own.
+
+    Tenants stay isolated: each one's rules run with its own credentials, state,
+    calendar list and API services, and are rate limited to its own
+    requests_per_second, so one tenant can't use up another's quota. A tenant's
+    failure doesn't stop the others.
+
+    Returns a dict mapping each tenant's name to its run's RunContext, or to
+    the exception its run raised."""
+    results = {}
+
+    with ThreadPoolExecutor(
+        max_workers=concurrency, thread_name_prefix="calsync-worker"
+    ) as workers, ThreadPoolExecutor(
+        max_workers=max_tenants, thread_name_prefix="calsync-tenant"
+    ) as runners:
+        futures = {
+            runners.submit(__run_tenant, tenant, workers): tenant for tenant in tenants
+        }
+
+        for future in as_completed(futures):
+            tenant = futures[future]
+            try:
+                results[tenant.name] = future.result()
+            except Exception as ex:
+                logger.exception(f"rules for tenant {tenant.name} failed")
+                results[tenant.name] = ex
+
+    return results
+
+
+def __run_tenant(tenant, workers):
+    with use_tenant(tenant):
+        logger.info(f"running rules for tenant {tenant.name}")
+        return run_rules(executor=workers)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog="py-calsync tenants",
+        description="Runs the rules of many accounts in one process.",
+    )
+    parser.add_argument("--tenants", default=TENANTS_FILE)
+    options = parser.parse_args(args)
+
+    config = {**MULTITENANT_DEFAULTS, **get_config(options.tenants)}
+    tenants = load_tenants(config)
+
+    try:
+        results = run_tenants(tenants, config["concurrency"], config["max_tenants"])
+    finally:
+        for tenant in tenants:
+            tenant.credential_manager.stop()
+            tenant.state_store.close()
+
+    failed = [name for name, result in results.items() if isinstance(result, Exception)]
+    if failed:
+        logger.error(f"rules failed for tenants: {', '.join(sorted(failed))}")
+        sys.exit(1)
@@ -0,0 +1,188 @@
+import asyncio
+import json
+import logging
+import random
+import threading
+import time
+
+from calsync.tenant import get_current_tenant
+
+logger = logging.getLogger(__name__)
+
+# The Calendar API's default per-user quota is 600 requests a minute
+DEFAULT_REQUESTS_PER_SECOND = 10
+
+# How many times to try a request before giving up on it
+MAX_ATTEMPTS = 5
+
+# Retry delays grow exponentially from BACKOFF_BASE, up to BACKOFF_MAX seconds
+BACKOFF_BASE = 1
+BACKOFF_MAX = 32
+
+# 403 reasons that mean "slow down" rather than "not allowed"
+RATE_LIMIT_REASONS = ["rateLimitExceeded", "userRateLimitExceeded"]
+
+
+class RateLimiter:
+    """Token bucket limiting requests to requests_per_second on average, with
+    bursts of up to burst requests. Safe to share between threads, and between
+    threads and an event loop.
+
+    A requests_per_second of None (or 0) disables limiting."""
+
+    def __init__(self, requests_per_second=DEFAULT_REQUESTS_PER_SECOND, burst=None):
+        self.rate = requests_per_second
+        self.burst = burst if burst is not None else requests_per_second
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __take(self, n):
+        """Takes n tokens, going into debt if there aren't enough, and returns how
+        long the caller must wait for the debt to be paid off."""
+        if not self.rate:
+            return 0
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+
+            self.tokens -= n
+            return max(0, -self.tokens / self.rate)
+
+    def acquire(self, n=1):
+        """Blocks until n requests may be made."""
+        wait = self.__take(n)
+        if wait:
+            time.sleep(wait)
+
+    async def acquire_async(self, n=1):
+        """Waits, without blocking the event loop, until n requests may be made."""
+        wait = self.__take(n)
+        if wait:
+            await asyncio.sleep(wait)
+
+
+def get_error_status(ex):
+    """Returns the HTTP status of an API error, from either googleapiclient's
+    HttpError or AsyncHttpError, or None if ex isn't an HTTP error."""
+    resp = getattr(ex, "resp", None)
+    if resp is not None:
+        return resp.status
+
+    return getattr(ex, "status", None)
+
+
+def __get_error_reasons(content):
+    try:
+        if isinstance(content, bytes):
+            content = content.decode("utf-8")
+        error = json.loads(content)["error"]
+        return [e.get("reason") for e in error.get("errors", [])]
+
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return []
+
+
+def is_retryable_error(ex):
+    """Returns True if ex is an API error worth retrying: 429s, 5xxs and 403s
+    caused by rate limiting."""
+    status = get_error_status(ex)
+    if status is None:
+        return False
+
+    if status == 429 or status >= 500:
+        return True
+
+    if status == 403:
+        reasons = __get_error_reasons(getattr(ex, "content", None))
+        return any(r in RATE_LIMIT_REASONS for r in reasons)
+
+    return False
+
+
+def backoff_delay(attempt):
+    """Returns how long to wait before retry number attempt (from 0), using
+    exponential backoff with full jitter so that retries spread out."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+
+def call_with_retries(f, rate_limiter=None, max_attempts=MAX_ATTEMPTS):
+    """Calls f(), waiting on rate_limiter first, and retries it with backoff
+    while it raises retryable errors, up to max_attempts times in all."""
+    for attempt in range(max_attempts):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+
+        try:
+            return f()
+
+        except Exception as ex:
+            if not is_retryable_error(ex) or attempt == max_attempts - 1:
+                raise
+
+            delay = backoff_delay(attempt)
+            logger.warning(f"request failed ({ex}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+async def call_with_retries_async(f, rate_limiter=None, max_attempts=MAX_ATTEMPTS):
+    """Async counterpart to call_with_retries; awaits f()."""
+    for attempt in range(max_attempts):
+        if rate_limiter is not None:
+            await rate_limiter.acquire_async()
+
+        try:
+            return await f()
+
+        except Exception as ex:
+            if not is_retryable_error(ex) or attempt == max_attempts - 1:
+                raise
+
+            delay = backoff_delay(attempt)
+            logger.warning(f"request failed ({ex}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+__cached_rate_limiter = None
+__rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Returns the RateLimiter shared by every service in the process, or by
+    every service of the current tenant, if there is one."""
+    global __cached_rate_limiter
+    tenant = get_current_tenant()
+
+    with __rate_limiter_lock:
+        if tenant is not None:
+            if tenant.rate_limiter is None:
+                tenant.rate_limiter = RateLimiter()
+            return tenant.rate_limiter
+
+        if __cached_rate_limiter is None:
+            __cached_rate_limiter = RateLimiter()
+
+    return __cached_rate_limiter
+
+
+def set_rate_limit(requests_per_second):
+    """Replaces the shared RateLimiter (the current tenant's, if there is one)
+    with one allowing requests_per_second. If it already allows that, it's
+    kept, so runs overlapping with others (as in the daemon) don't each start
+    a fresh, full bucket."""
+    global __cached_rate_limiter
+    tenant = get_current_tenant()
+
+    with __rate_limiter_lock:
+        current = tenant.rate_limiter if tenant is not None else __cached_rate_limiter
+        if current is not None and current.rate == requests_per_second:
+            return
+
+        if tenant is not None:
+            tenant.rate_limiter = RateLimiter(requests_per_second)
+        else:
+            __cached_rate_limiter = RateLimiter(requests_per_second)
@@ -0,0 +1,171 @@
+import asyncio
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from contextlib import ExitStack
+import logging
+
+from calsync.tenant import submit
+
+logger = logging.getLogger(__name__)
+
+
+def get_rule_calendars(rule, resolve_calendar):
+    """Returns (reads, writes), the sets of IDs of the calendars the rule reads
+    events from and writes events to."""
+    if type(rule["src"]) is list:
+        src = {resolve_calendar(x).id for x in rule["src"]}
+    else:
+        src = {resolve_calendar(rule["src"]).id}
+
+    dst = {resolve_calendar(rule["dst"]).id}
+
+    if rule["method"] == "remove_deleted":
+        # remove_deleted compares dst against src, so reads both
+        return src | dst, dst
+
+    return src, dst
+
+
+def rules_conflict(rule, calendars, other, other_calendars):
+    """Returns True if rule and other can't run at the same time, because one
+    writes a calendar the other reads, or both write the same calendar (unless
+    both are copy rules). calendars and other_calendars are their (reads,
+    writes) from get_rule_calendars."""
+    reads, writes = calendars
+    other_reads, other_writes = other_calendars
+    both_copies = rule["method"] == other["method"] == "copy"
+
+    return bool(
+        other_writes & reads
+        or other_reads & writes
+        or (other_writes & writes and not both_copies)
+    )
+
+
+def plan_rules(rules, resolve_calendar):
+    """Works out which rules must wait for which. A rule runs after every earlier
+    rule (in config order) that writes a calendar it reads, or reads or writes a
+    calendar it writes. The exception is copy rules writing the same dst, which
+    don't affect each other and so can run together.
+
+    Returns a list holding, for each rule, the set of indexes of the rules it
+    must run after."""
+    calendars = [get_rule_calendars(rule, resolve_calendar) for rule in rules]
+    dependencies = []
+
+    for i, rule in enumerate(rules):
+        depends_on = set()
+
+        for j in range(i):
+            if rules_conflict(rule, calendars[i], rules[j], calendars[j]):
+                depends_on.add(j)
+
+        dependencies.append(depends_on)
+
+    return dependencies
+
+
+def group_shared_sources(rules, dependencies, resolve_calendar, shareable):
+    """Groups rules reading the same src calendar, for which shareable(rule) is
+    True, so they can share a single scan of it. Each group runs where its first
+    rule would have, so a rule only joins a group if it doesn't depend on that
+    rule or any after it.
+
+    Takes the dependencies from plan_rules, and returns (groups, dependencies):
+    groups is a list of lists of rule indexes, and dependencies holds, for each
+    group, the set of indexes of the groups it must run after."""
+    groups = []
+    group_of = {}
+    open_groups = {}
+
+    for i, rule in enumerate(rules):
+        key = None
+        if shareable(rule) and type(rule["src"]) is not list:
+            key = resolve_calendar(rule["src"]).id
+
+        g = open_groups.get(key)
+        if g is None or not all(j < groups[g][0] for j in dependencies[i]):
+            groups.append([])
+            g = len(groups) - 1
+            if key is not None:
+                open_groups[key] = g
+
+        groups[g].append(i)
+        group_of[i] = g
+
+    group_dependencies = [
+        {group_of[j] for i in group for j in dependencies[i]} for group in groups
+    ]
+
+    return groups, group_dependencies
+
+
+def run_planned(rules, dependencies, run_rule, concurrency, executor=None):
+    """Runs each rule with run_rule(rule) on a pool of up to concurrency threads,
+    starting each as soon as the rules it depends on have finished. If executor
+    is given, rules run on its threads instead, still no more than concurrency
+    at once, so several callers can share one pool.
+
+    If a rule fails, no further rules are started; the ones already running are
+    allowed to finish, and then the error of the first rule (in config order) to
+    fail is raised."""
+    pending = dict(enumerate(dependencies))
+    running = {}
+    done = set()
+    errors = {}
+
+    with ExitStack() as stack:
+        if executor is None:
+            executor = stack.enter_context(ThreadPoolExecutor(max_workers=concurrency))
+
+        while pending or running:
+            if not errors:
+                ready = [i for i, deps in pending.items() if deps <= done]
+
+                for i in ready[: concurrency - len(running)]:
+                    del pending[i]
+                    running[submit(executor, run_rule, rules[i])] = i
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                i = running.pop(future)
+
+                if future.exception() is not None:
+                    logger.error(f"rule {i} failed: {future.exception()}")
+                    errors[i] = future.exception()
+                else:
+                    done.add(i)
+
+    if errors:
+        raise errors[min(errors)]
+
+
+async def run_planned_async(rules, dependencies, run_rule):
+    """Async counterpart to run_planned: runs each rule with await run_rule(rule)
+    on the current event loop, starting each as soon as the rules it depends on
+    have finished. A rule whose dependency fails fails with the same error.
+
+    Raises the error of the first rule (in config order) to fail, once every
+    rule has finished or failed."""
+    tasks = []
+
+    async def run(i):
+        await asyncio.gather(*(tasks[j] for j in dependencies[i]))
+        await run_rule(rules[i])
+
+    # dependencies are always on earlier rules, so their tasks already exist
+    for i in range(len(rules)):
+        tasks.append(asyncio.ensure_future(run(i)))
+
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    for i, result in enumerate(results):
+        if isinstance(result, Exception):
+            logger.error(f"rule {i} failed: {result}")
+
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
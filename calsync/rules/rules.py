@@ -1,16 +1,56 @@
+import asyncio
+from collections import Counter
 from datetime import datetime
+from functools import partial
+import hashlib
+import json
 import logging
 import sys
+import threading
+import time
 
+from calsync.async_calendar import get_async_calendar_resolver
+from calsync.async_service import AsyncCalendarService
+from calsync.async_service import MAX_CONNECTIONS
+from calsync.cache import AsyncEventCache
+from calsync.cache import event_in_window
+from calsync.cache import EventCache
 from calsync.config import get_config
+from calsync.calendar import new_batch
 from calsync.calendar import resolve_calendar
+from calsync.event import COPY_SKIP_FIELDS
+from calsync.event import Event
+from calsync.event import event_patch
 from calsync.event import event_short_repr
-from calsync.filters import match
+from calsync.event import FINGERPRINT_PROPERTY
+from calsync.filters import compile_tree
+from calsync.filters import EventColumns
+from calsync.ratelimit import BACKOFF_MAX
+from calsync.ratelimit import DEFAULT_REQUESTS_PER_SECOND
+from calsync.ratelimit import get_error_status
+from calsync.ratelimit import is_retryable_error
+from calsync.ratelimit import set_rate_limit
+from calsync.rules.planner import group_shared_sources
+from calsync.rules.planner import plan_rules
+from calsync.rules.planner import run_planned
+from calsync.rules.planner import run_planned_async
+from calsync.service import EVENTS_PAGE_SIZE
+from calsync.service import get_event_fields
+from calsync.service import get_credentials
+from calsync.state import get_state_store
+from calsync.stream import async_chunked
+from calsync.stream import chunked
+from calsync.tenant import get_current_tenant
+from calsync.timings import PhaseTimings
 
+from calsync.util import datetime_to_rfc3339
 from calsync.util import parse_timedelta_string
+from calsync.util import rfc3339_to_datetime
 
 logger = logging.getLogger(__name__)
 
+CONFIG_FILE = "py-calsync.yaml"
+
 COPY_DEFAULTS = {
     # the method to use
     "method": "copy",
@@ -19,24 +59,284 @@ COPY_DEFAULTS = {
     "look_forward": "12 weeks",
     # if True, mark copied events as private, which prevents event propagation
     "private_copy": True,
+    # if True, use sync tokens to only fetch events changed since the last run
+    # (the first run, or a run after the token expires, does a full sync)
+    "incremental": False,
+    # if True, only list events changed since the last run (by their updated
+    # time), plus any that have come into the window since, and delete the
+    # copies of events cancelled since; the first run lists the whole window
+    "delta": False,
+    # split the window into this many sub-windows, listed concurrently, which
+    # speeds up listing busy calendars
+    "shards": 1,
+}
+
+
+RUN_DEFAULTS = {
+    # "sync" runs rules on a thread pool through googleapiclient; "async" runs
+    # them on an event loop through AsyncCalendarService (needs aiohttp)
+    "backend": "sync",
+    # the most rules to run at once (sync backend)
+    "concurrency": 4,
+    # the most connections to the API to have open at once (async backend)
+    "max_connections": MAX_CONNECTIONS,
+    # the most API requests to make per second, shared by every rule
+    "requests_per_second": DEFAULT_REQUESTS_PER_SECOND,
+    # if True, copy rules reading the same src share a single scan of it
+    "shared_scan": True,
 }
 
+# rules match filters against at least this many events at once in bulk, rather
+# than one at a time
+BULK_FILTER_THRESHOLD = 1000
+
+# the most imports the async backend starts before waiting for some to finish,
+# which bounds the copies held in memory however fast events are listed
+MAX_PENDING_IMPORTS = 1000
+
+# the event fields rules need to match events up, filter them and tell whether
+# they were cancelled; rules only list the fields they need (copy rules also
+# list every field they copy), which keeps list responses small
+MATCH_FIELDS = frozenset(
+    ["id", "iCalUID", "status", "summary", "start", "end", "recurrence"]
+)
+
+# the fields listed from a dst to find its copies' fingerprints (see
+# __list_dst_copies)
+COPY_FINGERPRINT_FIELDS = frozenset(["id", "iCalUID", "extendedProperties"])
+
+# patching a copy fails with these statuses if it has been deleted from dst
+# since it was made, in which case it's imported afresh
+MISSING_COPY_STATUSES = (404, 410)
+
+# how long to wait before retrying writes deferred until the end of a run
+DEFERRED_RETRY_DELAY = BACKOFF_MAX
+
+
+class RunContext:
+    """State shared between the rules in a single run."""
 
-def run_rules():
-    config = get_config("py-calsync.yaml")
+    def __init__(self, event_cache=None, filters=None):
+        # every rule's window is relative to the same instant, so rules with the
+        # same look_back/look_forward ask for identical windows and can share
+        # fetches through the cache
+        self.now = datetime.utcnow()
+        self.event_cache = event_cache if event_cache is not None else EventCache()
 
-    # process rules sequentially
-    for rule in config["rules"]:
+        # each rule's compiled filter (see __compile_filters), keyed by id(rule),
+        # so rules compile them once per run rather than for every chunk
+        self.filters = filters if filters is not None else {}
+
+        # time spent listing, filtering, transforming and writing, across rules
+        self.timings = PhaseTimings()
+
+        # writes that still failed with retryable errors after every attempt;
+        # they're retried once more at the end of the run rather than failing
+        # their rule
+        self.deferred = []
+        self.lock = threading.Lock()
+
+    def defer(self, error):
+        """Defers a { item, error, retry } dict from __error_collector."""
+        with self.lock:
+            self.deferred.append(error)
+
+
+def run_rules(config=None, executor=None):
+    """Runs the rules in config, which defaults to the current tenant's config
+    (see calsync.tenant), or else the contents of CONFIG_FILE. With the sync
+    backend, rules run on executor's threads if it's given, rather than on a
+    pool of the run's own. Returns the run's RunContext."""
+    if config is None:
+        tenant = get_current_tenant()
+        config = tenant.config if tenant is not None else get_config(CONFIG_FILE)
+
+    rules = config["rules"]
+    filters = {}
+    for rule in rules:
         method = rule["method"]
+        if method not in RULE_METHODS:
+            raise ValueError(f'unknown method "${method}"')
+
+        # compiling filters checks they're valid before any rule makes changes
+        filters[id(rule)] = __compile_filters(rule)
+        __get_shards(rule)
+
+    set_rate_limit(
+        config.get("requests_per_second", RUN_DEFAULTS["requests_per_second"])
+    )
 
-        if method == "copy":
-            __run_copy_rule(rule)
+    if config.get("backend", RUN_DEFAULTS["backend"]) == "async":
+        return asyncio.run(__run_rules_async(config, filters))
 
-        elif method == "remove_deleted":
-            __run_remove_deleted_rule(rule)
+    context = RunContext(filters=filters)
 
+    # rules that don't touch each other's calendars run concurrently
+    groups, dependencies = __plan_groups(config, resolve_calendar)
+    context.event_cache.shared_calendars.update(
+        __get_shared_sources(groups, resolve_calendar)
+    )
+    run_planned(
+        groups,
+        dependencies,
+        lambda group: __run_group(group, context),
+        concurrency=config.get("concurrency", RUN_DEFAULTS["concurrency"]),
+        executor=executor,
+    )
+
+    if context.deferred:
+        logger.warning(f"retrying {len(context.deferred)} deferred writes")
+        time.sleep(DEFERRED_RETRY_DELAY)
+
+        for deferred in context.deferred:
+            try:
+                deferred["retry"]()
+            except Exception as ex:
+                __report_deferred_failure(deferred, ex)
+
+    return context
+
+
+async def __run_rules_async(config, filters):
+    context = RunContext(event_cache=AsyncEventCache(), filters=filters)
+
+    async with AsyncCalendarService(
+        get_credentials(),
+        max_connections=config.get("max_connections", RUN_DEFAULTS["max_connections"]),
+    ) as service:
+        resolve = await get_async_calendar_resolver(service)
+
+        groups, dependencies = __plan_groups(config, resolve)
+        context.event_cache.shared_calendars.update(
+            __get_shared_sources(groups, resolve)
+        )
+        await run_planned_async(
+            groups,
+            dependencies,
+            lambda group: __run_group_async(group, context, resolve),
+        )
+
+        if context.deferred:
+            logger.warning(f"retrying {len(context.deferred)} deferred writes")
+            await asyncio.sleep(DEFERRED_RETRY_DELAY)
+
+            results = await asyncio.gather(
+                *(deferred["retry"]() for deferred in context.deferred),
+                return_exceptions=True,
+            )
+            for deferred, result in zip(context.deferred, results):
+                if isinstance(result, Exception):
+                    __report_deferred_failure(deferred, result)
+
+    return context
+
+
+def __plan_groups(config, resolve):
+    """Plans the run of config's rules. Returns (groups, dependencies), where
+    groups is a list of lists of rules to run together, and dependencies holds
+    the indexes of the groups each group must run after.
+
+    With shared_scan, copy rules that read the same src are grouped, so it is
+    scanned once for all of them; otherwise every rule runs on its own."""
+    rules = config["rules"]
+    dependencies = plan_rules(rules, resolve)
+
+    if config.get("shared_scan", RUN_DEFAULTS["shared_scan"]):
+        groups, dependencies = group_shared_sources(
+            rules, dependencies, resolve, shareable=__can_share_scan
+        )
+    else:
+        groups = [[i] for i in range(len(rules))]
+
+    return [[rules[i] for i in group] for group in groups], dependencies
+
+
+def __get_shared_sources(groups, resolve):
+    """Returns a dict mapping the ids of the calendars more than one of groups
+    lists through the event cache to the fields those groups need from them
+    (None for all fields). They're listed in full and cached, so the groups
+    share a single fetch; every other src is streamed."""
+    counts = Counter()
+    fields = {}
+    for group in groups:
+        sources = set()
+        for rule in group:
+            for src in __get_sources(rule, resolve):
+                sources.add(src.id)
+                fields[src.id] = fields.get(src.id, frozenset()) | __get_fields(rule)
+        counts.update(sources)
+
+    return {
+        calendar_id: fields[calendar_id]
+        for calendar_id, count in counts.items()
+        if count > 1
+    }
+
+
+def __get_sources(rule, resolve):
+    """Returns the calendars the rule lists through the event cache."""
+    if rule["method"] == "copy" and __reads_changes(rule):
+        return []
+
+    if type(rule["src"]) is list:
+        return [resolve(x) for x in rule["src"]]
+
+    return [resolve(rule["src"])]
+
+
+def __get_fields(rule):
+    """Returns the event fields the rule lists from its calendars."""
+    if rule["method"] != "copy":
+        return MATCH_FIELDS
+
+    fields = (get_event_fields() - COPY_SKIP_FIELDS) | MATCH_FIELDS
+    if rule.get("delta", COPY_DEFAULTS["delta"]):
+        # delta rules pick up from the last updated time they saw
+        fields |= {"updated"}
+
+    return fields
+
+
+def __reads_changes(rule):
+    """Returns True if the copy rule reads the changes to its src since its last
+    run (with sync tokens or updatedMin), rather than listing its window."""
+    return rule.get("incremental", COPY_DEFAULTS["incremental"]) or rule.get(
+        "delta", COPY_DEFAULTS["delta"]
+    )
+
+
+def __can_share_scan(rule):
+    """Returns True if the rule can share a scan of its src with others: only
+    copy rules that list their src (rather than reading changes) can."""
+    return rule["method"] == "copy" and not __reads_changes(rule)
+
+
+def __run_group(rules, context):
+    try:
+        if len(rules) > 1:
+            __run_shared_copy_rules(rules, context)
         else:
-            raise ValueError(f'unknown method "${method}"')
+            RULE_METHODS[rules[0]["method"]](rules[0], context)
+    finally:
+        __invalidate_dsts(rules, context, resolve_calendar)
+
+
+async def __run_group_async(rules, context, resolve):
+    try:
+        if len(rules) > 1:
+            await __run_shared_copy_rules_async(rules, context, resolve)
+        else:
+            await ASYNC_RULE_METHODS[rules[0]["method"]](rules[0], context, resolve)
+    finally:
+        __invalidate_dsts(rules, context, resolve)
+
+
+def __invalidate_dsts(rules, context, resolve):
+    """Drops any events of the rules' dst calendars cached before the rules
+    wrote to them, so later rules reading those calendars (which the plan runs
+    only once these rules have finished) see what was written."""
+    for rule in rules:
+        context.event_cache.invalidate(resolve(rule["dst"]).id)
 
 
 def gather_errors(f, items):
@@ -68,54 +368,482 @@ def gather_errors(f, items):
     return errors
 
 
-def __run_copy_rule(rule):
+def __run_copy_rule(rule, context):
     src = resolve_calendar(rule["src"])
     dst = resolve_calendar(rule["dst"])
 
-    look_back = parse_timedelta_string(
-        rule.get("look_back", COPY_DEFAULTS["look_back"])
-    )
-    look_forward = parse_timedelta_string(
-        rule.get("look_forward", COPY_DEFAULTS["look_forward"])
-    )
+    time_min, time_max = __get_window(rule, context)
+
+    incremental = rule.get("incremental", COPY_DEFAULTS["incremental"])
+    delta = rule.get("delta", COPY_DEFAULTS["delta"])
 
     # copy events from src to dst
-    src_events = src.list_events(
-        timeMin=(datetime.utcnow() - look_back).isoformat() + "Z",
-        timeMax=(datetime.utcnow() + look_forward).isoformat() + "Z",
+    if incremental:
+        # sync tokens are per rule, since each rule consumes its own changes
+        sync_key = __get_state_key("copy", rule, src, dst)
+        window_key = __get_state_key("copy-window", rule, src, dst)
+        state = get_state_store()
+        sync_token = state.get_sync_token(sync_key)
+
+        with context.timings.phase("list"):
+            src_events, next_sync_token = src.sync_events(
+                syncToken=sync_token,
+                timeMin=time_min,
+                timeMax=time_max,
+                singleEvents=False,
+                fields=__get_fields(rule),
+            )
+
+            new_min = __get_incremental_new_min(
+                state, sync_token, window_key, time_min, time_max
+            )
+            if new_min is not None:
+                src_events = __merge_events(
+                    src_events,
+                    src.list_events(
+                        timeMin=new_min,
+                        timeMax=time_max,
+                        singleEvents=False,
+                        orderBy="updated",
+                        shards=__get_shards(rule),
+                        fields=__get_fields(rule),
+                    ),
+                )
+        chunks = chunked(src_events, EVENTS_PAGE_SIZE)
+    elif delta:
+        # like sync tokens, what a rule has seen is kept per rule
+        delta_key = __get_state_key("delta", rule, src, dst)
+        state = get_state_store()
+
+        last_run = __get_delta_state(state, delta_key)
+        next_run = {"updated": None, "timeMax": time_max}
+        chunks = __list_delta(
+            src,
+            __get_delta_queries(rule, last_run, time_min, time_max),
+            next_run,
+            lambda: state.clear_sync_token(delta_key),
+        )
+    else:
+        chunks = context.event_cache.iter_events(
+            src,
+            timeMin=time_min,
+            timeMax=time_max,
+            singleEvents=False,
+            orderBy="updated",
+            shards=__get_shards(rule),
+            fields=__get_fields(rule),
+        )
+
+    # a sync token's changes cover the whole calendar, so are cut back to the
+    # rule's window like any other listing
+    window = (time_min, time_max) if incremental else None
+    deferred = __copy_events(
+        src, chunks, [(rule, dst, window, context.filters[id(rule)])], context
+    )
+
+    # only store the token once every change has been processed, so a failed
+    # run picks the same changes up again next time
+    if incremental and not deferred:
+        state.set_sync_token(sync_key, next_sync_token)
+        state.set_sync_token(window_key, time_max)
+    elif delta and not deferred:
+        __set_delta_state(state, delta_key, last_run, next_run)
+
+
+def __get_state_key(kind, rule, src, dst):
+    """Returns the key a copy rule's kind of state (e.g. "copy", its sync token)
+    is stored under. Rules copying between the same calendars with different
+    options (filters, say) each consume their own changes, so the key includes
+    a hash of the rule's options. Its window and shards are left out, as
+    changing those doesn't change which changes the rule has seen."""
+    options = {
+        k: v
+        for k, v in rule.items()
+        if k not in ("look_back", "look_forward", "shards")
+    }
+    digest = hashlib.sha1(
+        json.dumps(options, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+    return f"{kind}:{src.id}:{dst.id}:{digest[:12]}"
+
+
+def __get_delta_state(state, key):
+    """Returns what the last run of a delta copy rule recorded under key: a dict
+    of the latest updated time of the events it saw, and the end of its window.
+    Returns None if it hasn't run, or saw no events."""
+    value = state.get_sync_token(key)
+    return json.loads(value) if value is not None else None
+
+
+def __set_delta_state(state, key, last_run, next_run):
+    """Records next_run, the state of a delta copy rule's run, under key. If the
+    run saw no events, the last run's updated time still stands."""
+    if next_run["updated"] is None and last_run is not None:
+        next_run["updated"] = last_run["updated"]
+
+    if next_run["updated"] is not None:
+        state.set_sync_token(key, json.dumps(next_run))
+
+
+def __get_delta_queries(rule, last_run, time_min, time_max):
+    """Returns the listings a delta copy rule makes of its src, as iter_events()
+    keyword arguments: every event in the window changed since the last run
+    (including cancelled ones), and every event in any part of the window the
+    last run's window didn't reach, as those may not have changed. Without a
+    last run, the whole window is listed."""
+    query = dict(
+        timeMin=time_min,
+        timeMax=time_max,
         singleEvents=False,
         orderBy="updated",
+        shards=__get_shards(rule),
+        fields=__get_fields(rule),
     )
-    logger.info(f"found {len(src_events)} events")
+    if last_run is None:
+        return [query]
+
+    queries = [dict(query, updatedMin=last_run["updated"])]
+    new_min = __get_new_min(last_run["timeMax"], time_min, time_max)
+    if new_min is not None:
+        queries.append(dict(query, timeMin=new_min))
+
+    return queries
+
+
+def __get_new_min(last_max, time_min, time_max):
+    """Returns the start of the part of a rule's window (time_min to time_max)
+    that a last run whose window ended at last_max didn't reach, or None if it
+    reached all of it."""
+    if rfc3339_to_datetime(last_max) >= rfc3339_to_datetime(time_max):
+        return None
+
+    return max(time_min, last_max, key=rfc3339_to_datetime)
 
-    for event in src_events:
-        logger.info(f"processing event {event_short_repr(event)}")
+
+def __get_incremental_new_min(state, sync_token, window_key, time_min, time_max):
+    """Returns where an incremental copy rule must list its src from, besides
+    syncing it with sync_token, or None if syncing is enough. A sync only
+    returns changed events, so events that have moved into the window without
+    changing (as the window moves on) have to be listed. If the end of the last
+    run's window wasn't recorded under window_key, the whole window is."""
+    if sync_token is None:
+        # a full sync lists the whole window anyway
+        return None
+
+    last_max = state.get_sync_token(window_key)
+    if last_max is None:
+        return time_min
+
+    return __get_new_min(last_max, time_min, time_max)
+
+
+def __merge_events(events, more):
+    """Returns events, followed by those of more that aren't among them."""
+    ids = {e.id for e in events}
+    return list(events) + [e for e in more if e.id not in ids]
+
+
+def __list_delta(src, queries, next_run, expired):
+    """Yields chunks of the events src lists for each of queries, each event
+    once, recording the latest updated time among them in next_run.
+
+    If the API won't list changes since the last run, as it was too long ago
+    (410 Gone), expired() is called to drop the rule's delta state, and the
+    whole window is listed instead, as for an expired sync token."""
+    seen = set()
+    for query in queries:
         try:
-            if not __matches_filters(rule, event):
-                logger.info("event did not match filters, skipping")
-                continue
+            yield from __iter_delta(src, query, seen, next_run)
 
-            new_event = event.copy()
+        except Exception as ex:
+            if not __is_delta_expired(src, query, ex):
+                raise
 
-            private_copy = rule.get("private_copy", COPY_DEFAULTS["private_copy"])
-            if private_copy:
-                new_event.attributes["privateCopy"] = True
+            expired()
+            # the whole window covers every other query's
+            yield from __iter_delta(src, __get_full_query(query), seen, next_run)
+            return
 
-            logger.info("running transforms")
-            __transform(rule, new_event, src=src)
 
-            logger.info(f"creating event in dst: {new_event}")
-            dst.import_event(new_event)
+async def __list_delta_async(src, queries, next_run, expired):
+    """Async counterpart to __list_delta."""
+    seen = set()
+    for query in queries:
+        try:
+            async for events in __iter_delta_async(src, query, seen, next_run):
+                yield events
 
         except Exception as ex:
-            print("error occurred while processing event:", file=sys.stderr)
-            print(event, file=sys.stderr)
+            if not __is_delta_expired(src, query, ex):
+                raise
+
+            expired()
+            full_query = __get_full_query(query)
+            async for events in __iter_delta_async(src, full_query, seen, next_run):
+                yield events
+            return
+
+
+def __iter_delta(src, query, seen, next_run):
+    """Yields chunks of the events src lists for query, skipping those in seen
+    (see __track_delta)."""
+    for events in chunked(src.iter_events(**query), EVENTS_PAGE_SIZE):
+        events = __track_delta(events, seen, next_run)
+        if events:
+            yield events
+
+
+async def __iter_delta_async(src, query, seen, next_run):
+    """Async counterpart to __iter_delta."""
+    async for events in async_chunked(src.iter_events(**query), EVENTS_PAGE_SIZE):
+        events = __track_delta(events, seen, next_run)
+        if events:
+            yield events
+
+
+def __is_delta_expired(src, query, ex):
+    """Returns whether ex is the API refusing query's listing of changes since
+    updatedMin, as too long ago (with a 410, e.g. updatedMinTooLongAgo)."""
+    if query.get("updatedMin") is None or get_error_status(ex) != 410:
+        return False
+
+    logger.warning(
+        f"changes to {src.get_name()} since the last run can't be listed, "
+        "listing every event in the window"
+    )
+    return True
+
+
+def __get_full_query(query):
+    """Returns query, a listing of changes since updatedMin, as a listing of
+    every event in its window."""
+    query = dict(query)
+    del query["updatedMin"]
+    return query
+
+
+def __track_delta(events, seen, next_run):
+    """Returns the events not in seen, adding them to it, and moves next_run's
+    updated time on to the latest of theirs."""
+    events = [e for e in events if e.id not in seen]
+    seen.update(e.id for e in events)
+
+    updated = [e.updated for e in events if e.updated is not None]
+    if next_run["updated"] is not None:
+        updated.append(next_run["updated"])
+    if updated:
+        next_run["updated"] = max(updated, key=rfc3339_to_datetime)
+
+    return events
+
+
+def __run_shared_copy_rules(rules, context):
+    """Runs copy rules that read the same src calendar together. The src is
+    listed once, over the union of the rules' windows, and each event is passed
+    through every rule's filter in a single pass, with matches copied to that
+    rule's dst."""
+    src = resolve_calendar(rules[0]["src"])
+
+    time_min, time_max, windows = __get_shared_window(rules, context)
+
+    chunks = context.event_cache.iter_events(
+        src,
+        timeMin=time_min,
+        timeMax=time_max,
+        singleEvents=False,
+        orderBy="updated",
+        shards=max(__get_shards(rule) for rule in rules),
+        fields=__get_fields(rules[0]),
+    )
+    targets = [
+        (rule, resolve_calendar(rule["dst"]), window, context.filters[id(rule)])
+        for rule, window in zip(rules, windows)
+    ]
+
+    __copy_events(src, chunks, targets, context)
+
+
+def __copy_events(src, chunks, targets, context):
+    """Copies events from chunks, an iterable of lists of src's events, into
+    the dst of each of targets whose filter they match. targets is a list of
+    (rule, dst, window, compiled) tuples, where window and compiled are as for
+    __match_chunk.
+
+    Each chunk is filtered, transformed and queued for import before the next
+    is read, so imports start while later chunks are still being listed, and
+    only a chunk's worth of events is held at a time. Imports are sent in
+    batches, so failures are reported after the fact.
+
+    Copies made before are patched with just the fields that changed, rather
+    than imported again; any since deleted from dst are imported once the
+    patches have been sent.
+
+    Returns True if any imports were deferred."""
+    errors = []
+    missing = []
+
+    copies = {
+        id(rule): __list_dst_copies(rule, dst, context) for rule, dst, _, _ in targets
+    }
+
+    with new_batch() as batch:
+        for events in context.timings.timed("list", chunks):
+            logger.info(f"found {len(events)} events")
+            chunk_targets = __compile_targets(targets, events, context)
+
+            for event in events:
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info(f"processing event {event_short_repr(event)}")
+                for rule, dst, matches_filters in chunk_targets:
+                    try:
+                        if event.is_cancelled() and rule.get(
+                            "delta", COPY_DEFAULTS["delta"]
+                        ):
+                            with context.timings.phase("write"):
+                                __delete_copy(dst, event, batch, errors)
+                            continue
+
+                        copy = __prepare_copy(
+                            rule,
+                            event,
+                            src,
+                            dst,
+                            matches_filters,
+                            context.timings,
+                            copies[id(rule)],
+                        )
+                        if copy is None:
+                            continue
+
+                        new_event, patch = copy
+                        with context.timings.phase("write"):
+                            if patch is None:
+                                __import_copy(dst, event, new_event, batch, errors)
+                            else:
+                                if logger.isEnabledFor(logging.INFO):
+                                    logger.info(f"patching event in dst: {patch}")
+                                event_id, changes = patch
+                                dst.patch_event(
+                                    event_id,
+                                    new_event,
+                                    changes,
+                                    source=event,
+                                    batch=batch,
+                                    callback=__patch_error_collector(
+                                        errors, missing, event, new_event, dst
+                                    ),
+                                )
+
+                    except Exception as ex:
+                        print("error occurred while processing event:", file=sys.stderr)
+                        print(event, file=sys.stderr)
+
+                        raise ex
+
+        with context.timings.phase("write"):
+            batch.flush()
+
+            for event, new_event, dst in missing:
+                logger.info("copy has been deleted from dst, importing it again")
+                __import_copy(dst, event, new_event, batch, errors)
+            batch.flush()
+
+    return __handle_errors(errors, context)
+
+
+def __import_copy(dst, event, new_event, batch, errors):
+    """Queues the import of new_event into dst, as the copy of event, on batch,
+    recording any failure in errors."""
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(f"creating event in dst: {new_event}")
+
+    dst.import_event(
+        new_event,
+        source=event,
+        batch=batch,
+        callback=__error_collector(
+            errors, event, retry=partial(dst.import_event, new_event, source=event)
+        ),
+    )
+
+
+def __get_copy(dst, event):
+    """Returns the copy of event last made in dst (as an Event with just its
+    id), or None if there isn't one."""
+    mapping = get_state_store().get_event_mapping(event.calendarId, event.id, dst.id)
+    if mapping is None:
+        return None
+
+    return Event(id=mapping[0], calendarId=dst.id)
+
+
+def __delete_copy(dst, event, batch, errors):
+    """Queues the delete of the copy of event, which has been cancelled, from
+    dst on batch, recording any failure in errors. Copies already gone from dst
+    are just forgotten."""
+    copy = __get_copy(dst, event)
+    if copy is None:
+        return
+
+    logger.info("event was cancelled, deleting its copy")
+
+    def callback(result, exception):
+        if exception is None:
+            return
+
+        if get_error_status(exception) in MISSING_COPY_STATUSES:
+            get_state_store().delete_event_mapping(dst.id, copy.id)
+        else:
+            errors.append(
+                {
+                    "item": event,
+                    "error": exception,
+                    "retry": partial(dst.delete_event, copy),
+                }
+            )
+
+    dst.delete_event(copy, batch=batch, callback=callback)
 
-            raise ex
 
+def __patch_error_collector(errors, missing, event, new_event, dst):
+    """Returns a batch callback for a patch of the copy of event, which records
+    the copy in missing if it was deleted from dst, or any other failure in
+    errors (as __error_collector does). Either way, new_event is to be imported
+    instead."""
 
-def __run_remove_deleted_rule(rule):
-    # check all events in dst have a matching src event
+    def callback(result, exception):
+        if exception is None:
+            return
+
+        if get_error_status(exception) in MISSING_COPY_STATUSES:
+            missing.append((event, new_event, dst))
+        else:
+            errors.append(
+                {
+                    "item": event,
+                    "error": exception,
+                    "retry": partial(dst.import_event, new_event, source=event),
+                }
+            )
+
+    return callback
+
+
+def __compile_targets(targets, events, context):
+    """Returns a (rule, dst, predicate) tuple for each of targets' (rule, dst,
+    window, compiled) tuples, where predicate says whether an event of a chunk
+    of events matches the rule's filter."""
+    with context.timings.phase("filter"):
+        return [
+            (rule, dst, __match_chunk(compiled, events, window=window))
+            for rule, dst, window, compiled in targets
+        ]
+
+
+def __run_remove_deleted_rule(rule, context):
+    # check all events in dst have a matching src event; this always lists the
+    # full window, since spotting a missing src event needs a complete view
     if type(rule["src"]) is list:
         src = [resolve_calendar(x) for x in rule["src"]]
     else:
@@ -123,74 +851,622 @@ def __run_remove_deleted_rule(rule):
 
     dst = resolve_calendar(rule["dst"])
 
-    look_back = parse_timedelta_string(
-        rule.get("look_back", COPY_DEFAULTS["look_back"])
-    )
-    look_forward = parse_timedelta_string(
-        rule.get("look_forward", COPY_DEFAULTS["look_forward"])
-    )
+    time_min, time_max = __get_window(rule, context)
+
+    with context.timings.phase("list"):
+        src_events = []
+        for src_ in src:
+            src_events.extend(
+                context.event_cache.list_events(
+                    src_,
+                    timeMin=time_min,
+                    timeMax=time_max,
+                    singleEvents=False,
+                    orderBy="updated",
+                    shards=__get_shards(rule),
+                    fields=__get_fields(rule),
+                )
+            )
+        logger.info(f"found {len(src_events)} events")
+
+        # dst is listed directly, as earlier rules in this run may have written
+        # to it
+        dst_events = dst.list_events(
+            timeMin=time_min,
+            timeMax=time_max,
+            singleEvents=False,
+            orderBy="updated",
+            shards=__get_shards(rule),
+            fields=__get_fields(rule),
+        )
+        logger.debug(f"found {len(dst_events)} events")
+
+    # copies made by a copy rule are found through the state store; anything
+    # else is matched on iCalUID, which imports preserve
+    dst_sources = get_state_store().get_event_sources(dst.id)
+    src_keys = {(e.calendarId, e.id) for e in src_events}
+    src_ical_uids = {e.iCalUID for e in src_events}
+    src_ical_uids.discard(None)
+
+    errors = []
+
+    with new_batch() as batch:
+        for event in dst_events:
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(f"processing event {event_short_repr(event)}")
+
+            try:
+                with context.timings.phase("filter"):
+                    delete = __should_delete(
+                        event, dst_sources, src_keys, src_ical_uids
+                    )
+
+                if delete:
+                    with context.timings.phase("write"):
+                        dst.delete_event(
+                            event,
+                            batch=batch,
+                            callback=__error_collector(
+                                errors, event, retry=partial(dst.delete_event, event)
+                            ),
+                        )
+
+            except Exception as ex:
+                print("error occurred while processing event:", file=sys.stderr)
+                print(event, file=sys.stderr)
+
+                raise ex
+
+        with context.timings.phase("write"):
+            batch.flush()
+
+    __handle_errors(errors, context)
+
+
+async def __run_copy_rule_async(rule, context, resolve):
+    src = resolve(rule["src"])
+    dst = resolve(rule["dst"])
+
+    time_min, time_max = __get_window(rule, context)
 
-    src_events = []
-    for src_ in src:
-        src_events.extend(
-            src_.list_events(
-                timeMin=(datetime.utcnow() - look_back).isoformat() + "Z",
-                timeMax=(datetime.utcnow() + look_forward).isoformat() + "Z",
+    incremental = rule.get("incremental", COPY_DEFAULTS["incremental"])
+    delta = rule.get("delta", COPY_DEFAULTS["delta"])
+
+    if incremental:
+        sync_key = __get_state_key("copy", rule, src, dst)
+        window_key = __get_state_key("copy-window", rule, src, dst)
+        state = get_state_store()
+        sync_token = state.get_sync_token(sync_key)
+
+        with context.timings.phase("list"):
+            src_events, next_sync_token = await src.sync_events(
+                syncToken=sync_token,
+                timeMin=time_min,
+                timeMax=time_max,
                 singleEvents=False,
-                orderBy="updated",
+                fields=__get_fields(rule),
+            )
+
+            new_min = __get_incremental_new_min(
+                state, sync_token, window_key, time_min, time_max
             )
+            if new_min is not None:
+                src_events = __merge_events(
+                    src_events,
+                    await src.list_events(
+                        timeMin=new_min,
+                        timeMax=time_max,
+                        singleEvents=False,
+                        orderBy="updated",
+                        shards=__get_shards(rule),
+                        fields=__get_fields(rule),
+                    ),
+                )
+        chunks = __iter_async(chunked(src_events, EVENTS_PAGE_SIZE))
+    elif delta:
+        delta_key = __get_state_key("delta", rule, src, dst)
+        state = get_state_store()
+
+        last_run = __get_delta_state(state, delta_key)
+        next_run = {"updated": None, "timeMax": time_max}
+        chunks = __list_delta_async(
+            src,
+            __get_delta_queries(rule, last_run, time_min, time_max),
+            next_run,
+            lambda: state.clear_sync_token(delta_key),
+        )
+    else:
+        chunks = context.event_cache.iter_events(
+            src,
+            timeMin=time_min,
+            timeMax=time_max,
+            singleEvents=False,
+            orderBy="updated",
+            shards=__get_shards(rule),
+            fields=__get_fields(rule),
         )
-    logger.info(f"found {len(src_events)} events")
 
-    dst_events = dst.list_events(
-        timeMin=(datetime.utcnow() - look_back).isoformat() + "Z",
-        timeMax=(datetime.utcnow() + look_forward).isoformat() + "Z",
+    window = (time_min, time_max) if incremental else None
+    deferred = await __copy_events_async(
+        src, chunks, [(rule, dst, window, context.filters[id(rule)])], context
+    )
+
+    if incremental and not deferred:
+        state.set_sync_token(sync_key, next_sync_token)
+        state.set_sync_token(window_key, time_max)
+    elif delta and not deferred:
+        __set_delta_state(state, delta_key, last_run, next_run)
+
+
+async def __run_shared_copy_rules_async(rules, context, resolve):
+    """Async counterpart to __run_shared_copy_rules."""
+    src = resolve(rules[0]["src"])
+
+    time_min, time_max, windows = __get_shared_window(rules, context)
+
+    chunks = context.event_cache.iter_events(
+        src,
+        timeMin=time_min,
+        timeMax=time_max,
         singleEvents=False,
         orderBy="updated",
+        shards=max(__get_shards(rule) for rule in rules),
+        fields=__get_fields(rules[0]),
     )
-    logger.debug(f"found {len(dst_events)} events")
+    targets = [
+        (rule, resolve(rule["dst"]), window, context.filters[id(rule)])
+        for rule, window in zip(rules, windows)
+    ]
 
-    for event in dst_events:
-        logger.info(f"processing event {event_short_repr(event)}")
+    await __copy_events_async(src, chunks, targets, context)
 
-        try:
-            matching_src_events = list(
-                filter(
-                    lambda x: x == event,
-                    src_events,
+
+async def __copy_events_async(src, chunks, targets, context):
+    """Async counterpart to __copy_events. Imports are started as each chunk is
+    processed; the service's connection pool limits how many are actually in
+    flight, and once MAX_PENDING_IMPORTS are waiting, reading more chunks waits
+    for some to finish."""
+    errors = []
+    imports = {}
+
+    copies = {
+        id(rule): await __list_dst_copies_async(rule, dst, context)
+        for rule, dst, _, _ in targets
+    }
+
+    def collect(done):
+        for task in done:
+            event, retry = imports.pop(task)
+            if task.exception() is not None:
+                errors.append(
+                    {"item": event, "error": task.exception(), "retry": retry}
                 )
-            )
 
-            if not matching_src_events:
-                # no matching source events, so delete
-                if event.is_all_day():
-                    # we skip deletes for all-days (but still warn) as there
-                    # appears to be a bug (or mistake) where many all-days in
-                    # my personal calendar were copied and then removed, particularly
-                    # birthdays
-                    logger.warn(
-                        "no matching source event, it's all-day so won't delete"
+    try:
+        async for events in context.timings.timed_async("list", chunks):
+            logger.info(f"found {len(events)} events")
+            chunk_targets = __compile_targets(targets, events, context)
+
+            for event in events:
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info(f"processing event {event_short_repr(event)}")
+                for rule, dst, matches_filters in chunk_targets:
+                    if event.is_cancelled() and rule.get(
+                        "delta", COPY_DEFAULTS["delta"]
+                    ):
+                        copy = __get_copy(dst, event)
+                        if copy is not None:
+                            task = asyncio.ensure_future(__delete_copy_async(dst, copy))
+                            imports[task] = (event, partial(dst.delete_event, copy))
+                        continue
+
+                    copy = __prepare_copy(
+                        rule,
+                        event,
+                        src,
+                        dst,
+                        matches_filters,
+                        context.timings,
+                        copies[id(rule)],
+                    )
+                    if copy is not None:
+                        new_event, patch = copy
+                        task = asyncio.ensure_future(
+                            __write_copy_async(dst, event, new_event, patch)
+                        )
+                        imports[task] = (
+                            event,
+                            partial(dst.import_event, new_event, source=event),
+                        )
+
+            while len(imports) >= MAX_PENDING_IMPORTS:
+                with context.timings.phase("write"):
+                    done, _ = await asyncio.wait(
+                        imports, return_when=asyncio.FIRST_COMPLETED
                     )
-                    continue
+                collect(done)
 
-                logger.info("no matching source event, deleting")
-                dst.delete_event(event)
+    finally:
+        if imports:
+            with context.timings.phase("write"):
+                done, _ = await asyncio.wait(imports)
+            collect(done)
 
+    return __handle_errors(errors, context)
+
+
+async def __write_copy_async(dst, event, new_event, patch):
+    """Writes new_event to dst as the copy of event, as __prepare_copy said to:
+    importing it, or patching an earlier copy, or importing it again if that
+    copy has since been deleted."""
+    if patch is not None:
+        try:
+            event_id, changes = patch
+            return await dst.patch_event(event_id, new_event, changes, source=event)
         except Exception as ex:
-            print("error occurred while processing event:", file=sys.stderr)
-            print(event, file=sys.stderr)
+            if get_error_status(ex) not in MISSING_COPY_STATUSES:
+                raise
+            logger.info("copy has been deleted from dst, importing it again")
+
+    return await dst.import_event(new_event, source=event)
+
+
+async def __delete_copy_async(dst, copy):
+    """Deletes copy, the copy of an event since cancelled, from dst. Copies
+    already gone from dst are just forgotten."""
+    logger.info("event was cancelled, deleting its copy")
+    try:
+        await dst.delete_event(copy)
+    except Exception as ex:
+        if get_error_status(ex) not in MISSING_COPY_STATUSES:
+            raise
+        get_state_store().delete_event_mapping(dst.id, copy.id)
+
+
+async def __run_remove_deleted_rule_async(rule, context, resolve):
+    if type(rule["src"]) is list:
+        src = [resolve(x) for x in rule["src"]]
+    else:
+        src = [resolve(rule["src"])]
+
+    dst = resolve(rule["dst"])
+
+    time_min, time_max = __get_window(rule, context)
+
+    with context.timings.phase("list"):
+        src_results = await asyncio.gather(
+            *(
+                context.event_cache.list_events(
+                    src_,
+                    timeMin=time_min,
+                    timeMax=time_max,
+                    singleEvents=False,
+                    orderBy="updated",
+                    shards=__get_shards(rule),
+                    fields=__get_fields(rule),
+                )
+                for src_ in src
+            )
+        )
+        src_events = [e for events in src_results for e in events]
+        logger.info(f"found {len(src_events)} events")
+
+        dst_events = await dst.list_events(
+            timeMin=time_min,
+            timeMax=time_max,
+            singleEvents=False,
+            orderBy="updated",
+            shards=__get_shards(rule),
+            fields=__get_fields(rule),
+        )
+        logger.debug(f"found {len(dst_events)} events")
+
+    dst_sources = get_state_store().get_event_sources(dst.id)
+    src_keys = {(e.calendarId, e.id) for e in src_events}
+    src_ical_uids = {e.iCalUID for e in src_events}
+    src_ical_uids.discard(None)
+
+    deletes = []
+    with context.timings.phase("filter"):
+        for event in dst_events:
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(f"processing event {event_short_repr(event)}")
+            if __should_delete(event, dst_sources, src_keys, src_ical_uids):
+                deletes.append(event)
+
+    with context.timings.phase("write"):
+        results = await asyncio.gather(
+            *(dst.delete_event(event) for event in deletes),
+            return_exceptions=True,
+        )
+    __handle_errors(
+        [
+            {
+                "item": event,
+                "error": result,
+                "retry": partial(dst.delete_event, event),
+            }
+            for event, result in zip(deletes, results)
+            if isinstance(result, Exception)
+        ],
+        context,
+    )
+
+
+def __prepare_copy(rule, event, src, dst, matches_filters, timings, copies=None):
+    """Returns (new_event, patch) for writing the copy of event to dst, or None
+    if the event should be skipped. new_event is the copy, and patch is None if
+    it should be imported, or (dst event id, changes) if an earlier copy should
+    be patched with just the fields that changed since it was written.
+    matches_filters is the rule's compiled filter, and copies is as returned by
+    __list_dst_copies. Time spent is added to timings' filter and transform
+    phases."""
+    with timings.phase("filter"):
+        if event.is_cancelled():
+            logger.info("event was cancelled, skipping")
+            return None
+
+        if not matches_filters(event):
+            logger.info("event did not match filters, skipping")
+            return None
+
+    with timings.phase("transform"):
+        new_event = event.copy()
+
+        private_copy = rule.get("private_copy", COPY_DEFAULTS["private_copy"])
+        if private_copy:
+            new_event.attributes["privateCopy"] = True
+
+        logger.info("running transforms")
+        __transform(rule, new_event, src=src)
+
+        # skip events whose copy would be identical to the last one we made
+        fingerprint = new_event.fingerprint()
+        state = get_state_store()
+        mapping = state.get_event_mapping(event.calendarId, event.id, dst.id)
+        if mapping is not None and mapping[1] == fingerprint:
+            logger.info("event unchanged since last copied, skipping")
+            return None
+
+        new_event.set_private_property(FINGERPRINT_PROPERTY, fingerprint)
+
+        # without a record of the copy, the fingerprint on the copy itself says
+        # whether it's up to date; if so, the record is made again
+        if mapping is None and copies is not None:
+            copy = copies.get(event.iCalUID)
+            if copy is not None and copy[1] == fingerprint:
+                logger.info("copy in dst already up to date, skipping")
+                state.set_event_mapping(
+                    event.calendarId,
+                    event.id,
+                    dst.id,
+                    copy[0],
+                    fingerprint,
+                    new_event.attributes,
+                )
+                return None
+
+        # the transforms are run on a fresh copy of event every time, so the
+        # changes hold the copy's new fields whole (appended descriptions too)
+        if mapping is not None:
+            content = state.get_event_content(event.calendarId, event.id, dst.id)
+            if content is not None:
+                changes = event_patch(content, new_event.attributes)
+                if not changes:
+                    logger.info("copy already up to date, skipping")
+                    return None
+
+                return new_event, (mapping[0], changes)
+
+    return new_event, None
 
-            raise ex
 
+def __list_dst_copies(rule, dst, context):
+    """Returns a dict mapping the iCalUIDs of the events in dst, within the
+    rule's window, to their (id, fingerprint), if the state store has no record
+    of any copies in dst: because it's new, or py-calsync.db was deleted or
+    moved. Copies carry their fingerprints, so those that are up to date needn't
+    be imported again. Otherwise, returns None, as the state store's records say
+    which copies are up to date."""
+    if get_state_store().has_event_mappings(dst.id):
+        return None
+
+    time_min, time_max = __get_window(rule, context)
+    with context.timings.phase("list"):
+        events = dst.list_events(
+            timeMin=time_min,
+            timeMax=time_max,
+            singleEvents=False,
+            orderBy="updated",
+            fields=COPY_FINGERPRINT_FIELDS,
+        )
+
+    return __index_copies(events)
+
+
+async def __list_dst_copies_async(rule, dst, context):
+    """Async counterpart to __list_dst_copies."""
+    if get_state_store().has_event_mappings(dst.id):
+        return None
+
+    time_min, time_max = __get_window(rule, context)
+    with context.timings.phase("list"):
+        events = await dst.list_events(
+            timeMin=time_min,
+            timeMax=time_max,
+            singleEvents=False,
+            orderBy="updated",
+            fields=COPY_FINGERPRINT_FIELDS,
+        )
+
+    return __index_copies(events)
+
+
+def __index_copies(events):
+    """Returns a dict mapping the iCalUIDs of the copies among events (those
+    carrying a fingerprint) to their (id, fingerprint)."""
+    return {
+        e.iCalUID: (e.id, e.get_private_property(FINGERPRINT_PROPERTY))
+        for e in events
+        if e.get_private_property(FINGERPRINT_PROPERTY) is not None
+    }
+
+
+def __should_delete(event, dst_sources, src_keys, src_ical_uids):
+    """Returns True if the dst event should be deleted, because it has no
+    matching source event."""
+    if event.id in dst_sources:
+        has_src_event = dst_sources[event.id] in src_keys
+    else:
+        has_src_event = event.iCalUID in src_ical_uids
+
+    if has_src_event:
+        return False
+
+    if event.is_all_day():
+        # we skip deletes for all-days (but still warn) as there appears to be
+        # a bug (or mistake) where many all-days in my personal calendar were
+        # copied and then removed, particularly birthdays
+        logger.warn("no matching source event, it's all-day so won't delete")
+        return False
+
+    logger.info("no matching source event, deleting")
+    return True
+
+
+def __get_shared_window(rules, context):
+    """Returns (timeMin, timeMax, windows), where timeMin and timeMax bound the
+    windows of every one of rules, and windows holds each rule's own window, or
+    None where it's the same as the shared one."""
+    windows = [__get_window(rule, context) for rule in rules]
+
+    time_min = min((w[0] for w in windows), key=rfc3339_to_datetime)
+    time_max = max((w[1] for w in windows), key=rfc3339_to_datetime)
+
+    return (
+        time_min,
+        time_max,
+        [w if w != (time_min, time_max) else None for w in windows],
+    )
 
-def __matches_filters(rule, event):
+
+def __get_shards(rule):
+    """Returns how many sub-windows the rule lists its window in."""
+    shards = rule.get("shards", COPY_DEFAULTS["shards"])
+    if type(shards) is not int or shards < 1:
+        raise ValueError(f"shards must be a positive whole number, not {shards!r}")
+
+    return shards
+
+
+def __get_window(rule, context):
+    """Returns the (timeMin, timeMax) window of events the rule works on."""
+    look_back = parse_timedelta_string(
+        rule.get("look_back", COPY_DEFAULTS["look_back"])
+    )
+    look_forward = parse_timedelta_string(
+        rule.get("look_forward", COPY_DEFAULTS["look_forward"])
+    )
+
+    return (
+        datetime_to_rfc3339(context.now - look_back),
+        datetime_to_rfc3339(context.now + look_forward),
+    )
+
+
+RULE_METHODS = {
+    "copy": __run_copy_rule,
+    "remove_deleted": __run_remove_deleted_rule,
+}
+
+ASYNC_RULE_METHODS = {
+    "copy": __run_copy_rule_async,
+    "remove_deleted": __run_remove_deleted_rule_async,
+}
+
+
+def __error_collector(errors, item, retry):
+    """Returns a batch callback that records a failed request for item in
+    errors, as a { item, error } dict like gather_errors returns, plus the
+    function to call to retry the request."""
+
+    def callback(result, exception):
+        if exception is not None:
+            errors.append({"item": item, "error": exception, "retry": retry})
+
+    return callback
+
+
+def __handle_errors(errors, context):
+    """Handles errors gathered from a rule's writes. Those that were still being
+    rate limited (or hitting server errors) after every retry are deferred to
+    the end of the run; the rest are reported, and the first re-raised.
+
+    Returns True if any errors were deferred."""
+    fatal = []
+    for error in errors:
+        if is_retryable_error(error["error"]):
+            logger.warning(
+                f"deferring {event_short_repr(error['item'])}: {error['error']}"
+            )
+            context.defer(error)
+        else:
+            fatal.append(error)
+
+    for error in fatal:
+        print("error occurred while processing event:", file=sys.stderr)
+        print(error["item"], file=sys.stderr)
+
+    if fatal:
+        raise fatal[0]["error"]
+
+    return len(fatal) < len(errors)
+
+
+async def __iter_async(items):
+    """Returns an async iterable over items."""
+    for item in items:
+        yield item
+
+
+def __report_deferred_failure(deferred, ex):
+    logger.error(f"giving up on {event_short_repr(deferred['item'])}: {ex}")
+
+
+def __compile_filters(rule):
+    """Returns the rule's filter as a CompiledFilter, or None if it has none.
+    Raises ValueError if the filter is invalid."""
     filter_ = rule.get("filter", [])
+    return compile_tree(filter_) if filter_ else None
+
+
+def __match_chunk(compiled, events, window=None):
+    """Returns a predicate for whether an event of a chunk of events matches a
+    rule's filter, compiled by __compile_filters. If there are many events,
+    they're all matched up front in bulk, and the predicate looks up their
+    result.
+
+    If window is given, the events were listed for a wider window than the
+    rule's (timeMin, timeMax), and events outside it don't match either."""
+    if window is not None:
+        in_window = {id(e) for e in events if event_in_window(e, *window)}
+        matches_filters = __match_chunk(compiled, events)
+        return lambda event: id(event) in in_window and matches_filters(event)
+
+    elif compiled is None:
+        return lambda event: True
+
+    elif compiled.is_constant():
+        constant = compiled.constant
+        return lambda event: constant
 
-    if not filter_:
-        return True
+    elif len(events) < BULK_FILTER_THRESHOLD:
+        return compiled.predicate
 
     else:
-        return match(filter_, event)
+        mask = compiled.bulk(EventColumns(events))
+        matching = {id(e) for e, matched in zip(events, mask) if matched}
+        return lambda event: id(event) in matching
 
 
 def __transform(rule, event, src):
@@ -0,0 +1,172 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+
+from calsync.rules.planner import get_rule_calendars
+from calsync.rules.planner import rules_conflict
+from calsync.tenant import submit
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_DEFAULTS = {
+    # how long a calendar must go without changes before the rules reading it
+    # run, in seconds, so a burst of changes is synced once
+    "debounce": 5,
+    # the longest a change waits for its calendar to go quiet before its rules
+    # run anyway, in seconds
+    "max_delay": 60,
+}
+
+
+class ChangeScheduler:
+    """Runs rules as the calendars they read change, coalescing bursts of
+    changes into single runs.
+
+    Changes are tracked per (calendar id, rule), and a rule becomes due once one
+    of its calendars has gone debounce seconds without changing (or max_delay
+    seconds after the first change, if it never goes quiet). A due rule runs
+    once for everything pending against it, so a burst yields one incremental
+    run; changes arriving while it runs are kept for another.
+
+    Due rules are started together with run(rules), which is expected to be a
+    run_rules() of them, so they can share scans. At most concurrency rules run
+    at once, and a rule never starts alongside a running rule it conflicts with
+    (see rules_conflict). Rules whose changes have waited longest go first.
+
+    Call run_forever() on a thread of its own, and stop() to end it."""
+
+    def __init__(
+        self,
+        rules,
+        resolve_calendar,
+        run,
+        concurrency=4,
+        debounce=SCHEDULER_DEFAULTS["debounce"],
+        max_delay=SCHEDULER_DEFAULTS["max_delay"],
+        clock=time.monotonic,
+    ):
+        self.rules = rules
+        self.calendars = [get_rule_calendars(rule, resolve_calendar) for rule in rules]
+        self.run = run
+        self.concurrency = concurrency
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.clock = clock
+
+        # maps (calendar id, rule index) to (first change, when due)
+        self.pending = {}
+        self.running = set()
+
+        self.condition = threading.Condition()
+        self.stopping = False
+
+    def changed(self, calendar_id, debounce=None):
+        """Records a change to calendar_id, for every rule reading it. debounce
+        overrides the scheduler's, e.g. 0 to run them as soon as possible."""
+        if debounce is None:
+            debounce = self.debounce
+
+        now = self.clock()
+        with self.condition:
+            for i, (reads, _) in enumerate(self.calendars):
+                if calendar_id not in reads:
+                    continue
+
+                first, _ = self.pending.get((calendar_id, i), (now, None))
+                due = min(now + debounce, first + self.max_delay)
+                self.pending[(calendar_id, i)] = (first, due)
+
+            self.condition.notify_all()
+
+    def changed_all(self):
+        """Records a change to every calendar the rules read, running every rule
+        as soon as possible."""
+        # all at once, so they all start together
+        with self.condition:
+            for calendar_id in set().union(*(reads for reads, _ in self.calendars)):
+                self.changed(calendar_id, debounce=0)
+
+    def get_due(self):
+        """Returns the indexes of the rules to start now, in config order (which
+        run_rules relies on), and marks them running. Their pending changes are
+        cleared, as their runs will pick them up."""
+        now = self.clock()
+        oldest = {}
+        due = set()
+
+        for (_, i), (first, due_at) in self.pending.items():
+            oldest[i] = min(first, oldest.get(i, first))
+            if due_at <= now:
+                due.add(i)
+
+        started = []
+        for i in sorted(due - self.running, key=lambda i: (oldest[i], i)):
+            if len(self.running) >= self.concurrency:
+                break
+
+            if any(
+                rules_conflict(
+                    self.rules[i], self.calendars[i], self.rules[j], self.calendars[j]
+                )
+                for j in self.running
+            ):
+                continue
+
+            self.running.add(i)
+            started.append(i)
+
+        for key in [key for key in self.pending if key[1] in started]:
+            del self.pending[key]
+
+        return sorted(started)
+
+    def get_wait(self):
+        """Returns how many seconds until a pending rule that isn't running
+        becomes due, or None if none will. Rules already due are waiting on
+        running rules, and are looked at again when those finish."""
+        now = self.clock()
+        waiting = [
+            due
+            for (_, i), (_, due) in self.pending.items()
+            if due > now and i not in self.running
+        ]
+        if not waiting:
+            return None
+
+        return min(waiting) - now
+
+    def finished(self, indexes):
+        """Marks the rules at indexes as no longer running."""
+        with self.condition:
+            self.running.difference_update(indexes)
+            self.condition.notify_all()
+
+    def run_forever(self):
+        """Starts due rules as they become due, until stop() is called. Rules
+        still running are waited for."""
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while True:
+                with self.condition:
+                    if self.stopping:
+                        return
+
+                    started = self.get_due()
+                    if not started:
+                        self.condition.wait(timeout=self.get_wait())
+                        continue
+
+                submit(executor, self.__run, started)
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+
+    def __run(self, indexes):
+        try:
+            self.run([self.rules[i] for i in indexes])
+        except Exception:
+            logger.exception(f"rules {indexes} failed")
+        finally:
+            self.finished(indexes)
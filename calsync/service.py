@@ -1,79 +1,360 @@
-import os.path
+import json
+import threading
+import time
+from urllib.parse import urljoin
 
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from calsync.credentials import get_credential_manager
+from calsync.ratelimit import backoff_delay
+from calsync.ratelimit import call_with_retries
+from calsync.ratelimit import get_error_status
+from calsync.ratelimit import get_rate_limiter
+from calsync.ratelimit import is_retryable_error
+from calsync.ratelimit import MAX_ATTEMPTS
+from calsync.tenant import get_current_tenant
 
-# If modifying these scopes, delete the file token.json.
-SCOPES = [
-    "https://www.googleapis.com/auth/calendar",
-    "https://www.googleapis.com/auth/calendar.events",
-]
+API_ROOT_URL = "https://www.googleapis.com/"
 
-CREDENTIALS_FILE = "credentials.json"
-TOKEN_FILE = "token.json"
-CALLBACK_LISTEN_PORT = 56133
+# The largest page sizes the API allows, to keep round trips to a minimum
+EVENTS_PAGE_SIZE = 2500
+CALENDARS_PAGE_SIZE = 250
 
+# The most requests the API accepts in a single batch request
+BATCH_SIZE = 50
 
-__cached_service = None
+# The fields of list responses that partial response masks always keep, as
+# they're needed to page through results and to sync
+LIST_RESPONSE_FIELDS = ["nextPageToken", "nextSyncToken"]
+
+
+# if set, the root URL of the API to use instead of Google's (see set_api_endpoint)
+__api_endpoint = None
+
+# the API's discovery document, parsed (see get_discovery_document)
+__discovery_document = None
+__discovery_lock = threading.Lock()
+
+# the names of the Event resource's fields, read from the discovery document
+__event_fields = None
+
+# googleapiclient service objects, and the httplib2 connections under them,
+# aren't thread-safe, so each thread builds its own
+__thread_local = threading.local()
+
+
+class SyncTokenExpiredError(Exception):
+    """Raised when the server rejects a sync token (410 Gone), meaning the
+    caller must discard it and do a full sync."""
+
+
+def set_api_endpoint(url):
+    """Points every service at the API at url instead of Google's, such as a
+    FakeCalendarServer's. Requests are then sent without credentials, so no
+    login is needed. Passing None points services back at Google's API."""
+    global __api_endpoint
+    __api_endpoint = url
+
+
+def get_api_base_url():
+    """Returns the base URL of the Calendar API's REST endpoints."""
+    return urljoin(__api_endpoint or API_ROOT_URL, "calendar/v3")
+
+
+def get_credentials():
+    """Returns the credentials services authenticate with, from the shared
+    CredentialManager, which keeps them fresh."""
+    if __api_endpoint is not None:
+        # the Google client libraries are slow to import, so they're only
+        # imported once needed, keeping startup quick
+        from google.auth.credentials import AnonymousCredentials
+
+        return AnonymousCredentials()
+
+    return get_credential_manager().get()
+
+
+def get_discovery_document():
+    """Returns the Calendar API's discovery document, as a dict. It's read from
+    the copy googleapiclient ships with (its static discovery document) rather
+    than fetched, and parsed only once per process, however many threads build
+    services from it. Don't modify it."""
+    global __discovery_document
+
+    with __discovery_lock:
+        if __discovery_document is None:
+            from googleapiclient.discovery_cache import get_static_doc
+
+            __discovery_document = json.loads(get_static_doc("calendar", "v3"))
+
+    return __discovery_document
+
+
+def get_event_fields():
+    """Returns the names of every field of the API's Event resource, as a
+    frozenset, from the discovery document."""
+    global __event_fields
+
+    if __event_fields is None:
+        doc = get_discovery_document()
+        __event_fields = frozenset(doc["schemas"]["Event"]["properties"])
+
+    return __event_fields
+
+
+def get_events_fields_mask(fields):
+    """Returns the partial response mask (the fields parameter) for listing
+    events with only the given Event fields, or None to get every field."""
+    if fields is None:
+        return None
+
+    return ",".join(LIST_RESPONSE_FIELDS + [f"items({','.join(sorted(fields))})"])
+
+
+def __build_calendar_service():
+    from googleapiclient.discovery import build_from_document
+
+    document = get_discovery_document()
+    if __api_endpoint is not None:
+        # batch requests go to the discovery document's rootUrl whatever the
+        # client options say, so build from a copy pointing at the endpoint
+        document = dict(document, rootUrl=__api_endpoint)
+
+    return build_from_document(document, credentials=get_credentials())
 
 
 def __get_underlying_calendar_service():
-    global __cached_service
-    if __cached_service is None:
-        creds = None
-        # The file token.json stores the user's access and refresh tokens, and is
-        # created automatically when the authorization flow completes for the first
-        # time.
-        if os.path.exists(TOKEN_FILE):
-            creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
-        # If there are no (valid) credentials available, let the user log in.
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    CREDENTIALS_FILE, SCOPES
-                )
-                creds = flow.run_local_server(port=CALLBACK_LISTEN_PORT)
-            # Save the credentials for the next run
-            with open(TOKEN_FILE, "w") as token:
-                token.write(creds.to_json())
-
-        __cached_service = build("calendar", "v3", credentials=creds)
-
-    return __cached_service
+    """Returns (service, events resource) for this thread and the current tenant
+    (if any), building them on first use. Each tenant's are built with its own
+    credentials, so a thread keeps one per tenant it has run rules for."""
+    services = getattr(__thread_local, "services", None)
+    if services is None or __thread_local.api_endpoint != __api_endpoint:
+        services = __thread_local.services = {}
+        __thread_local.api_endpoint = __api_endpoint
+
+    tenant = get_current_tenant()
+    if tenant not in services:
+        service = __build_calendar_service()
+        services[tenant] = (service, service.events())
+
+    return services[tenant]
 
 
 def get_calendar_service():
-    underlying = __get_underlying_calendar_service()
-    return CalendarService(service=underlying)
+    underlying, events = __get_underlying_calendar_service()
+    return CalendarService(
+        service=underlying, rate_limiter=get_rate_limiter(), events=events
+    )
 
 
 class CalendarService:
     """Wrapper around the Google Calendar Service API, to make mocking/testing much
-    easier."""
+    easier.
+
+    Every request waits on rate_limiter (if given) and is retried with backoff
+    on 429, 5xx and rate limit 403 responses, up to max_attempts times.
 
-    def __init__(self, service):
+    googleapiclient builds a resource's methods from the discovery document each
+    time the resource is asked for, which takes milliseconds, so events (the
+    service's events() resource) is only built once and passed in where
+    possible."""
+
+    def __init__(
+        self, service, rate_limiter=None, max_attempts=MAX_ATTEMPTS, events=None
+    ):
         self.service = service
+        self.rate_limiter = rate_limiter
+        self.max_attempts = max_attempts
+        self.events = events if events is not None else service.events()
+
+    def __execute(self, request):
+        return call_with_retries(
+            request.execute,
+            rate_limiter=self.rate_limiter,
+            max_attempts=self.max_attempts,
+        )
+
+    def __pages(self, list_method, **kwargs):
+        """Executes a list request, following nextPageToken, and yields the result
+        of each page as it arrives."""
+        while True:
+            result = self.__execute(list_method(**kwargs))
+            yield result
+
+            page_token = result.get("nextPageToken")
+            if not page_token:
+                return
+
+            kwargs["pageToken"] = page_token
 
     def list_calendars(self, **kwargs):
-        result = self.service.calendarList().list(**kwargs).execute()
-        return result.get("items", [])
+        """Yields every calendar in the user's calendar list, across all pages."""
+        if kwargs.get("maxResults") is None:
+            kwargs["maxResults"] = CALENDARS_PAGE_SIZE
+
+        for page in self.__pages(self.service.calendarList().list, **kwargs):
+            yield from page.get("items", [])
 
     def list_events(self, **kwargs):
-        result = self.service.events().list(**kwargs).execute()
-        return result.get("items", [])
+        """Yields every event matching the query, across all pages. Pages are
+        fetched lazily, so callers that stop early don't fetch the rest."""
+        if kwargs.get("maxResults") is None:
+            kwargs["maxResults"] = EVENTS_PAGE_SIZE
+
+        for page in self.__pages(self.events.list, **kwargs):
+            yield from page.get("items", [])
+
+    def sync_events(self, **kwargs):
+        """Lists events, following every page, and returns (items, nextSyncToken).
+        The sync token is only sent on the final page, so all pages must be read
+        before it is available."""
+        if kwargs.get("maxResults") is None:
+            kwargs["maxResults"] = EVENTS_PAGE_SIZE
+
+        items = []
+        try:
+            for page in self.__pages(self.events.list, **kwargs):
+                items.extend(page.get("items", []))
+
+        except Exception as ex:
+            if get_error_status(ex) == 410:
+                raise SyncTokenExpiredError(str(ex)) from ex
+            raise
+
+        return items, page.get("nextSyncToken")
+
+    def new_batch(self, batch_size=BATCH_SIZE):
+        """Returns a CalendarBatch for queueing imports, patches and deletes."""
+        return CalendarBatch(
+            service=self.service,
+            batch_size=batch_size,
+            rate_limiter=self.rate_limiter,
+            max_attempts=self.max_attempts,
+            events=self.events,
+        )
 
     def insert_event(self, **kwargs):
-        result = self.service.events().insert(**kwargs).execute()
+        result = self.__execute(self.events.insert(**kwargs))
         return result
 
     def import_event(self, **kwargs):
-        result = self.service.events().import_(**kwargs).execute()
+        result = self.__execute(self.events.import_(**kwargs))
+        return result
+
+    def patch_event(self, **kwargs):
+        result = self.__execute(self.events.patch(**kwargs))
         return result
 
     def delete_event(self, **kwargs):
-        result = self.service.events().delete(**kwargs).execute()
+        result = self.__execute(self.events.delete(**kwargs))
         return result
+
+    def watch_events(self, **kwargs):
+        result = self.__execute(self.events.watch(**kwargs))
+        return result
+
+    def stop_channel(self, **kwargs):
+        result = self.__execute(self.service.channels().stop(**kwargs))
+        return result
+
+
+class CalendarBatch:
+    """Queues import, patch and delete requests and sends them to the API in batch
+    requests of up to batch_size requests each, rather than one round trip per
+    request. Used as a context manager, any queued requests are sent on exit.
+
+    Each request's callback is called with (response, exception) once its batch
+    has been sent; exception is None if the request succeeded. Requests failing
+    with retryable errors are re-sent in a later batch, after a backoff, up to
+    max_attempts times before their callback gets the error."""
+
+    def __init__(
+        self,
+        service,
+        batch_size=BATCH_SIZE,
+        rate_limiter=None,
+        max_attempts=MAX_ATTEMPTS,
+        events=None,
+    ):
+        self.service = service
+        self.batch_size = batch_size
+        self.rate_limiter = rate_limiter
+        self.max_attempts = max_attempts
+        self.events = events if events is not None else service.events()
+        self.queue = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def import_event(self, callback=None, **kwargs):
+        self.__add(self.events.import_(**kwargs), callback)
+
+    def patch_event(self, callback=None, **kwargs):
+        self.__add(self.events.patch(**kwargs), callback)
+
+    def delete_event(self, callback=None, **kwargs):
+        self.__add(self.events.delete(**kwargs), callback)
+
+    def __add(self, request, callback):
+        self.queue.append((request, callback, 0))
+
+        if len(self.queue) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Sends every queued request, calling their callbacks."""
+        while self.queue:
+            requests = self.queue[: self.batch_size]
+            self.queue = self.queue[self.batch_size :]
+            retries = []
+
+            # quota is counted per request in the batch, not per batch
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(len(requests))
+
+            # the callbacks of requests the batch hasn't answered yet, by index
+            unanswered = {
+                i: self.__wrap_callback(request, callback, attempt, retries)
+                for i, (request, callback, attempt) in enumerate(requests)
+            }
+
+            batch = self.service.new_batch_http_request()
+            for i, (request, _, _) in enumerate(requests):
+                batch.add(request, callback=self.__answer(unanswered, i))
+
+            try:
+                batch.execute()
+            except Exception as ex:
+                # the batch request itself failed (a 5xx, say), so every request
+                # it didn't answer fails with its error, and is retried like any
+                # other request if that's retryable
+                for batch_callback in list(unanswered.values()):
+                    batch_callback(None, None, ex)
+
+            if retries:
+                # attempt is already that of the retry, so back off from the one before
+                time.sleep(backoff_delay(max(attempt for _, _, attempt in retries) - 1))
+                self.queue = retries + self.queue
+
+    def __answer(self, unanswered, i):
+        def batch_callback(request_id, response, exception):
+            unanswered.pop(i)(request_id, response, exception)
+
+        return batch_callback
+
+    def __wrap_callback(self, request, callback, attempt, retries):
+        def batch_callback(request_id, response, exception):
+            if (
+                exception is not None
+                and is_retryable_error(exception)
+                and attempt + 1 < self.max_attempts
+            ):
+                retries.append((request, callback, attempt + 1))
+                return
+
+            if callback is not None:
+                callback(response, exception)
+
+        return batch_callback
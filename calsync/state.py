@@ -0,0 +1,204 @@
+import json
+import sqlite3
+import threading
+
+from calsync.tenant import get_current_tenant
+
+# The file the state database is kept in, relative to the working directory
+# (alongside token.json and py-calsync.yaml).
+STATE_FILE = "py-calsync.db"
+
+
+class StateStore:
+    """Local store for state that needs to survive between runs, such as the
+    sync tokens used for incremental syncing and the mapping of source events
+    to the copies made of them. Backed by a SQLite database."""
+
+    def __init__(self, filename=STATE_FILE):
+        self.filename = filename
+        # the connection is shared by every thread in the run, one at a time
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.__create_tables()
+
+    def __create_tables(self):
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS sync_tokens (
+                    key TEXT PRIMARY KEY,
+                    token TEXT NOT NULL
+                )
+                """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS event_mappings (
+                    src_calendar_id TEXT NOT NULL,
+                    src_event_id TEXT NOT NULL,
+                    dst_calendar_id TEXT NOT NULL,
+                    dst_event_id TEXT NOT NULL,
+                    content_hash TEXT,
+                    content TEXT,
+                    PRIMARY KEY (src_calendar_id, src_event_id, dst_calendar_id)
+                )
+                """)
+
+            # databases made before copies' content was kept lack its column
+            columns = [
+                row[1] for row in self.conn.execute("PRAGMA table_info(event_mappings)")
+            ]
+            if "content" not in columns:
+                self.conn.execute("ALTER TABLE event_mappings ADD COLUMN content TEXT")
+            self.conn.execute("""
+                CREATE INDEX IF NOT EXISTS event_mappings_dst
+                ON event_mappings (dst_calendar_id, dst_event_id)
+                """)
+
+    def get_sync_token(self, key):
+        """Returns the sync token stored under key, or None if there isn't one."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT token FROM sync_tokens WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_sync_token(self, key, token):
+        """Stores token under key. A token of None clears the key, so the next
+        sync is a full one."""
+        if token is None:
+            self.clear_sync_token(key)
+            return
+
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO sync_tokens (key, token) VALUES (?, ?)",
+                (key, token),
+            )
+
+    def clear_sync_token(self, key):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM sync_tokens WHERE key = ?", (key,))
+
+    def set_event_mapping(
+        self,
+        src_calendar_id,
+        src_event_id,
+        dst_calendar_id,
+        dst_event_id,
+        content_hash=None,
+        content=None,
+    ):
+        """Records that the source event has been copied to dst_event_id in the
+        destination calendar, replacing any earlier copy's mapping. content is
+        the copy's attributes as written, which later changes are patched onto
+        (see get_event_content)."""
+        with self.lock, self.conn:
+            self.conn.execute(
+                """
+                INSERT OR REPLACE INTO event_mappings (
+                    src_calendar_id,
+                    src_event_id,
+                    dst_calendar_id,
+                    dst_event_id,
+                    content_hash,
+                    content
+                ) VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    src_calendar_id,
+                    src_event_id,
+                    dst_calendar_id,
+                    dst_event_id,
+                    content_hash,
+                    None if content is None else json.dumps(content, default=str),
+                ),
+            )
+
+    def get_event_mapping(self, src_calendar_id, src_event_id, dst_calendar_id):
+        """Returns (dst_event_id, content_hash) for the copy of the source event in
+        the destination calendar, or None if it hasn't been copied there."""
+        with self.lock:
+            return self.conn.execute(
+                """
+                SELECT dst_event_id, content_hash FROM event_mappings
+                WHERE src_calendar_id = ? AND src_event_id = ? AND dst_calendar_id = ?
+                """,
+                (src_calendar_id, src_event_id, dst_calendar_id),
+            ).fetchone()
+
+    def get_event_content(self, src_calendar_id, src_event_id, dst_calendar_id):
+        """Returns the attributes the copy of the source event in the destination
+        calendar was last written with, or None if they weren't recorded."""
+        with self.lock:
+            row = self.conn.execute(
+                """
+                SELECT content FROM event_mappings
+                WHERE src_calendar_id = ? AND src_event_id = ? AND dst_calendar_id = ?
+                """,
+                (src_calendar_id, src_event_id, dst_calendar_id),
+            ).fetchone()
+
+        if row is None or row[0] is None:
+            return None
+
+        return json.loads(row[0])
+
+    def get_event_sources(self, dst_calendar_id):
+        """Returns a dict of dst event ID to (src_calendar_id, src_event_id) for
+        every copy recorded in the destination calendar."""
+        with self.lock:
+            rows = self.conn.execute(
+                """
+                SELECT dst_event_id, src_calendar_id, src_event_id
+                FROM event_mappings
+                WHERE dst_calendar_id = ?
+                """,
+                (dst_calendar_id,),
+            )
+            return {row[0]: (row[1], row[2]) for row in rows}
+
+    def has_event_mappings(self, dst_calendar_id):
+        """Returns True if any copy is recorded in the destination calendar."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM event_mappings WHERE dst_calendar_id = ? LIMIT 1",
+                (dst_calendar_id,),
+            ).fetchone()
+        return row is not None
+
+    def delete_event_mapping(self, dst_calendar_id, dst_event_id):
+        """Forgets the mapping for a destination event, e.g. once it's deleted."""
+        with self.lock, self.conn:
+            self.conn.execute(
+                """
+                DELETE FROM event_mappings
+                WHERE dst_calendar_id = ? AND dst_event_id = ?
+                """,
+                (dst_calendar_id, dst_event_id),
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+__cached_state_store = None
+__state_store_lock = threading.Lock()
+
+
+def get_state_store():
+    global __cached_state_store
+
+    tenant = get_current_tenant()
+    if tenant is not None:
+        return tenant.state_store
+
+    with __state_store_lock:
+        if __cached_state_store is None:
+            __cached_state_store = StateStore()
+
+    return __cached_state_store
+
+
+def set_state_store(state_store):
+    """Replaces the shared StateStore, e.g. with one kept in memory."""
+    global __cached_state_store
+    with __state_store_lock:
+        __cached_state_store = state_store
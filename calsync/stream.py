@@ -0,0 +1,103 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import queue
+import threading
+
+from calsync.tenant import submit
+
+# how long a prefetch thread waits to hand over a chunk before checking whether
+# its consumer has gone away
+PREFETCH_POLL_INTERVAL = 0.1
+
+# the most iterables prefetched at once, across the process; any more wait for
+# a thread to come free
+MAX_PREFETCH_WORKERS = 32
+
+# marks the end of a prefetched iterable
+__END = object()
+
+
+def chunked(iterable, size):
+    """Yields lists of up to size items from iterable, reading it lazily."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+async def async_chunked(aiterable, size):
+    """Async counterpart to chunked, for async iterables."""
+    chunk = []
+    async for item in aiterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def prefetch(iterable, buffered=1):
+    """Yields the items of iterable, reading it on a background thread (from
+    get_prefetch_executor()) that stays up to buffered items ahead, so
+    producing the next item (fetching a page, say) overlaps with the caller's
+    work on this one. Exceptions raised by iterable are re-raised to the caller.
+
+    If the caller stops early, the thread stops after its current item."""
+    items = queue.Queue(maxsize=buffered)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=PREFETCH_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as ex:
+            put((None, ex))
+        else:
+            put((__END, None))
+
+    submit(get_prefetch_executor(), produce)
+
+    try:
+        while True:
+            item, ex = items.get()
+            if ex is not None:
+                raise ex
+            if item is __END:
+                return
+            yield item
+
+    finally:
+        stopped.set()
+
+
+__prefetch_executor = None
+__prefetch_executor_lock = threading.Lock()
+
+
+def get_prefetch_executor():
+    """Returns the thread pool that prefetch() reads iterables on. It lasts as
+    long as the process, so its threads build their API service objects (see
+    get_calendar_service) just once, rather than once per listing."""
+    global __prefetch_executor
+
+    with __prefetch_executor_lock:
+        if __prefetch_executor is None:
+            __prefetch_executor = ThreadPoolExecutor(
+                max_workers=MAX_PREFETCH_WORKERS, thread_name_prefix="calsync-prefetch"
+            )
+
+        return __prefetch_executor
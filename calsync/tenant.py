@@ -0,0 +1,65 @@
+from contextlib import contextmanager
+import contextvars
+import threading
+
+# the tenant whose rules are running, if any (see use_tenant)
+__current_tenant = contextvars.ContextVar("calsync_tenant", default=None)
+
+
+class Tenant:
+    """One account whose rules run alongside other accounts' in the same
+    process (see calsync.multitenant).
+
+    While a tenant is current (see use_tenant), the process-wide credential
+    manager, state store, rate limiter, calendar list and API services are
+    replaced by the tenant's own: get_credential_manager(), get_state_store(),
+    get_rate_limiter(), get_calendars() and get_calendar_service() return
+    these. So tenants can't see each other's calendars or state, and one
+    tenant's requests can't use up another's quota."""
+
+    def __init__(
+        self, name, config, credential_manager, state_store, rate_limiter=None
+    ):
+        self.name = name
+        self.config = config
+        self.credential_manager = credential_manager
+        self.state_store = state_store
+        # set by set_rate_limit() when the tenant's rules run
+        self.rate_limiter = rate_limiter
+        # the tenant's calendar list, cached by get_calendars()
+        self.calendars = None
+
+    def __repr__(self):
+        return f"Tenant({self.name!r})"
+
+
+def get_current_tenant():
+    """Returns the current Tenant, or None if there isn't one."""
+    return __current_tenant.get()
+
+
+@contextmanager
+def use_tenant(tenant):
+    """Makes tenant current within the block, in this thread and the threads
+    started from it through start_thread() and submit()."""
+    token = __current_tenant.set(tenant)
+    try:
+        yield tenant
+    finally:
+        __current_tenant.reset(token)
+
+
+def start_thread(target, **kwargs):
+    """Starts a thread running target, with the current tenant (if any) current
+    in it too. kwargs are passed to threading.Thread."""
+    thread = threading.Thread(
+        target=contextvars.copy_context().run, args=(target,), **kwargs
+    )
+    thread.start()
+    return thread
+
+
+def submit(executor, f, *args, **kwargs):
+    """executor.submit(f, *args, **kwargs), with the current tenant (if any)
+    current while f runs."""
+    return executor.submit(contextvars.copy_context().run, f, *args, **kwargs)
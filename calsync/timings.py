@@ -0,0 +1,55 @@
+from contextlib import contextmanager
+import threading
+import time
+
+
+class PhaseTimings:
+    """Adds up the time spent in each phase of a run (listing, filtering and so
+    on) across every rule. Safe to share between threads.
+
+    Rules running concurrently each add their own time, so totals can exceed the
+    run's wall clock time."""
+
+    def __init__(self):
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """Times the body of a with statement as part of phase name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.totals[name] = self.totals.get(name, 0) + seconds
+
+    def as_dict(self):
+        with self.lock:
+            return dict(self.totals)
+
+    def timed(self, name, iterable):
+        """Yields the items of iterable, timing the work of producing each one
+        (fetching a page, say) as part of phase name."""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    async def timed_async(self, name, aiterable):
+        """Async counterpart to timed, for async iterables."""
+        iterator = aiterable.__aiter__()
+        while True:
+            with self.phase(name):
+                try:
+                    item = await iterator.__anext__()
+                except StopAsyncIteration:
+                    return
+            yield item
@@ -1,5 +1,7 @@
+from datetime import date
 from datetime import datetime
 from datetime import timedelta
+from datetime import timezone
 
 from pytimeparse import parse
 
@@ -14,3 +16,58 @@ def datetime_to_rfc3339(dt):
 
 def parse_timedelta_string(input):
     return timedelta(seconds=parse(input))
+
+
+def rfc3339_to_datetime(input):
+    """Parses an RFC3339 timestamp as used by the API into an aware datetime.
+    Timestamps without an offset are taken to be UTC. None is passed through, so
+    unset bounds can be parsed the same way as set ones."""
+    if input is None:
+        return None
+
+    # fromisoformat() only understands the 'Z' suffix from 3.11 onwards
+    if input.endswith("Z"):
+        input = input[:-1] + "+00:00"
+
+    dt = datetime.fromisoformat(input)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+
+    return dt
+
+
+def event_time_to_datetime(input):
+    """Converts an event's start or end (a dict holding either a dateTime or, for
+    all-day events, a date) to an aware datetime. All-day dates are taken as
+    midnight UTC. Returns None if input isn't in a recognised form."""
+    if not isinstance(input, dict):
+        return None
+
+    if "dateTime" in input:
+        return rfc3339_to_datetime(input["dateTime"])
+
+    if "date" in input:
+        return datetime.combine(
+            date.fromisoformat(input["date"]), datetime.min.time(), timezone.utc
+        )
+
+    return None
+
+
+def split_window(timeMin, timeMax, count):
+    """Splits the window from timeMin to timeMax (RFC3339 timestamps) into count
+    equal, adjoining sub-windows, returned as (timeMin, timeMax) tuples in
+    order."""
+    start = rfc3339_to_datetime(timeMin)
+    step = (rfc3339_to_datetime(timeMax) - start) / count
+
+    # inner bounds are given in UTC; the outer ones are kept as they were
+    bounds = [
+        datetime_to_rfc3339(
+            (start + step * i).astimezone(timezone.utc).replace(tzinfo=None)
+        )
+        for i in range(1, count)
+    ]
+    bounds = [timeMin] + bounds + [timeMax]
+
+    return list(zip(bounds, bounds[1:]))
@@ -28,4 +28,8 @@ setup(
         "google-auth-httplib2==0.1.0",
         "google-auth-oauthlib==0.5.2",
     ],
+    extras_require={
+        # for the async backend (backend: async in py-calsync.yaml)
+        "async": ["aiohttp"],
+    },
 )
@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+
+from calsync.service import SyncTokenExpiredError
+
+aiohttp = pytest.importorskip("aiohttp")
+from aiohttp import web  # noqa: E402
+
+from calsync.async_service import AsyncCalendarService  # noqa: E402
+from calsync.async_service import AsyncHttpError  # noqa: E402
+
+
+class FakeCredentials:
+    valid = True
+
+    def apply(self, headers):
+        headers["authorization"] = "Bearer token"
+
+
+def __run_with_server(routes, test):
+    """Starts a localhost server with routes, and runs test(service) against
+    an AsyncCalendarService pointed at it."""
+
+    async def run():
+        app = web.Application()
+        app.add_routes(routes)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        try:
+            async with AsyncCalendarService(
+                FakeCredentials(), base_url=f"http://127.0.0.1:{port}"
+            ) as service:
+                return await test(service)
+        finally:
+            await runner.cleanup()
+
+    return asyncio.run(run())
+
+
+def test_list_events_follows_pages():
+    requests = []
+
+    async def list_events(request):
+        requests.append(dict(request.query))
+        assert request.headers["authorization"] == "Bearer token"
+
+        if "pageToken" not in request.query:
+            return web.json_response({"items": [{"id": "1"}], "nextPageToken": "p2"})
+        return web.json_response({"items": [{"id": "2"}]})
+
+    async def test(service):
+        return [
+            e["id"]
+            async for e in service.list_events(
+                calendarId="cal@example.com", singleEvents=False, timeMax=None
+            )
+        ]
+
+    result = __run_with_server(
+        [web.get("/calendars/cal@example.com/events", list_events)], test
+    )
+
+    assert result == ["1", "2"]
+    assert requests == [
+        {"singleEvents": "false", "maxResults": "2500"},
+        {"singleEvents": "false", "maxResults": "2500", "pageToken": "p2"},
+    ]
+
+
+def test_import_and_delete_event():
+    async def import_event(request):
+        body = await request.json()
+        return web.json_response(dict(body, id="new"))
+
+    async def delete_event(request):
+        assert request.match_info["event_id"] == "old"
+        return web.Response(status=204)
+
+    async def test(service):
+        imported = await service.import_event(
+            calendarId="calid", body={"summary": "foo"}
+        )
+        deleted = await service.delete_event(calendarId="calid", eventId="old")
+        return imported, deleted
+
+    result = __run_with_server(
+        [
+            web.post("/calendars/calid/events/import", import_event),
+            web.delete("/calendars/calid/events/{event_id}", delete_event),
+        ],
+        test,
+    )
+
+    assert result == ({"summary": "foo", "id": "new"}, None)
+
+
+def test_sync_events_expired_token():
+    async def list_events(request):
+        return web.json_response({"error": "gone"}, status=410)
+
+    async def test(service):
+        with pytest.raises(SyncTokenExpiredError):
+            await service.sync_events(calendarId="calid", syncToken="old")
+
+        with pytest.raises(AsyncHttpError):
+            await service.import_event(calendarId="calid", body={})
+
+    __run_with_server([web.get("/calendars/calid/events", list_events)], test)
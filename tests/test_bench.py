@@ -0,0 +1,52 @@
+from datetime import datetime
+
+from calsync.bench import generate_events
+from calsync.bench import measure_startup
+from calsync.bench import run_benchmark
+from calsync.bench import SKIPPED_FRACTION
+from calsync.service import BATCH_SIZE
+
+
+def test_generate_events_mix():
+    now = datetime(2022, 6, 1)
+    events = generate_events(1000, now)
+
+    assert generate_events(1000, now) == events
+    assert len({e["iCalUID"] for e in events}) == 1000
+
+    all_day = [e for e in events if "date" in e["start"]]
+    recurring = [e for e in events if "recurrence" in e]
+    assert 50 < len(all_day) < 150
+    assert 20 < len(recurring) < 80
+
+
+def test_run_benchmark_copy():
+    result = run_benchmark(100, "copy")
+
+    assert result["events"] == 100
+    assert result["events_per_second"] > 0
+
+    # every event not filtered out is imported, in batches, after listing the
+    # calendars, src and dst's existing copies
+    events = generate_events(100, datetime.utcnow())
+    imported = sum(not e["summary"].startswith("Skipped") for e in events)
+    assert imported > 100 * (1 - SKIPPED_FRACTION * 3)
+    assert result["api_calls"] == 1 + 1 + 1 + imported
+    assert result["http_requests"] == 1 + 1 + 1 + -(-imported // BATCH_SIZE)
+    assert set(result["phases"]) == {"list", "filter", "transform", "write"}
+
+
+def test_run_benchmark_remove_deleted():
+    result = run_benchmark(100, "remove_deleted")
+
+    assert set(result["phases"]) == {"list", "filter", "write"}
+    # calendar list, src and dst lists, and deletes of the deleted events that
+    # aren't all-day
+    assert 3 < result["api_calls"] <= 3 + 10
+
+
+def test_measure_startup():
+    startup = measure_startup(repeat=1)
+
+    assert set(startup) == {"total", "import", "service"}
+    assert startup["total"] > startup["import"] + startup["service"]
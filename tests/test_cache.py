@@ -0,0 +1,155 @@
+from unittest.mock import Mock
+
+from calsync.cache import EventCache
+from calsync.calendar import Calendar
+from calsync.event import Event
+
+
+def __event(id_, start, end, **kwargs):
+    return Event(id=id_, start={"dateTime": start}, end={"dateTime": end}, **kwargs)
+
+
+def test_list_events_cached():
+    calendar = Mock(spec=Calendar, id="calid")
+    calendar.list_events = Mock(
+        return_value=[__event("1", "2020-01-02T00:00:00Z", "2020-01-02T01:00:00Z")]
+    )
+
+    cache = EventCache()
+    first = cache.list_events(
+        calendar, timeMin="2020-01-01T00:00:00Z", timeMax="2020-02-01T00:00:00Z"
+    )
+    second = cache.list_events(
+        calendar, timeMin="2020-01-01T00:00:00Z", timeMax="2020-02-01T00:00:00Z"
+    )
+
+    assert first is second
+    calendar.list_events.assert_called_once_with(
+        timeMin="2020-01-01T00:00:00Z",
+        timeMax="2020-02-01T00:00:00Z",
+        singleEvents=True,
+        orderBy="startTime",
+        shards=1,
+        fields=None,
+    )
+
+
+def test_list_events_narrower_window_filtered_locally():
+    before = __event("before", "2020-01-01T10:00:00Z", "2020-01-01T11:00:00Z")
+    spanning = __event("spanning", "2020-01-09T23:00:00Z", "2020-01-10T01:00:00Z")
+    inside = __event("inside", "2020-01-15T10:00:00Z", "2020-01-15T11:00:00Z")
+    after = __event("after", "2020-01-25T10:00:00Z", "2020-01-25T11:00:00Z")
+    recurring = __event(
+        "recurring",
+        "2020-01-01T10:00:00Z",
+        "2020-01-01T11:00:00Z",
+        recurrence=["RRULE:FREQ=DAILY"],
+    )
+    all_day = Event(
+        id="all_day", start={"date": "2020-01-12"}, end={"date": "2020-01-13"}
+    )
+
+    calendar = Mock(spec=Calendar, id="calid")
+    calendar.list_events = Mock(
+        return_value=[before, spanning, inside, after, recurring, all_day]
+    )
+
+    cache = EventCache()
+    cache.list_events(
+        calendar, timeMin="2020-01-01T00:00:00Z", timeMax="2020-02-01T00:00:00Z"
+    )
+    result = cache.list_events(
+        calendar, timeMin="2020-01-10T00:00:00Z", timeMax="2020-01-20T00:00:00Z"
+    )
+
+    assert [e.id for e in result] == ["spanning", "inside", "recurring", "all_day"]
+    assert calendar.list_events.call_count == 1
+
+
+def test_list_events_wider_window_fetched():
+    calendar = Mock(spec=Calendar, id="calid")
+    calendar.list_events = Mock(return_value=[])
+
+    cache = EventCache()
+    cache.list_events(
+        calendar, timeMin="2020-01-10T00:00:00Z", timeMax="2020-01-20T00:00:00Z"
+    )
+    cache.list_events(
+        calendar, timeMin="2020-01-01T00:00:00Z", timeMax="2020-01-20T00:00:00Z"
+    )
+    cache.list_events(
+        calendar,
+        timeMin="2020-01-10T00:00:00Z",
+        timeMax="2020-01-20T00:00:00Z",
+        singleEvents=False,
+    )
+
+    assert calendar.list_events.call_count == 3
+
+
+def test_iter_events_streams_unshared_calendars():
+    events = [
+        __event(str(i), "2020-01-02T00:00:00Z", "2020-01-02T01:00:00Z")
+        for i in range(5)
+    ]
+
+    calendar = Mock(spec=Calendar, id="calid")
+    calendar.iter_events = Mock(side_effect=lambda **kwargs: iter(events))
+    calendar.list_events = Mock(return_value=events)
+
+    cache = EventCache()
+    chunks = list(cache.iter_events(calendar, chunk_size=2))
+
+    assert chunks == [events[0:2], events[2:4], events[4:]]
+    calendar.list_events.assert_not_called()
+    assert cache.entries == {}
+
+    # shared calendars are listed and cached, and cached windows are reused
+    cache.shared_calendars["calid"] = None
+    assert list(cache.iter_events(calendar, chunk_size=5)) == [events]
+    cache.shared_calendars.clear()
+    assert list(cache.iter_events(calendar, chunk_size=5)) == [events]
+
+    calendar.list_events.assert_called_once()
+    calendar.iter_events.assert_called_once()
+
+
+def test_list_events_fields_covered():
+    calendar = Mock(spec=Calendar, id="calid")
+    calendar.list_events = Mock(return_value=[])
+    cache = EventCache()
+    window = dict(timeMin="2020-01-01T00:00:00Z", timeMax="2020-02-01T00:00:00Z")
+
+    # events listed with some fields stand in for requests for fewer of them
+    cache.list_events(calendar, fields=["id", "summary"], **window)
+    cache.list_events(calendar, fields=["id"], **window)
+    assert calendar.list_events.call_count == 1
+
+    # but not for requests for others, or for every field
+    cache.list_events(calendar, fields=["id", "description"], **window)
+    cache.list_events(calendar, **window)
+    assert calendar.list_events.call_count == 3
+
+    # events listed with every field stand in for any request
+    cache.list_events(calendar, fields=["location"], **window)
+    assert calendar.list_events.call_count == 3
+
+
+def test_list_events_shared_calendar_fields():
+    calendar = Mock(spec=Calendar, id="calid")
+    calendar.list_events = Mock(return_value=[])
+    cache = EventCache()
+    cache.shared_calendars["calid"] = frozenset(["id", "summary", "location"])
+
+    # shared calendars are listed with every field their rules need
+    cache.list_events(calendar, fields=["id"])
+    cache.list_events(calendar, fields=["summary", "location"])
+
+    calendar.list_events.assert_called_once_with(
+        timeMin=None,
+        timeMax=None,
+        singleEvents=True,
+        orderBy="startTime",
+        shards=1,
+        fields=frozenset(["id", "summary", "location"]),
+    )
@@ -4,6 +4,7 @@ from unittest.mock import patch
 from calsync.calendar import get_calendars, Calendar
 from calsync.event import Event
 from calsync.service import CalendarService
+from calsync.service import SyncTokenExpiredError
 
 
 def test_get_calendars():
@@ -72,6 +73,35 @@ def test_list_events():
     assert result == expected_result
 
 
+def test_list_events_sharded():
+    # "spanning" crosses the boundary between the two halves, so is listed in both
+    shard_results = {
+        "2020-01-01T00:00:00Z": [{"summary": "early", "id": "1"}, {"id": "spanning"}],
+        "2020-01-16T00:00:00Z": [{"id": "spanning"}, {"summary": "late", "id": "2"}],
+    }
+
+    calendar_service = Mock()
+    calendar_service.list_events = Mock(
+        side_effect=lambda timeMin, **kwargs: shard_results[timeMin]
+    )
+
+    get_calendar_service = Mock(return_value=calendar_service)
+
+    with patch("calsync.calendar.get_calendar_service", get_calendar_service):
+        result = Calendar(id="calid").list_events(
+            timeMin="2020-01-01T00:00:00Z", timeMax="2020-01-31T00:00:00Z", shards=2
+        )
+
+    assert [e.id for e in result] == ["1", "spanning", "2"]
+    assert sorted(
+        (c.kwargs["timeMin"], c.kwargs["timeMax"])
+        for c in calendar_service.list_events.mock_calls
+    ) == [
+        ("2020-01-01T00:00:00Z", "2020-01-16T00:00:00Z"),
+        ("2020-01-16T00:00:00Z", "2020-01-31T00:00:00Z"),
+    ]
+
+
 def test_import_event():
     import_event_result = {
         "summary": "foo",
@@ -91,3 +121,101 @@ def test_import_event():
         result = Calendar(id="calid").import_event(expected_result)
 
     assert result == expected_result
+
+
+def test_sync_events():
+    calendar_service = Mock()
+    calendar_service.sync_events = Mock(
+        return_value=([{"summary": "foo", "id": "foo"}], "token2")
+    )
+
+    get_calendar_service = Mock(return_value=calendar_service)
+
+    with patch("calsync.calendar.get_calendar_service", get_calendar_service):
+        result = Calendar(id="calid").sync_events(syncToken="token1")
+
+    assert result == ([Event(summary="foo", id="foo", calendarId="calid")], "token2")
+    calendar_service.sync_events.assert_called_once_with(
+        calendarId="calid",
+        syncToken="token1",
+        singleEvents=True,
+        showDeleted=True,
+        fields=None,
+    )
+
+
+def test_sync_events_expired_token():
+    calendar_service = Mock()
+    calendar_service.sync_events = Mock(
+        side_effect=[
+            SyncTokenExpiredError("gone"),
+            ([{"summary": "foo", "id": "foo"}], "token2"),
+        ]
+    )
+
+    get_calendar_service = Mock(return_value=calendar_service)
+
+    with patch("calsync.calendar.get_calendar_service", get_calendar_service):
+        result = Calendar(id="calid").sync_events(
+            syncToken="token1", timeMin="min", timeMax="max"
+        )
+
+    assert result == ([Event(summary="foo", id="foo", calendarId="calid")], "token2")
+    calendar_service.sync_events.assert_called_with(
+        calendarId="calid",
+        timeMin="min",
+        timeMax="max",
+        singleEvents=True,
+        fields=None,
+    )
+
+
+def test_import_event_records_mapping():
+    source = Event(id="src1", summary="foo", calendarId="srccal")
+
+    calendar_service = Mock()
+    calendar_service.import_event = Mock(return_value={"id": "dst1", "summary": "foo"})
+
+    get_calendar_service = Mock(return_value=calendar_service)
+    state = Mock()
+
+    with patch("calsync.calendar.get_calendar_service", get_calendar_service):
+        with patch("calsync.calendar.get_state_store", Mock(return_value=state)):
+            result = Calendar(id="calid").import_event(source.copy(), source=source)
+
+    assert result.id == "dst1"
+    state.set_event_mapping.assert_called_once_with(
+        "srccal",
+        "src1",
+        "calid",
+        "dst1",
+        source.copy().fingerprint(),
+        source.copy().attributes,
+    )
+
+
+def test_import_event_batched():
+    source = Event(id="src1", summary="foo", calendarId="srccal")
+
+    batch = Mock()
+    batch.import_event = Mock(
+        side_effect=lambda callback, **kw: callback({"id": "dst1"}, None)
+    )
+    callback = Mock()
+    state = Mock()
+
+    with patch("calsync.calendar.get_state_store", Mock(return_value=state)):
+        result = Calendar(id="calid").import_event(
+            source.copy(), source=source, batch=batch, callback=callback
+        )
+
+    assert result is None
+    callback.assert_called_once_with(Event(id="dst1", calendarId="calid"), None)
+    state.set_event_mapping.assert_called_once_with(
+        "srccal",
+        "src1",
+        "calid",
+        "dst1",
+        source.copy().fingerprint(),
+        source.copy().attributes,
+    )
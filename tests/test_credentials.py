@@ -0,0 +1,117 @@
+from datetime import datetime
+from datetime import timedelta
+import json
+import threading
+import time
+from unittest.mock import patch
+
+from google.oauth2.credentials import Credentials
+import pytest
+
+from calsync.credentials import CredentialManager
+
+
+def __write_token(path, token, expires_in, refresh_token="refresh"):
+    expiry = datetime.utcnow() + expires_in
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "token": token,
+                "refresh_token": refresh_token,
+                "client_id": "client",
+                "client_secret": "secret",
+                "token_uri": "https://oauth2.example.com/token",
+                "expiry": expiry.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            },
+            f,
+        )
+
+
+def __refresh(credentials, request):
+    # slow enough for every thread to be waiting on it
+    time.sleep(0.1)
+    credentials.token = f"refreshed {credentials.token}"
+    credentials.expiry = datetime.utcnow() + timedelta(hours=1)
+
+
+@pytest.fixture
+def refresh():
+    with patch.object(
+        Credentials, "refresh", autospec=True, side_effect=__refresh
+    ) as refresh:
+        yield refresh
+
+
+@pytest.fixture
+def token_file(tmp_path):
+    return str(tmp_path / "token.json")
+
+
+def test_fresh_token_is_used_as_is(token_file, refresh):
+    __write_token(token_file, "a", timedelta(hours=1))
+    manager = CredentialManager(token_file)
+
+    try:
+        assert manager.get().token == "a"
+        assert manager.get() is manager.get()
+        refresh.assert_not_called()
+    finally:
+        manager.stop()
+
+
+def test_expired_token_is_refreshed_once(token_file, refresh):
+    __write_token(token_file, "a", timedelta(hours=-1))
+    manager = CredentialManager(token_file)
+    tokens = []
+
+    threads = [
+        threading.Thread(target=lambda: tokens.append(manager.get().token))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    manager.stop()
+
+    assert tokens == ["refreshed a"] * 8
+    refresh.assert_called_once()
+
+    # the refreshed token is saved for other processes
+    with open(token_file) as f:
+        assert json.load(f)["token"] == "refreshed a"
+
+
+def test_token_refreshed_by_another_process_is_used(token_file, refresh):
+    __write_token(token_file, "a", timedelta(minutes=5))
+    manager = CredentialManager(token_file)
+    credentials = Credentials.from_authorized_user_file(token_file)
+    manager.credentials = credentials
+
+    # with its refresh token rotated
+    __write_token(token_file, "b", timedelta(hours=1), refresh_token="rotated")
+    manager.refresh()
+
+    assert manager.credentials is credentials
+    assert credentials.token == "b"
+    assert credentials.refresh_token == "rotated"
+    refresh.assert_not_called()
+
+
+def test_token_is_refreshed_ahead_of_expiry(token_file, refresh):
+    # valid, but inside the refresh margin
+    __write_token(token_file, "a", timedelta(minutes=5))
+    manager = CredentialManager(token_file)
+
+    try:
+        credentials = manager.get()
+        assert credentials.token == "a"
+
+        deadline = time.monotonic() + 5
+        while credentials.token == "a" and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        assert credentials.token == "refreshed a"
+        assert manager.get_refresh_wait() > 0
+    finally:
+        manager.stop()
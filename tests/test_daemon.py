@@ -0,0 +1,181 @@
+from datetime import datetime
+from datetime import timedelta
+import threading
+import time
+from unittest.mock import Mock
+from unittest.mock import patch
+
+import pytest
+
+from calsync.calendar import clear_calendars
+from calsync.calendar import resolve_calendar
+from calsync.daemon import Daemon
+from calsync.fake_server import FakeCalendarServer
+from calsync.service import set_api_endpoint
+from calsync.state import set_state_store
+from calsync.state import StateStore
+from calsync.util import datetime_to_rfc3339
+
+
+def __wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def server():
+    with FakeCalendarServer() as server:
+        server.add_calendar("src@example.com", summary="Source")
+        server.add_calendar("dst@example.com", summary="Destination")
+        server.add_calendar("other@example.com", summary="Other")
+        set_api_endpoint(server.url)
+        clear_calendars()
+        set_state_store(StateStore(":memory:"))
+
+        with patch("calsync.service.backoff_delay", return_value=0):
+            yield server
+
+        set_api_endpoint(None)
+        clear_calendars()
+        set_state_store(None)
+
+
+def __add_event(server, n):
+    start = datetime.utcnow().replace(microsecond=0) + timedelta(days=1, hours=n)
+    server.add_event(
+        "src@example.com",
+        summary=f"event {n}",
+        iCalUID=f"{n}@example.com",
+        start={"dateTime": datetime_to_rfc3339(start)},
+        end={"dateTime": datetime_to_rfc3339(start + timedelta(hours=1))},
+    )
+
+
+def test_daemon_runs_rules_on_notifications(server):
+    config = {
+        "requests_per_second": 0,
+        "daemon": {"listen_port": 0, "poll_interval": 3600, "debounce": 0},
+        "rules": [
+            {"method": "copy", "src": "Source", "dst": "Destination", "delta": True},
+            {"method": "copy", "src": "Other", "dst": "Destination"},
+        ],
+    }
+    __add_event(server, 0)
+
+    with Daemon(config) as daemon:
+        assert [c["calendarId"] for c in server.channels.values()] == [
+            "other@example.com",
+            "src@example.com",
+        ]
+
+        thread = threading.Thread(target=daemon.run_forever)
+        thread.start()
+        try:
+            # every rule runs on start
+            __wait_for(lambda: len(server.get_events("dst@example.com")) == 1)
+
+            scheduler = daemon.scheduler
+            with patch.object(scheduler, "run", wraps=scheduler.run) as run:
+                __add_event(server, 1)
+                __wait_for(lambda: len(server.get_events("dst@example.com")) == 2)
+
+            # only the rule reading the changed calendar ran
+            run.assert_called_once_with([config["rules"][0]])
+
+        finally:
+            daemon.stop()
+            thread.join()
+
+    assert server.channels == {}
+
+
+def test_daemon_runs_rules_on_its_own_threads(server):
+    config = {
+        "daemon": {"listen_port": 0, "watch": False},
+        "rules": [{"method": "copy", "src": "Source", "dst": "Destination"}],
+    }
+
+    with Daemon(config) as daemon, patch("calsync.daemon.run_rules") as run_rules:
+        daemon.run(config["rules"])
+        daemon.run(config["rules"])
+        executor = daemon.executor
+
+    # every run shares one pool, so its threads' services stay warm
+    assert executor is not None
+    assert [c.kwargs["executor"] for c in run_rules.mock_calls] == [executor] * 2
+    assert daemon.executor is None
+
+
+def test_daemon_rejects_unknown_notifications(server):
+    config = {"rules": [{"method": "copy", "src": "Source", "dst": "Destination"}]}
+    daemon = Daemon(config)
+    daemon.channels["1"] = {"id": "1", "calendarId": "src@example.com"}
+    daemon.scheduler = Mock()
+
+    assert not daemon.notify("1", "wrong", "exists")
+    assert not daemon.notify("2", daemon.token, "exists")
+    assert daemon.notify("1", daemon.token, "sync")
+    daemon.scheduler.changed.assert_not_called()
+
+    assert daemon.notify("1", daemon.token, "exists")
+    daemon.scheduler.changed.assert_called_once_with("src@example.com")
+
+
+def test_daemon_accepts_notifications_while_opening_channels(server):
+    config = {
+        "daemon": {"address": "https://calsync.example.com/notifications"},
+        "rules": [
+            {"method": "copy", "src": "Source", "dst": "Destination"},
+            {"method": "copy", "src": "Other", "dst": "Destination"},
+        ],
+    }
+    daemon = Daemon(config)
+    daemon.scheduler = Mock()
+    synced = []
+
+    def watch_events(calendar, channel_id, address, token=None, ttl=None):
+        if calendar.id == "other@example.com":
+            raise ValueError("can't watch")
+
+        # the API can send the "sync" notification before it responds
+        synced.append(daemon.notify(channel_id, token, "sync"))
+        expiration = int((time.time() + 3600) * 1000)
+        return {"id": channel_id, "resourceId": "r", "expiration": str(expiration)}
+
+    with patch("calsync.calendar.Calendar.watch_events", watch_events):
+        daemon.watch()
+
+    assert synced == [True]
+    assert [c["calendarId"] for c in daemon.channels.values()] == ["src@example.com"]
+
+
+def test_daemon_renews_short_lived_channels_halfway(server):
+    config = {
+        "daemon": {"listen_port": 0, "channel_ttl": 120},
+        "rules": [{"method": "copy", "src": "Source", "dst": "Destination"}],
+    }
+
+    with Daemon(config) as daemon:
+        (channel,) = daemon.channels.values()
+        renew_in = channel["renew_at"] - time.monotonic()
+
+    # rather than CHANNEL_RENEW_MARGIN before expiry, which has already passed
+    assert 50 < renew_in <= 60
+
+    with pytest.raises(ValueError):
+        Daemon({**config, "daemon": {"channel_ttl": 10}})
+
+
+def test_get_sources(server):
+    rules = [
+        {"method": "copy", "src": "Source", "dst": "Destination"},
+        {"method": "copy", "src": ["Other", "Source"], "dst": "Destination"},
+        {"method": "remove_deleted", "src": "Other", "dst": "Destination"},
+    ]
+    daemon = Daemon({"rules": rules})
+
+    assert daemon.get_sources() == {
+        resolve_calendar(c).id for c in ("Source", "Other", "Destination")
+    }
@@ -0,0 +1,118 @@
+from datetime import datetime
+from datetime import timezone
+
+from calsync.event import Event
+from calsync.event import event_patch
+from calsync.event import FINGERPRINT_PROPERTY
+
+
+def test_fingerprint_ignores_stored_fingerprint():
+    event = Event(id="123", summary="Event 123", calendarId="foo")
+    fingerprint = event.fingerprint()
+
+    event.set_private_property(FINGERPRINT_PROPERTY, fingerprint)
+
+    assert event.fingerprint() == fingerprint
+    assert event.get_private_property(FINGERPRINT_PROPERTY) == fingerprint
+    assert Event(id="123", summary="Event 123", calendarId="bar").fingerprint() == (
+        fingerprint
+    )
+
+
+def test_fingerprint_changes_with_content():
+    event = Event(id="123", summary="Event 123", description="foo")
+
+    assert event.fingerprint() != (
+        Event(id="123", summary="Event 123", description="bar").fingerprint()
+    )
+
+
+def api_event():
+    return {
+        "kind": "calendar#event",
+        "etag": '"3181161784712000"',
+        "id": "123",
+        "status": "confirmed",
+        "summary": "Event 123",
+        "description": "Some description",
+        "organizer": {"email": "foo@example.com", "displayName": "Foo"},
+        "start": {"dateTime": "2022-06-01T10:00:00Z"},
+        "end": {"date": "2022-06-02"},
+        "iCalUID": "123@example.com",
+        "sequence": 0,
+    }
+
+
+def test_from_api():
+    event = Event.from_api("foo", api_event())
+
+    assert not hasattr(event, "__dict__")
+    assert event.id == "123"
+    assert event.iCalUID == "123@example.com"
+    assert event.recurrence is None
+    assert event.get("organizer")["displayName"] == "Foo"
+    assert event.get("description") == "Some description"
+    assert event.get("recurrence", []) == []
+    assert event.start_time == datetime(2022, 6, 1, 10, tzinfo=timezone.utc)
+    assert event.end_time == datetime(2022, 6, 2, tzinfo=timezone.utc)
+
+    assert event.attributes == {"calendarId": "foo", **api_event()}
+    assert event == Event(calendarId="foo", **api_event())
+
+
+def test_attributes_changes_are_kept():
+    event = Event.from_api("foo", api_event())
+    event.attributes["description"] = "Changed"
+
+    assert event.get("description") == "Changed"
+    assert event.attributes["description"] == "Changed"
+
+
+def test_copy_skips_fields():
+    expected = {
+        "calendarId": "foo",
+        "kind": "calendar#event",
+        "status": "confirmed",
+        "summary": "Event 123",
+        "description": "Some description",
+        "start": {"dateTime": "2022-06-01T10:00:00Z"},
+        "end": {"date": "2022-06-02"},
+        "iCalUID": "123@example.com",
+    }
+
+    # copied both before and after the event's fields are decoded
+    event = Event.from_api("foo", api_event())
+    assert event.copy().id is None
+    assert event.copy().attributes == expected
+    assert event.attributes["id"] == "123"
+    assert event.copy().attributes == expected
+
+    copy = event.copy()
+    copy.attributes["description"] = "Changed"
+    assert event.attributes["description"] == "Some description"
+
+
+def test_event_patch():
+    old = {
+        "summary": "foo",
+        "location": "Room 1",
+        "start": {"date": "2022-06-01"},
+        "extendedProperties": {"private": {"a": "1", "b": "2"}},
+        "recurrence": ["RRULE:FREQ=DAILY"],
+    }
+    new = {
+        "summary": "foo",
+        "description": "bar",
+        "start": {"dateTime": "2022-06-01T10:00:00Z"},
+        "extendedProperties": {"private": {"a": "1", "b": "3"}},
+        "recurrence": ["RRULE:FREQ=WEEKLY"],
+    }
+
+    assert event_patch(old, new) == {
+        "description": "bar",
+        "location": None,
+        "start": {"date": None, "dateTime": "2022-06-01T10:00:00Z"},
+        "extendedProperties": {"private": {"b": "3"}},
+        "recurrence": ["RRULE:FREQ=WEEKLY"],
+    }
+    assert event_patch(new, new) == {}
@@ -0,0 +1,731 @@
+import asyncio
+from datetime import datetime
+from datetime import timedelta
+from unittest.mock import Mock
+from unittest.mock import patch
+
+import pytest
+
+from calsync.calendar import Calendar
+from calsync.calendar import clear_calendars
+from calsync.event import Event
+from calsync.fake_server import FakeCalendarServer
+from calsync.fake_server import parse_fields
+from calsync.fake_server import select_fields
+from calsync.rules.rules import run_rules
+from calsync.service import get_calendar_service
+from calsync.service import set_api_endpoint
+from calsync.service import SyncTokenExpiredError
+from calsync.state import set_state_store
+from calsync.state import StateStore
+from calsync.util import datetime_to_rfc3339
+
+
+def __event(n, **attributes):
+    return {
+        "summary": f"event {n}",
+        "iCalUID": f"{n}@example.com",
+        "start": {"dateTime": f"2022-06-{n:02}T10:00:00Z"},
+        "end": {"dateTime": f"2022-06-{n:02}T11:00:00Z"},
+        **attributes,
+    }
+
+
+@pytest.fixture
+def server():
+    with FakeCalendarServer() as server:
+        server.add_calendar("src@example.com", summary="Source")
+        server.add_calendar("dst@example.com", summary="Destination")
+        set_api_endpoint(server.url)
+
+        # retry straight away rather than backing off
+        with patch("calsync.ratelimit.backoff_delay", return_value=0), patch(
+            "calsync.service.backoff_delay", return_value=0
+        ):
+            yield server
+
+        set_api_endpoint(None)
+
+
+def test_list_calendars(server):
+    calendars = list(get_calendar_service().list_calendars())
+
+    assert [c["summary"] for c in calendars] == ["Source", "Destination"]
+
+
+def test_list_events_pages_and_filters_window(server):
+    for n in range(1, 11):
+        server.add_event("src@example.com", **__event(n))
+
+    events = list(
+        get_calendar_service().list_events(
+            calendarId="src@example.com",
+            timeMin="2022-06-03T00:00:00Z",
+            timeMax="2022-06-08T00:00:00Z",
+            maxResults=2,
+            orderBy="startTime",
+            singleEvents=True,
+        )
+    )
+
+    assert [e["summary"] for e in events] == [f"event {n}" for n in range(3, 8)]
+    assert server.stats["methods"] == {"events.list": 3}
+
+
+def test_partial_responses(server):
+    server.add_event("src@example.com", **__event(1, location="Room 1"))
+    calendar = Calendar(id="src@example.com")
+
+    events = calendar.list_events(timeMin=None, fields=["summary", "start"])
+
+    assert [e.attributes for e in events] == [
+        {
+            "calendarId": "src@example.com",
+            "summary": "event 1",
+            "start": {"dateTime": "2022-06-01T10:00:00Z"},
+        }
+    ]
+
+    fields = parse_fields("kind,items(id,start/dateTime),etag")
+    assert fields == {
+        "kind": None,
+        "items": {"id": None, "start": {"dateTime": None}},
+        "etag": None,
+    }
+    assert select_fields(
+        {
+            "kind": "calendar#events",
+            "items": [{"id": "1", "start": {"dateTime": "x", "timeZone": "UTC"}}],
+            "nextPageToken": "2",
+        },
+        fields,
+    ) == {"kind": "calendar#events", "items": [{"id": "1", "start": {"dateTime": "x"}}]}
+
+
+def test_sync_tokens(server):
+    calendar = Calendar(id="src@example.com")
+    server.add_event("src@example.com", **__event(1))
+
+    events, token = calendar.sync_events()
+    assert [e.summary for e in events] == ["event 1"]
+
+    server.add_event("src@example.com", **__event(2))
+    events, token = calendar.sync_events(syncToken=token)
+    assert [e.summary for e in events] == ["event 2"]
+
+    get_calendar_service().delete_event(
+        calendarId="src@example.com", eventId=events[0].id
+    )
+    events, token = calendar.sync_events(syncToken=token)
+    assert [(e.summary, e.attributes["status"]) for e in events] == [
+        ("event 2", "cancelled")
+    ]
+
+    server.expire_sync_tokens()
+    with pytest.raises(SyncTokenExpiredError):
+        get_calendar_service().sync_events(
+            calendarId="src@example.com", syncToken=token
+        )
+
+
+def test_batch_imports_and_deletes(server):
+    calendar = Calendar(id="dst@example.com")
+    responses = []
+
+    with patch("calsync.calendar.get_state_store"):
+        with get_calendar_service().new_batch(batch_size=3) as batch:
+            for n in range(1, 6):
+                calendar.import_event(
+                    Event(**__event(n)),
+                    batch=batch,
+                    callback=lambda response, ex: responses.append((response, ex)),
+                )
+
+    assert [(r.summary, ex) for r, ex in responses] == [
+        (f"event {n}", None) for n in range(1, 6)
+    ]
+    assert len(server.get_events("dst@example.com")) == 5
+    assert server.stats["batches"] == 2
+    assert server.stats["methods"] == {"events.import": 5}
+
+    # importing the same iCalUID again updates the existing event
+    calendar.import_event(Event(**__event(1, summary="renamed")))
+    assert [e["summary"] for e in server.get_events("dst@example.com")][0] == "renamed"
+
+    with patch("calsync.calendar.get_state_store"):
+        with get_calendar_service().new_batch() as batch:
+            for r, _ in responses[:2]:
+                calendar.delete_event(r, batch=batch)
+
+    assert len(server.get_events("dst@example.com")) == 3
+
+
+def test_injected_errors_are_retried(server):
+    server.add_event("src@example.com", **__event(1))
+    server.fail_next(status=503, count=2)
+
+    events = list(get_calendar_service().list_events(calendarId="src@example.com"))
+
+    assert len(events) == 1
+    assert server.stats["errors"] == 2
+    assert server.stats["calls"] == 3
+
+
+def test_quota(server):
+    server.quota = 2
+    service = get_calendar_service()
+    service.max_attempts = 1
+
+    results = []
+    for _ in range(3):
+        try:
+            list(service.list_events(calendarId="src@example.com"))
+            results.append(200)
+        except Exception as ex:
+            results.append(ex.resp.status)
+
+    assert results == [200, 200, 403]
+
+
+def test_async_service(server):
+    aiohttp = pytest.importorskip("aiohttp")  # noqa: F841
+
+    from calsync.async_service import AsyncCalendarService
+    from calsync.service import get_credentials
+
+    async def run():
+        async with AsyncCalendarService(get_credentials()) as service:
+            await service.import_event("src@example.com", __event(1))
+            await service.import_event("src@example.com", __event(2))
+            return [e async for e in service.list_events("src@example.com")]
+
+    events = asyncio.run(run())
+
+    assert [e["summary"] for e in events] == ["event 1", "event 2"]
+    assert server.stats["methods"] == {"events.import": 2, "events.list": 1}
+
+
+def test_async_service_refreshes_through_credential_manager(server):
+    aiohttp = pytest.importorskip("aiohttp")  # noqa: F841
+
+    from google.auth.credentials import AnonymousCredentials
+
+    from calsync.async_service import AsyncCalendarService
+    from calsync.credentials import set_credential_manager
+
+    expired = Mock(valid=False)
+    manager = Mock()
+    manager.get.return_value = AnonymousCredentials()
+
+    async def run():
+        async with AsyncCalendarService(expired) as service:
+            await asyncio.gather(
+                *(service.import_event("src@example.com", __event(n)) for n in (1, 2))
+            )
+
+    set_credential_manager(manager)
+    try:
+        asyncio.run(run())
+    finally:
+        set_credential_manager(None)
+
+    # refreshed once, by the manager, which saves the token for other processes
+    manager.get.assert_called_once()
+    expired.refresh.assert_not_called()
+    assert len(server.get_events("src@example.com")) == 2
+
+
+def test_async_copy_rule_streams_pages(server):
+    aiohttp = pytest.importorskip("aiohttp")  # noqa: F841
+
+    start = datetime.utcnow().replace(microsecond=0) + timedelta(days=1)
+    for n in range(6):
+        server.add_event(
+            "src@example.com",
+            summary=f"event {n}",
+            iCalUID=f"{n}@example.com",
+            start={"dateTime": datetime_to_rfc3339(start + timedelta(hours=n))},
+            end={"dateTime": datetime_to_rfc3339(start + timedelta(hours=n + 1))},
+        )
+
+    # slow enough that the first imports reach the server while later pages
+    # are being listed
+    server.latency = 0.05
+    requests = []
+    handle_request = server.handle_request
+
+    def record_request(method, path, headers, body):
+        requests.append("import" if method == "POST" else "list")
+        return handle_request(method, path, headers, body)
+
+    config = {
+        "backend": "async",
+        "requests_per_second": 0,
+        "rules": [{"method": "copy", "src": "Source", "dst": "Destination"}],
+    }
+
+    clear_calendars()
+    set_state_store(StateStore(":memory:"))
+    try:
+        with patch.object(server, "handle_request", record_request), patch(
+            "calsync.async_service.EVENTS_PAGE_SIZE", 2
+        ), patch("calsync.cache.EVENTS_PAGE_SIZE", 2):
+            run_rules(config)
+    finally:
+        clear_calendars()
+        set_state_store(None)
+
+    assert len(server.get_events("dst@example.com")) == 6
+
+    # imports start as soon as the first page is in, before the last is listed;
+    # the calendar list and the (empty) listing of dst's copies come first
+    event_lists = [i for i, r in enumerate(requests) if r == "list"][2:]
+    assert len(event_lists) == 3
+    assert requests.index("import") < event_lists[-1]
+
+
+def test_sharded_listing(server):
+    aiohttp = pytest.importorskip("aiohttp")  # noqa: F841
+
+    from calsync.async_calendar import get_async_calendar_resolver
+    from calsync.async_service import AsyncCalendarService
+    from calsync.service import get_credentials
+
+    for n in range(1, 11):
+        server.add_event("src@example.com", **__event(n))
+    # spans every shard boundary
+    server.add_event(
+        "src@example.com",
+        **__event(11, start={"date": "2022-06-01"}, end={"date": "2022-06-30"}),
+    )
+
+    window = dict(
+        timeMin="2022-06-01T00:00:00Z",
+        timeMax="2022-06-30T00:00:00Z",
+        orderBy="startTime",
+        maxResults=2,
+    )
+
+    sharded = Calendar(id="src@example.com").list_events(shards=3, **window)
+
+    async def run():
+        async with AsyncCalendarService(get_credentials()) as service:
+            resolve = await get_async_calendar_resolver(service)
+            return await resolve("src@example.com").list_events(shards=3, **window)
+
+    expected = Calendar(id="src@example.com").list_events(**window)
+    assert len(expected) == 11
+    assert sharded == expected
+    assert asyncio.run(run()) == expected
+
+
+@pytest.mark.parametrize("backend", ["sync", "async"])
+def test_copy_rule_patches_changed_events(server, backend):
+    if backend == "async":
+        pytest.importorskip("aiohttp")
+
+    start = datetime.utcnow().replace(microsecond=0) + timedelta(days=1)
+    for n in range(3):
+        server.add_event(
+            "src@example.com",
+            summary=f"event {n}",
+            iCalUID=f"{n}@example.com",
+            location="Room 1",
+            description="Details.",
+            start={"dateTime": datetime_to_rfc3339(start + timedelta(hours=n))},
+            end={"dateTime": datetime_to_rfc3339(start + timedelta(hours=n + 1))},
+        )
+
+    config = {
+        "backend": backend,
+        "requests_per_second": 0,
+        "rules": [
+            {
+                "method": "copy",
+                "src": "Source",
+                "dst": "Destination",
+                "transform": [{"description_append": "From $calendar_name."}],
+            }
+        ],
+    }
+
+    clear_calendars()
+    set_state_store(StateStore(":memory:"))
+    try:
+        run_rules(config)
+
+        # change one event, and delete the copy of another before changing it
+        src_events = server.get_events("src@example.com")
+        changed = {k: v for k, v in src_events[0].items() if k != "location"}
+        server.add_event("src@example.com", **dict(changed, summary="changed 0"))
+        server.add_event("src@example.com", **dict(src_events[1], summary="changed 1"))
+        copy_id = next(
+            e["id"]
+            for e in server.get_events("dst@example.com")
+            if e["iCalUID"] == "1@example.com"
+        )
+        server.events["dst@example.com"][copy_id]["status"] = "cancelled"
+
+        server.reset_stats()
+        run_rules(config)
+    finally:
+        clear_calendars()
+        set_state_store(None)
+
+    methods = server.stats["methods"]
+    assert methods["events.patch"] == 2
+    assert methods["events.import"] == 1
+
+    # the async backend imports in no particular order
+    dst_events = sorted(
+        server.get_events("dst@example.com"), key=lambda e: e["iCalUID"]
+    )
+    assert dst_events[0]["summary"] == "changed 0"
+    assert "location" not in dst_events[0]
+    assert dst_events[0]["description"] == "Details.\n\nFrom Source."
+    assert dst_events[1]["summary"] == "changed 1"
+    assert dst_events[1]["status"] == "confirmed"
+    assert dst_events[2]["summary"] == "event 2"
+
+
+@pytest.mark.parametrize("backend", ["sync", "async"])
+def test_delta_copy_rule(server, backend):
+    if backend == "async":
+        pytest.importorskip("aiohttp")
+
+    start = datetime.utcnow().replace(microsecond=0) + timedelta(days=1)
+
+    def add_event(n, start):
+        return server.add_event(
+            "src@example.com",
+            summary=f"event {n}",
+            iCalUID=f"{n}@example.com",
+            start={"dateTime": datetime_to_rfc3339(start)},
+            end={"dateTime": datetime_to_rfc3339(start + timedelta(hours=1))},
+        )
+
+    events = [add_event(n, start + timedelta(hours=n)) for n in range(3)]
+    # outside the first run's window
+    add_event(3, start + timedelta(weeks=2))
+
+    rule = {"method": "copy", "src": "Source", "dst": "Destination", "delta": True}
+    config = {"backend": backend, "requests_per_second": 0, "rules": [rule]}
+
+    clear_calendars()
+    set_state_store(StateStore(":memory:"))
+    try:
+        rule["look_forward"] = "1 week"
+        run_rules(config)
+        assert len(server.get_events("dst@example.com")) == 3
+
+        # change one event and delete another, then widen the window
+        server.add_event("src@example.com", **dict(events[0], summary="changed 0"))
+        get_calendar_service().delete_event(
+            calendarId="src@example.com", eventId=events[1]["id"]
+        )
+        rule["look_forward"] = "4 weeks"
+
+        server.reset_stats()
+        run_rules(config)
+        methods = server.stats["methods"]
+
+        server.reset_stats()
+        run_rules(config)
+    finally:
+        clear_calendars()
+        set_state_store(None)
+
+    # changes since the last run, and the part of the window that's new
+    assert methods["events.list"] == 2
+    assert methods["events.patch"] == 1
+    assert methods["events.import"] == 1
+    assert methods["events.delete"] == 1
+
+    assert sorted(e["summary"] for e in server.get_events("dst@example.com")) == [
+        "changed 0",
+        "event 2",
+        "event 3",
+    ]
+
+    # nothing has changed since, so there's nothing to write
+    assert set(server.stats["methods"]) <= {"calendarList.list", "events.list"}
+
+
+@pytest.mark.parametrize("backend", ["sync", "async"])
+def test_incremental_copy_rule_keeps_to_window(server, backend):
+    if backend == "async":
+        pytest.importorskip("aiohttp")
+
+    start = datetime.utcnow().replace(microsecond=0) + timedelta(days=1)
+
+    def add_event(n, start):
+        return server.add_event(
+            "src@example.com",
+            summary=f"event {n}",
+            iCalUID=f"{n}@example.com",
+            start={"dateTime": datetime_to_rfc3339(start)},
+            end={"dateTime": datetime_to_rfc3339(start + timedelta(hours=1))},
+        )
+
+    add_event(0, start)
+    # outside the first run's window
+    add_event(1, start + timedelta(weeks=2))
+
+    rule = {
+        "method": "copy",
+        "src": "Source",
+        "dst": "Destination",
+        "incremental": True,
+        "look_forward": "1 week",
+    }
+    config = {"backend": backend, "requests_per_second": 0, "rules": [rule]}
+
+    clear_calendars()
+    set_state_store(StateStore(":memory:"))
+    try:
+        run_rules(config)
+        assert [e["summary"] for e in server.get_events("dst@example.com")] == [
+            "event 0"
+        ]
+
+        # changes far outside the window are synced, but not copied
+        add_event(2, start + timedelta(days=300))
+        add_event(3, start + timedelta(days=400))
+        add_event(4, start + timedelta(hours=1))
+        run_rules(config)
+        assert sorted(e["summary"] for e in server.get_events("dst@example.com")) == [
+            "event 0",
+            "event 4",
+        ]
+
+        # an event the window moves on to is copied, though it hasn't changed
+        rule["look_forward"] = "4 weeks"
+        run_rules(config)
+    finally:
+        clear_calendars()
+        set_state_store(None)
+
+    assert sorted(e["summary"] for e in server.get_events("dst@example.com")) == [
+        "event 0",
+        "event 1",
+        "event 4",
+    ]
+
+
+@pytest.mark.parametrize("backend", ["sync", "async"])
+def test_delta_copy_rule_lists_window_when_updated_min_expires(server, backend):
+    if backend == "async":
+        pytest.importorskip("aiohttp")
+
+    start = datetime.utcnow().replace(microsecond=0) + timedelta(days=1)
+    events = [
+        server.add_event(
+            "src@example.com",
+            summary=f"event {n}",
+            iCalUID=f"{n}@example.com",
+            start={"dateTime": datetime_to_rfc3339(start + timedelta(hours=n))},
+            end={"dateTime": datetime_to_rfc3339(start + timedelta(hours=n + 1))},
+        )
+        for n in range(2)
+    ]
+
+    rule = {"method": "copy", "src": "Source", "dst": "Destination", "delta": True}
+    config = {"backend": backend, "requests_per_second": 0, "rules": [rule]}
+
+    clear_calendars()
+    set_state_store(StateStore(":memory:"))
+    try:
+        run_rules(config)
+
+        # the last run is now too long ago to list the changes since
+        server.expire_updated_min()
+        server.add_event("src@example.com", **dict(events[0], summary="changed 0"))
+
+        server.reset_stats()
+        run_rules(config)
+        stats = server.stats
+
+        server.reset_stats()
+        run_rules(config)
+    finally:
+        clear_calendars()
+        set_state_store(None)
+
+    # the rejected listing of changes, then the whole window
+    assert stats["errors"] == 1
+    assert stats["methods"]["events.list"] == 2
+    assert stats["methods"]["events.patch"] == 1
+    assert sorted(e["summary"] for e in server.get_events("dst@example.com")) == [
+        "changed 0",
+        "event 1",
+    ]
+
+    # changes since that run can be listed again
+    assert server.stats["errors"] == 0
+    assert set(server.stats["methods"]) <= {"calendarList.list", "events.list"}
+
+
+@pytest.mark.parametrize("backend", ["sync", "async"])
+def test_chained_copy_rules_see_earlier_rules_copies(server, backend):
+    if backend == "async":
+        pytest.importorskip("aiohttp")
+
+    for calendar_id, summary in [("c@example.com", "C"), ("d@example.com", "D")]:
+        server.add_calendar(calendar_id, summary=summary)
+
+    start = datetime.utcnow().replace(microsecond=0) + timedelta(days=1)
+    server.add_event(
+        "src@example.com",
+        summary="event 0",
+        iCalUID="0@example.com",
+        start={"dateTime": datetime_to_rfc3339(start)},
+        end={"dateTime": datetime_to_rfc3339(start + timedelta(hours=1))},
+    )
+
+    # Destination is read before the second rule writes to it, and after
+    config = {
+        "backend": backend,
+        "requests_per_second": 0,
+        "rules": [
+            {"method": "copy", "src": "Destination", "dst": "D"},
+            {"method": "copy", "src": "Source", "dst": "Destination"},
+            {"method": "copy", "src": "Destination", "dst": "C"},
+        ],
+    }
+
+    clear_calendars()
+    set_state_store(StateStore(":memory:"))
+    try:
+        run_rules(config)
+    finally:
+        clear_calendars()
+        set_state_store(None)
+
+    assert [e["summary"] for e in server.get_events("d@example.com")] == []
+    assert [e["summary"] for e in server.get_events("c@example.com")] == ["event 0"]
+
+
+def test_incremental_copy_rules_between_same_calendars_keep_own_tokens(server):
+    start = datetime.utcnow().replace(microsecond=0) + timedelta(days=1)
+
+    def add_event(summary):
+        server.add_event(
+            "src@example.com",
+            summary=summary,
+            iCalUID=f"{summary}@example.com",
+            start={"dateTime": datetime_to_rfc3339(start)},
+            end={"dateTime": datetime_to_rfc3339(start + timedelta(hours=1))},
+        )
+
+    rule = {"method": "copy", "src": "Source", "dst": "Destination"}
+    # one rule after the other, so the second would see the first's token
+    config = {
+        "requests_per_second": 0,
+        "concurrency": 1,
+        "rules": [
+            dict(rule, incremental=True, filter={"summary": "a*"}),
+            dict(rule, incremental=True, filter={"summary": "b*"}),
+        ],
+    }
+
+    clear_calendars()
+    set_state_store(StateStore(":memory:"))
+    try:
+        run_rules(config)
+
+        # each rule sees every change since its own last run
+        add_event("a 1")
+        add_event("b 1")
+        run_rules(config)
+    finally:
+        clear_calendars()
+        set_state_store(None)
+
+    assert sorted(e["summary"] for e in server.get_events("dst@example.com")) == [
+        "a 1",
+        "b 1",
+    ]
+
+
+def test_delta_copy_rules_between_same_calendars_keep_own_state(server):
+    start = datetime.utcnow().replace(microsecond=0) + timedelta(days=1)
+
+    def add_event(summary):
+        server.add_event(
+            "src@example.com",
+            summary=summary,
+            iCalUID=f"{summary}@example.com",
+            start={"dateTime": datetime_to_rfc3339(start)},
+            end={"dateTime": datetime_to_rfc3339(start + timedelta(hours=1))},
+        )
+
+    add_event("b 0")
+    add_event("a 0")
+    rule = {"method": "copy", "src": "Source", "dst": "Destination", "delta": True}
+    # one rule after the other, so the second would see the first's state
+    config = {
+        "requests_per_second": 0,
+        "concurrency": 1,
+        "rules": [
+            dict(rule, filter={"summary": "a*"}),
+            dict(rule, filter={"summary": "b*"}),
+        ],
+    }
+
+    clear_calendars()
+    set_state_store(StateStore(":memory:"))
+    try:
+        run_rules(config)
+    finally:
+        clear_calendars()
+        set_state_store(None)
+
+    # the second rule's first run lists its whole window, rather than only the
+    # changes since the first rule's run
+    assert sorted(e["summary"] for e in server.get_events("dst@example.com")) == [
+        "a 0",
+        "b 0",
+    ]
+
+
+@pytest.mark.parametrize("backend", ["sync", "async"])
+def test_copy_rule_trusts_copies_fingerprints_when_state_is_lost(server, backend):
+    if backend == "async":
+        pytest.importorskip("aiohttp")
+
+    start = datetime.utcnow().replace(microsecond=0) + timedelta(days=1)
+    for n in range(3):
+        server.add_event(
+            "src@example.com",
+            summary=f"event {n}",
+            iCalUID=f"{n}@example.com",
+            start={"dateTime": datetime_to_rfc3339(start + timedelta(hours=n))},
+            end={"dateTime": datetime_to_rfc3339(start + timedelta(hours=n + 1))},
+        )
+
+    rule = {"method": "copy", "src": "Source", "dst": "Destination"}
+    config = {"backend": backend, "requests_per_second": 0, "rules": [rule]}
+
+    clear_calendars()
+    try:
+        set_state_store(StateStore(":memory:"))
+        run_rules(config)
+
+        # as if py-calsync.db had been deleted
+        set_state_store(StateStore(":memory:"))
+        server.reset_stats()
+        run_rules(config)
+        stats = server.stats
+
+        server.reset_stats()
+        run_rules(config)
+    finally:
+        clear_calendars()
+        set_state_store(None)
+
+    # the copies' own fingerprints show they're up to date
+    assert "events.import" not in stats["methods"]
+    assert len(server.get_events("dst@example.com")) == 3
+
+    # and they're recorded again, so dst needn't be listed
+    assert server.stats["methods"]["events.list"] == 1
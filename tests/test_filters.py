@@ -4,7 +4,11 @@ from io import StringIO
 
 from calsync.event import Event
 
+from calsync.filters import compile_bulk_filter
+from calsync.filters import compile_filter
+from calsync.filters import EventColumns
 from calsync.filters import match
+from calsync.filters import match_many
 
 
 @pytest.fixture
@@ -292,3 +296,68 @@ filter:
     )
 
     assert match(config["filter"], event) is True
+
+
+@pytest.fixture
+def events():
+    return [
+        Event(
+            summary="Your order from Amazon",
+            start={"date": "2020-01-11"},
+            end={"date": "2020-01-12"},
+        ),
+        Event(
+            summary="Lunch",
+            start={"dateTime": "2020-01-11T12:00:00Z"},
+            end={"dateTime": "2020-01-11T13:00:00Z"},
+        ),
+        Event(
+            summary=None,
+            start={"dateTime": "2020-01-11T12:00:00Z"},
+            end={"dateTime": "2020-01-11T13:00:00Z"},
+        ),
+    ]
+
+
+@pytest.mark.parametrize(
+    "data,expected",
+    [
+        ({"summary": "Your*"}, [True, False, False]),
+        ({"all_day_event": False}, [False, True, True]),
+        (
+            {"any_of": [{"summary": "Lunch"}, {"summary": "Your*"}]},
+            [True, True, False],
+        ),
+        (
+            {"not": {"any_of": [{"all_day_event": True}, {"summary": "Lunch"}]}},
+            [False, False, True],
+        ),
+        ({"all_of": [{"summary": "*"}, {"all_day_event": False}]}, [False, True, True]),
+        ({"not": {"summary": "*"}}, [False, False, False]),
+        ({"any_of": []}, [False, False, False]),
+        ({"all_of": []}, [True, True, True]),
+    ],
+)
+def test_compile_filter(data, expected, events):
+    predicate = compile_filter(data)
+
+    assert [predicate(e) for e in events] == expected
+    assert [match(data, e) for e in events] == expected
+    assert match_many(data, events) == expected
+    assert compile_bulk_filter(data)(EventColumns(events)) == expected
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        {"summary": 1},
+        {"all_day_event": "yes"},
+        {"subject": "Lunch"},
+        {"summary": "Lunch", "all_day_event": True},
+        {"not": [{"summary": "Lunch"}]},
+        {"any_of": {"summary": "Lunch"}},
+    ],
+)
+def test_compile_filter_rejects_invalid_filters(data):
+    with pytest.raises(ValueError):
+        compile_filter(data)
@@ -0,0 +1,116 @@
+from datetime import datetime
+from datetime import timedelta
+import os.path
+from unittest.mock import patch
+
+import pytest
+
+from calsync.calendar import clear_calendars
+from calsync.fake_server import FakeCalendarServer
+from calsync.multitenant import load_tenants
+from calsync.multitenant import run_tenants
+from calsync.ratelimit import get_rate_limiter
+from calsync.service import set_api_endpoint
+from calsync.state import StateStore
+from calsync.tenant import Tenant
+from calsync.tenant import use_tenant
+from calsync.util import datetime_to_rfc3339
+
+
+@pytest.fixture
+def server():
+    with FakeCalendarServer() as server:
+        for name in ("a", "b"):
+            server.add_calendar(f"src-{name}@example.com", summary=f"Source {name}")
+            server.add_calendar(f"dst-{name}@example.com", summary=f"Dest {name}")
+
+            start = datetime.utcnow().replace(microsecond=0) + timedelta(days=1)
+            server.add_event(
+                f"src-{name}@example.com",
+                summary=f"event {name}",
+                iCalUID=f"{name}@example.com",
+                start={"dateTime": datetime_to_rfc3339(start)},
+                end={"dateTime": datetime_to_rfc3339(start + timedelta(hours=1))},
+            )
+
+        set_api_endpoint(server.url)
+        clear_calendars()
+
+        with patch("calsync.service.backoff_delay", return_value=0):
+            yield server
+
+        set_api_endpoint(None)
+        clear_calendars()
+
+
+def __tenant(name, src, dst, requests_per_second=10):
+    config = {
+        "requests_per_second": requests_per_second,
+        "rules": [{"method": "copy", "src": src, "dst": dst}],
+    }
+    return Tenant(name, config, None, StateStore(":memory:"))
+
+
+def test_run_tenants(server):
+    a = __tenant("a", "Source a", "Dest a", requests_per_second=100)
+    b = __tenant("b", "Source b", "Dest b", requests_per_second=200)
+    broken = __tenant("broken", "No such calendar", "Dest b")
+
+    results = run_tenants([a, b, broken], concurrency=2, max_tenants=2)
+
+    assert isinstance(results["broken"], ValueError)
+    for name in ("a", "b"):
+        copies = server.get_events(f"dst-{name}@example.com")
+        assert [e["summary"] for e in copies] == [f"event {name}"]
+
+    # each tenant's state, rate limit and calendar list are its own
+    assert a.state_store.get_event_sources("dst-a@example.com")
+    assert not a.state_store.get_event_sources("dst-b@example.com")
+    assert b.state_store.get_event_sources("dst-b@example.com")
+
+    assert a.rate_limiter.rate == 100
+    assert b.rate_limiter.rate == 200
+    assert get_rate_limiter() not in (a.rate_limiter, b.rate_limiter)
+    with use_tenant(a):
+        assert get_rate_limiter() is a.rate_limiter
+
+    assert a.calendars is not None and a.calendars is not b.calendars
+
+
+def test_load_tenants(tmp_path):
+    for name in ("alice", "bob"):
+        os.mkdir(tmp_path / name)
+        with open(tmp_path / name / "py-calsync.yaml", "w") as f:
+            f.write(f"rules:\n  - method: copy\n    src: {name}\n    dst: shared\n")
+
+    tenants = load_tenants(
+        {
+            "tenants": [
+                {"name": "alice", "config": str(tmp_path / "alice/py-calsync.yaml")},
+                {
+                    "name": "bob",
+                    "config": str(tmp_path / "bob/py-calsync.yaml"),
+                    "token_file": str(tmp_path / "bob.json"),
+                },
+            ]
+        }
+    )
+
+    alice, bob = tenants
+    assert alice.config["rules"][0]["src"] == "alice"
+    assert alice.credential_manager.token_file == str(tmp_path / "alice/token.json")
+    assert alice.state_store.filename == str(tmp_path / "alice/py-calsync.db")
+    assert bob.credential_manager.token_file == str(tmp_path / "bob.json")
+
+    for tenant in tenants:
+        tenant.state_store.close()
+
+    with pytest.raises(ValueError):
+        load_tenants(
+            {
+                "tenants": [
+                    {"name": "alice", "config": str(tmp_path / "alice/py-calsync.yaml")}
+                ]
+                * 2
+            }
+        )
@@ -0,0 +1,101 @@
+import asyncio
+import threading
+from unittest.mock import Mock
+
+import pytest
+
+from calsync.rules.planner import group_shared_sources
+from calsync.rules.planner import plan_rules
+from calsync.rules.planner import run_planned
+from calsync.rules.planner import run_planned_async
+
+
+def __resolve_calendar(name):
+    return Mock(id=f"cid_{name}")
+
+
+def test_plan_rules():
+    rules = [
+        {"method": "copy", "src": "main", "dst": "combined"},
+        {"method": "copy", "src": "work", "dst": "combined"},
+        {"method": "copy", "src": "other", "dst": "elsewhere"},
+        {"method": "remove_deleted", "src": ["main", "work"], "dst": "combined"},
+        {"method": "copy", "src": "combined", "dst": "backup"},
+    ]
+
+    assert plan_rules(rules, __resolve_calendar) == [
+        set(),
+        set(),
+        set(),
+        {0, 1},
+        {0, 1, 3},
+    ]
+
+
+def test_group_shared_sources():
+    rules = [
+        {"method": "copy", "src": "main", "dst": "combined"},
+        {"method": "copy", "src": "work", "dst": "combined"},
+        {"method": "copy", "src": "main", "dst": "elsewhere"},
+        {"method": "remove_deleted", "src": ["main", "work"], "dst": "combined"},
+        {"method": "copy", "src": "combined", "dst": "backup"},
+        # can't join rule 0's group, as it must wait for rule 3
+        {"method": "copy", "src": "main", "dst": "combined"},
+    ]
+    dependencies = plan_rules(rules, __resolve_calendar)
+
+    groups, group_dependencies = group_shared_sources(
+        rules,
+        dependencies,
+        __resolve_calendar,
+        shareable=lambda rule: rule["method"] == "copy",
+    )
+
+    assert groups == [[0, 2], [1], [3], [4], [5]]
+    assert group_dependencies == [set(), set(), {0, 1}, {0, 1, 2}, {2, 3}]
+
+
+def test_run_planned_runs_independent_rules_together():
+    rules = ["a", "b", "c"]
+    started = threading.Barrier(2, timeout=5)
+    order = []
+
+    def run_rule(rule):
+        if rule in ("a", "b"):
+            # a and b only get past this if they're running at the same time
+            started.wait()
+        order.append(rule)
+
+    run_planned(rules, [set(), set(), {0, 1}], run_rule, concurrency=2)
+
+    assert sorted(order[:2]) == ["a", "b"]
+    assert order[2] == "c"
+
+
+def test_run_planned_stops_after_failure():
+    error = Exception("failed")
+    ran = []
+
+    def run_rule(rule):
+        ran.append(rule)
+        if rule == "a":
+            raise error
+
+    with pytest.raises(Exception) as ex:
+        run_planned(["a", "b", "c"], [set(), {0}, set()], run_rule, concurrency=1)
+
+    assert ex.value is error
+    assert ran == ["a"]
+
+
+def test_run_planned_async():
+    order = []
+
+    async def run_rule(rule):
+        # b would finish first if it didn't wait for a
+        await asyncio.sleep(0.02 if rule == "a" else 0)
+        order.append(rule)
+
+    asyncio.run(run_planned_async(["a", "b", "c"], [set(), {0}, set()], run_rule))
+
+    assert order == ["c", "a", "b"]
@@ -0,0 +1,105 @@
+import json
+from unittest.mock import Mock
+from unittest.mock import patch
+
+import pytest
+from googleapiclient.errors import HttpError
+
+from calsync.ratelimit import call_with_retries
+from calsync.ratelimit import get_rate_limiter
+from calsync.ratelimit import is_retryable_error
+from calsync.ratelimit import RateLimiter
+from calsync.ratelimit import set_rate_limit
+from calsync.tenant import Tenant
+from calsync.tenant import use_tenant
+
+
+def http_error(status, reason=None):
+    content = {"error": {"errors": [{"reason": reason}] if reason else []}}
+    return HttpError(Mock(status=status), json.dumps(content).encode("utf-8"))
+
+
+@pytest.mark.parametrize(
+    "error,expected",
+    [
+        (http_error(429), True),
+        (http_error(500), True),
+        (http_error(503), True),
+        (http_error(403, "rateLimitExceeded"), True),
+        (http_error(403, "userRateLimitExceeded"), True),
+        (http_error(403, "forbidden"), False),
+        (http_error(404), False),
+        (http_error(410), False),
+        (ValueError("not http"), False),
+    ],
+)
+def test_is_retryable_error(error, expected):
+    assert is_retryable_error(error) is expected
+
+
+def test_rate_limiter_waits_once_burst_is_used():
+    limiter = RateLimiter(requests_per_second=10, burst=2)
+
+    with patch("calsync.ratelimit.time.sleep") as sleep:
+        limiter.acquire()
+        limiter.acquire()
+        sleep.assert_not_called()
+
+        limiter.acquire(3)
+        assert sleep.call_args.args[0] == pytest.approx(0.3, abs=0.05)
+
+
+def test_rate_limiter_disabled():
+    limiter = RateLimiter(requests_per_second=None)
+
+    with patch("calsync.ratelimit.time.sleep") as sleep:
+        for _ in range(100):
+            limiter.acquire()
+
+    sleep.assert_not_called()
+
+
+def test_set_rate_limit_keeps_limiter_with_same_rate():
+    with use_tenant(Tenant("test", {}, None, None)):
+        set_rate_limit(10)
+        limiter = get_rate_limiter()
+
+        # overlapping runs with the same rate share the bucket, rather than each
+        # getting a full one
+        set_rate_limit(10)
+        assert get_rate_limiter() is limiter
+
+        set_rate_limit(20)
+        assert get_rate_limiter() is not limiter
+        assert get_rate_limiter().rate == 20
+
+
+def test_call_with_retries():
+    f = Mock(side_effect=[http_error(429), http_error(503), "result"])
+
+    with patch("calsync.ratelimit.time.sleep") as sleep:
+        assert call_with_retries(f, max_attempts=3) == "result"
+
+    assert f.call_count == 3
+    assert sleep.call_count == 2
+
+
+def test_call_with_retries_gives_up():
+    error = http_error(429)
+    f = Mock(side_effect=error)
+
+    with patch("calsync.ratelimit.time.sleep"):
+        with pytest.raises(HttpError) as ex:
+            call_with_retries(f, max_attempts=3)
+
+    assert ex.value is error
+    assert f.call_count == 3
+
+
+def test_call_with_retries_does_not_retry_other_errors():
+    f = Mock(side_effect=http_error(404))
+
+    with pytest.raises(HttpError):
+        call_with_retries(f, max_attempts=3)
+
+    assert f.call_count == 1
@@ -2,21 +2,32 @@ import pytest
 
 from contextlib import contextmanager
 from datetime import datetime
+from datetime import timedelta
 
+from unittest.mock import MagicMock
 from unittest.mock import Mock
 from unittest.mock import patch
 from unittest.mock import call
+from unittest.mock import ANY
 
 from calsync.calendar import Calendar
 from calsync.rules.rules import COPY_DEFAULTS
+from calsync.rules.rules import MATCH_FIELDS
 from calsync.rules.rules import run_rules
 from calsync.event import Event
+from calsync.filters import compile_tree
+from calsync.event import FINGERPRINT_PROPERTY
+from calsync.state import StateStore
 from calsync.util import parse_timedelta_string
 from calsync.util import datetime_to_rfc3339
 
+from tests.test_ratelimit import http_error
+
 RESOLVE_CALENDAR_ADDR = "calsync.rules.rules.resolve_calendar"
 GET_CONFIG_ADDR = "calsync.rules.rules.get_config"
 DATETIME_ADDR = "calsync.rules.rules.datetime"
+GET_STATE_STORE_ADDR = "calsync.rules.rules.get_state_store"
+NEW_BATCH_ADDR = "calsync.rules.rules.new_batch"
 
 # 'lock' the clock so millisecond-precision datetime assertions work
 utcnow_fixed = datetime.utcnow()
@@ -39,6 +50,10 @@ def __setup_mocks(config):
     calendar_bar.get_name = Mock(return_value="Bar")
     calendar_baz.get_name = Mock(return_value="Baz")
 
+    # calendars are empty unless given events with __mock_events
+    for calendar in (calendar_foo, calendar_bar, calendar_baz):
+        __mock_events(calendar, [])
+
     resolve_calendar_result = {
         "cs_foo": calendar_foo,
         "cs_bar": calendar_bar,
@@ -52,15 +67,28 @@ def __setup_mocks(config):
     return calendar_foo, calendar_bar, calendar_baz, resolve_calendar, get_config
 
 
+def __mock_events(calendar, events):
+    """Mocks the events calendar lists, whether as a list or streamed."""
+    calendar.list_events = Mock(return_value=events)
+    calendar.iter_events = Mock(side_effect=lambda **kwargs: iter(events))
+
+
 @contextmanager
-def __patch_mocks(resolve_calendar, get_config):
+def __patch_mocks(resolve_calendar, get_config, state=None):
+    if state is None:
+        state = StateStore(":memory:")
+
     with patch(RESOLVE_CALENDAR_ADDR, resolve_calendar):
         with patch(GET_CONFIG_ADDR, get_config):
-            with patch(DATETIME_ADDR) as mock_datetime:
-                # https://docs.python.org/3/library/unittest.mock-examples.html#partial-mocking
-                mock_datetime.utcnow.return_value = utcnow_fixed
-                mock_datetime.side_effect = lambda *args, **kw: datetime(*args, **kw)
-                yield None
+            with patch(GET_STATE_STORE_ADDR, Mock(return_value=state)):
+                with patch(NEW_BATCH_ADDR, MagicMock()):
+                    with patch(DATETIME_ADDR) as mock_datetime:
+                        # https://docs.python.org/3/library/unittest.mock-examples.html#partial-mocking
+                        mock_datetime.utcnow.return_value = utcnow_fixed
+                        mock_datetime.side_effect = lambda *args, **kw: datetime(
+                            *args, **kw
+                        )
+                        yield None
 
 
 def __run_copy_rule_test(
@@ -97,7 +125,7 @@ def __run_copy_rule_test(
     for events_data in input_events_data:
         cal, events = events_data
         if events is not None:
-            cal.list_events = Mock(return_value=events)
+            __mock_events(cal, events)
 
     for import_data in imported_events_data:
         cal, expected_events = import_data
@@ -111,7 +139,7 @@ def __run_copy_rule_test(
         cal, events = events_data
 
         if events is not None:
-            cal.list_events.assert_called_with(
+            cal.iter_events.assert_called_with(
                 timeMin=datetime_to_rfc3339(
                     __tdstr_to_rfc3339_back(expected_look_back)
                 ),
@@ -120,13 +148,17 @@ def __run_copy_rule_test(
                 ),
                 singleEvents=False,
                 orderBy="updated",
+                shards=1,
+                fields=ANY,
             )
 
     for import_data in imported_events_data:
         cal, expected_events = import_data
 
         if expected_events is not None:
-            cal.import_event.assert_has_calls([call(e) for e in expected_events])
+            cal.import_event.assert_has_calls(
+                [call(e, source=ANY, batch=ANY, callback=ANY) for e in expected_events]
+            )
 
 
 def __new_event(from_, del_=[], **kwargs):
@@ -401,3 +433,461 @@ def test_run_copy_rule_with_all_day_events_only(
             __new_event(from_=event456_all_day, del_=["id"], privateCopy=True),
         ],
     )
+
+
+def test_run_copy_rule_incremental(event123, event456):
+    config = {
+        "rules": [
+            {"method": "copy", "src": "cs_foo", "dst": "cs_bar", "incremental": True}
+        ]
+    }
+
+    (
+        calendar_foo,
+        calendar_bar,
+        calendar_baz,
+        resolve_calendar,
+        get_config,
+    ) = __setup_mocks(config)
+
+    cancelled = Event(id="789", status="cancelled")
+    calendar_foo.sync_events = Mock(
+        return_value=([event123, cancelled, event456], "token2")
+    )
+    calendar_bar.import_event = Mock()
+
+    time_max = datetime_to_rfc3339(
+        __tdstr_to_rfc3339_forward(COPY_DEFAULTS["look_forward"])
+    )
+    tokens = {"copy": "token1", "copy-window": time_max}
+
+    state = Mock()
+    state.get_sync_token = Mock(side_effect=lambda key: tokens[key.split(":")[0]])
+    state.get_event_mapping = Mock(return_value=None)
+
+    with __patch_mocks(resolve_calendar, get_config, state=state):
+        run_rules()
+
+    calendar_foo.sync_events.assert_called_with(
+        syncToken="token1",
+        timeMin=datetime_to_rfc3339(
+            __tdstr_to_rfc3339_back(COPY_DEFAULTS["look_back"])
+        ),
+        timeMax=datetime_to_rfc3339(
+            __tdstr_to_rfc3339_forward(COPY_DEFAULTS["look_forward"])
+        ),
+        singleEvents=False,
+        fields=ANY,
+    )
+    calendar_bar.import_event.assert_has_calls(
+        [
+            call(
+                __new_event(from_=event123, del_=["id"], privateCopy=True),
+                source=event123,
+                batch=ANY,
+                callback=ANY,
+            ),
+            call(
+                __new_event(from_=event456, del_=["id"], privateCopy=True),
+                source=event456,
+                batch=ANY,
+                callback=ANY,
+            ),
+        ]
+    )
+    assert calendar_bar.import_event.call_count == 2
+    # the last run's window reached as far, so there was nothing else to list
+    calendar_foo.list_events.assert_not_called()
+    key, token = state.set_sync_token.mock_calls[0].args
+    assert key.startswith("copy:cid_foo:cid_bar:")
+    assert token == "token2"
+    state.get_sync_token.assert_any_call(key)
+
+
+def test_run_remove_deleted_rule(tmp_path, event123, event456, event789):
+    config = {
+        "rules": [
+            {"method": "remove_deleted", "src": ["cs_foo", "cid_baz"], "dst": "cs_bar"}
+        ]
+    }
+
+    (
+        calendar_foo,
+        calendar_bar,
+        calendar_baz,
+        resolve_calendar,
+        get_config,
+    ) = __setup_mocks(config)
+
+    __mock_events(calendar_foo, [__new_event(from_=event123, calendarId="cid_foo")])
+    __mock_events(
+        calendar_baz, [__new_event(from_=event456, calendarId="cid_baz", iCalUID="u1")]
+    )
+
+    # copy of 123 is mapped and still has its source; copy of 456 is unmapped
+    # but matches on iCalUID; copy of 789 is mapped but its source has gone
+    dst_123 = Event(id="d123", calendarId="cid_bar")
+    dst_456 = Event(id="d456", calendarId="cid_bar", iCalUID="u1")
+    dst_789 = Event(id="d789", calendarId="cid_bar")
+    __mock_events(calendar_bar, [dst_123, dst_456, dst_789])
+    calendar_bar.delete_event = Mock()
+
+    state = StateStore(tmp_path / "state.db")
+    state.set_event_mapping("cid_foo", "123", "cid_bar", "d123")
+    state.set_event_mapping("cid_foo", "789", "cid_bar", "d789")
+
+    with __patch_mocks(resolve_calendar, get_config, state=state):
+        run_rules()
+
+    calendar_bar.delete_event.assert_called_once_with(dst_789, batch=ANY, callback=ANY)
+
+
+def test_run_copy_rule_skips_unchanged_events(event123, event456):
+    config = {"rules": [{"method": "copy", "src": "cs_foo", "dst": "cs_bar"}]}
+
+    (
+        calendar_foo,
+        calendar_bar,
+        calendar_baz,
+        resolve_calendar,
+        get_config,
+    ) = __setup_mocks(config)
+
+    event123 = __new_event(from_=event123, calendarId="cid_foo")
+    event456 = __new_event(from_=event456, calendarId="cid_foo")
+
+    __mock_events(calendar_foo, [event123, event456])
+    calendar_bar.import_event = Mock()
+
+    # 123 was copied before and is unchanged; 456's copy is out of date
+    state = StateStore(":memory:")
+    state.set_event_mapping(
+        "cid_foo",
+        "123",
+        "cid_bar",
+        "d123",
+        __new_event(from_=event123, del_=["id"], privateCopy=True).fingerprint(),
+    )
+    state.set_event_mapping("cid_foo", "456", "cid_bar", "d456", "stale")
+
+    with __patch_mocks(resolve_calendar, get_config, state=state):
+        run_rules()
+
+    calendar_bar.import_event.assert_called_once_with(
+        __new_event(from_=event456, del_=["id"], privateCopy=True),
+        source=event456,
+        batch=ANY,
+        callback=ANY,
+    )
+    imported = calendar_bar.import_event.call_args.args[0]
+    assert imported.get_private_property(FINGERPRINT_PROPERTY) == (
+        __new_event(from_=event456, del_=["id"], privateCopy=True).fingerprint()
+    )
+
+
+def test_run_copy_rule_raises_batch_errors(event123, event456):
+    config = {"rules": [{"method": "copy", "src": "cs_foo", "dst": "cs_bar"}]}
+
+    (
+        calendar_foo,
+        calendar_bar,
+        calendar_baz,
+        resolve_calendar,
+        get_config,
+    ) = __setup_mocks(config)
+
+    error = Exception("import failed")
+
+    def import_event(event, source, batch, callback):
+        callback(None, error if source is event123 else None)
+
+    __mock_events(calendar_foo, [event123, event456])
+    calendar_bar.import_event = Mock(side_effect=import_event)
+
+    with __patch_mocks(resolve_calendar, get_config):
+        with pytest.raises(Exception) as ex:
+            run_rules()
+
+    assert ex.value is error
+    assert calendar_bar.import_event.call_count == 2
+
+
+def test_run_rules_shares_src_fetches(event123, event456):
+    config = {
+        "rules": [
+            {"method": "copy", "src": "cs_foo", "dst": "cs_bar"},
+            {"method": "remove_deleted", "src": "cs_foo", "dst": "cs_bar"},
+        ]
+    }
+
+    (
+        calendar_foo,
+        calendar_bar,
+        calendar_baz,
+        resolve_calendar,
+        get_config,
+    ) = __setup_mocks(config)
+
+    __mock_events(calendar_foo, [event123, event456])
+    __mock_events(calendar_bar, [])
+    calendar_bar.import_event = Mock()
+
+    with __patch_mocks(resolve_calendar, get_config):
+        run_rules()
+
+    calendar_foo.list_events.assert_called_once()
+    # once by the copy rule for its copies' fingerprints, as the state store has
+    # no record of any, and once by remove_deleted
+    assert calendar_bar.list_events.call_count == 2
+    assert calendar_bar.import_event.call_count == 2
+
+
+def test_run_copy_rule_defers_rate_limited_imports(event123, event456):
+    config = {
+        "rules": [
+            {"method": "copy", "src": "cs_foo", "dst": "cs_bar", "incremental": True}
+        ]
+    }
+
+    (
+        calendar_foo,
+        calendar_bar,
+        calendar_baz,
+        resolve_calendar,
+        get_config,
+    ) = __setup_mocks(config)
+
+    def import_event(event, source, batch=None, callback=None):
+        # 123 is still rate limited after the batch's retries, but succeeds later
+        if callback is not None:
+            callback(None, http_error(429) if source is event123 else None)
+
+    calendar_foo.sync_events = Mock(return_value=([event123, event456], "token2"))
+    calendar_bar.import_event = Mock(side_effect=import_event)
+
+    state = StateStore(":memory:")
+
+    with __patch_mocks(resolve_calendar, get_config, state=state):
+        with patch("calsync.rules.rules.DEFERRED_RETRY_DELAY", 0):
+            run_rules()
+
+    assert calendar_bar.import_event.call_count == 3
+    calendar_bar.import_event.assert_called_with(
+        __new_event(from_=event123, del_=["id"], privateCopy=True), source=event123
+    )
+
+    # the sync token isn't advanced, so the next run sees the change again
+    assert state.conn.execute("SELECT * FROM sync_tokens").fetchall() == []
+
+
+def test_run_copy_rule_uses_fingerprints_of_copies_without_state():
+    config = {"rules": [{"method": "copy", "src": "cs_foo", "dst": "cs_bar"}]}
+
+    calendar_foo, calendar_bar, _, resolve_calendar, get_config = __setup_mocks(config)
+    calendar_bar.import_event = Mock()
+
+    def event(id, summary):
+        return Event(
+            id=id,
+            calendarId="cid_foo",
+            iCalUID=f"{id}@example.com",
+            summary=summary,
+            start="2020-01-11T11:11:11Z",
+        )
+
+    # made by an earlier run, whose state has since been lost
+    copies = []
+    for id in ("123", "456"):
+        copy = event(id, f"Event {id}").copy()
+        copy.attributes["privateCopy"] = True
+        copy.set_private_property(FINGERPRINT_PROPERTY, copy.fingerprint())
+        copies.append(Event(**{**copy.attributes, "id": f"copy{id}"}))
+    __mock_events(calendar_bar, copies)
+
+    # 456 has changed since
+    __mock_events(calendar_foo, [event("123", "Event 123"), event("456", "Changed")])
+
+    state = StateStore(":memory:")
+    with __patch_mocks(resolve_calendar, get_config, state=state):
+        run_rules()
+
+    assert [c.args[0].summary for c in calendar_bar.import_event.mock_calls] == [
+        "Changed"
+    ]
+    # the copy that's up to date is recorded again
+    assert state.get_event_mapping("cid_foo", "123", "cid_bar")[0] == "copy123"
+
+
+def test_run_copy_rule_filters_in_bulk(event123_all_day, event456, event789):
+    config = {
+        "rules": [
+            {
+                "method": "copy",
+                "src": "cs_foo",
+                "dst": "cs_bar",
+                "filter": {
+                    "not": {
+                        "any_of": [{"all_day_event": True}, {"summary": "Event 4*"}]
+                    }
+                },
+            }
+        ]
+    }
+
+    calendar_foo, calendar_bar, _, resolve_calendar, get_config = __setup_mocks(config)
+    __mock_events(calendar_foo, [event123_all_day, event456, event789])
+    calendar_bar.import_event = Mock()
+
+    with __patch_mocks(resolve_calendar, get_config):
+        with patch("calsync.rules.rules.BULK_FILTER_THRESHOLD", 1):
+            run_rules()
+
+    assert calendar_bar.import_event.call_count == 1
+    calendar_bar.import_event.assert_has_calls(
+        [
+            call(
+                __new_event(from_=event789, del_=["id"], privateCopy=True),
+                source=event789,
+                batch=ANY,
+                callback=ANY,
+            )
+        ]
+    )
+
+
+def test_run_copy_rule_compiles_filter_once(event123, event456, event789):
+    config = {
+        "rules": [
+            {
+                "method": "copy",
+                "src": "cs_foo",
+                "dst": "cs_bar",
+                "filter": {"not": {"summary": "Event 4*"}},
+            }
+        ]
+    }
+
+    calendar_foo, calendar_bar, _, resolve_calendar, get_config = __setup_mocks(config)
+    __mock_events(calendar_foo, [event123, event456, event789])
+    calendar_bar.import_event = Mock()
+
+    with __patch_mocks(resolve_calendar, get_config), patch(
+        "calsync.rules.rules.EVENTS_PAGE_SIZE", 1
+    ), patch(
+        "calsync.rules.rules.compile_tree", Mock(wraps=compile_tree)
+    ) as compile_tree_:
+        run_rules()
+
+    # once for the run, not once per chunk
+    compile_tree_.assert_called_once()
+    assert [c.args[0].summary for c in calendar_bar.import_event.mock_calls] == [
+        "Event 123",
+        "Event 789",
+    ]
+
+
+def test_run_rules_shares_src_scan_between_copy_rules():
+    def event_at(id, offset):
+        start = utcnow_fixed + parse_timedelta_string(offset)
+        return Event(
+            id=id,
+            summary=f"Event {id}",
+            start={"dateTime": datetime_to_rfc3339(start)},
+            end={"dateTime": datetime_to_rfc3339(start + timedelta(hours=1))},
+        )
+
+    soon = event_at("soon", "1 day")
+    skipped = event_at("skipped", "2 days")
+    later = event_at("later", "20 weeks")
+
+    config = {
+        "rules": [
+            {
+                "method": "copy",
+                "src": "cs_foo",
+                "dst": "cs_bar",
+                "look_forward": "30 weeks",
+            },
+            {
+                "method": "copy",
+                "src": "cs_foo",
+                "dst": "cid_baz",
+                "look_forward": "1 week",
+                "filter": {"not": {"summary": "Event skipped"}},
+            },
+        ]
+    }
+
+    calendar_foo, calendar_bar, calendar_baz, resolve_calendar, get_config = (
+        __setup_mocks(config)
+    )
+    __mock_events(calendar_foo, [soon, skipped, later])
+    calendar_bar.import_event = Mock()
+    calendar_baz.import_event = Mock()
+
+    with __patch_mocks(resolve_calendar, get_config):
+        run_rules()
+
+    # src is listed once, for the widest window
+    calendar_foo.iter_events.assert_called_once_with(
+        timeMin=datetime_to_rfc3339(__tdstr_to_rfc3339_back("1 week")),
+        timeMax=datetime_to_rfc3339(__tdstr_to_rfc3339_forward("30 weeks")),
+        singleEvents=False,
+        orderBy="updated",
+        shards=1,
+        fields=ANY,
+    )
+
+    assert [c.args[0].summary for c in calendar_bar.import_event.mock_calls] == [
+        "Event soon",
+        "Event skipped",
+        "Event later",
+    ]
+    assert [c.args[0].summary for c in calendar_baz.import_event.mock_calls] == [
+        "Event soon"
+    ]
+
+
+def test_run_rules_lists_only_needed_fields():
+    config = {
+        "rules": [
+            {"method": "copy", "src": "cs_foo", "dst": "cs_bar"},
+            {"method": "remove_deleted", "src": "cs_foo", "dst": "cid_baz"},
+        ]
+    }
+
+    calendar_foo, calendar_bar, calendar_baz, resolve_calendar, get_config = (
+        __setup_mocks(config)
+    )
+    __mock_events(calendar_foo, [])
+    __mock_events(calendar_baz, [])
+    calendar_bar.import_event = Mock()
+
+    with __patch_mocks(resolve_calendar, get_config):
+        run_rules()
+
+    # copy rules list the fields they copy, and remove_deleted only those it
+    # matches events up with, which both rules share a single listing of
+    copy_fields = calendar_foo.list_events.call_args.kwargs["fields"]
+    assert MATCH_FIELDS <= copy_fields
+    assert "description" in copy_fields
+    assert "attendees" not in copy_fields
+    calendar_foo.list_events.assert_called_once()
+    calendar_foo.iter_events.assert_not_called()
+
+    assert calendar_baz.list_events.call_args.kwargs["fields"] == MATCH_FIELDS
+
+
+def test_run_rules_checks_shards():
+    config = {
+        "rules": [{"method": "copy", "src": "cs_foo", "dst": "cs_bar", "shards": 0}]
+    }
+
+    _, calendar_bar, _, resolve_calendar, get_config = __setup_mocks(config)
+    calendar_bar.import_event = Mock()
+
+    with __patch_mocks(resolve_calendar, get_config):
+        with pytest.raises(ValueError, match="shards"):
+            run_rules()
+
+    calendar_bar.import_event.assert_not_called()
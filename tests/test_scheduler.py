@@ -0,0 +1,126 @@
+import threading
+from unittest.mock import Mock
+
+from calsync.rules.scheduler import ChangeScheduler
+
+
+def __resolve_calendar(name):
+    return Mock(id=f"cid_{name}")
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def __scheduler(rules, **kwargs):
+    clock = Clock()
+    scheduler = ChangeScheduler(
+        rules,
+        __resolve_calendar,
+        Mock(),
+        debounce=5,
+        max_delay=30,
+        clock=clock,
+        **kwargs,
+    )
+    return scheduler, clock
+
+
+def test_changes_are_debounced():
+    rules = [
+        {"method": "copy", "src": "main", "dst": "combined"},
+        {"method": "copy", "src": ["main", "work"], "dst": "backup"},
+        {"method": "copy", "src": "work", "dst": "elsewhere"},
+    ]
+    scheduler, clock = __scheduler(rules)
+
+    # a burst of changes keeps pushing the run back
+    for clock.now in range(4):
+        scheduler.changed("cid_main")
+        assert scheduler.get_due() == []
+
+    assert scheduler.get_wait() == 5
+    clock.now = 8
+    assert scheduler.get_due() == [0, 1]
+    assert scheduler.pending == {}
+
+    # changes while a rule runs are kept for another run once it finishes
+    scheduler.changed("cid_work")
+    clock.now = 20
+    assert scheduler.get_due() == [2]
+    scheduler.finished([0, 1])
+    assert scheduler.get_due() == [1]
+
+
+def test_changes_that_never_settle_run_after_max_delay():
+    scheduler, clock = __scheduler(
+        [{"method": "copy", "src": "main", "dst": "combined"}]
+    )
+
+    for clock.now in range(0, 30, 2):
+        scheduler.changed("cid_main")
+        assert scheduler.get_due() == []
+
+    clock.now = 30
+    assert scheduler.get_due() == [0]
+
+
+def test_concurrency_and_conflicts():
+    rules = [
+        {"method": "copy", "src": "a", "dst": "combined"},
+        {"method": "copy", "src": "b", "dst": "combined"},
+        {"method": "remove_deleted", "src": "c", "dst": "combined"},
+        {"method": "copy", "src": "d", "dst": "elsewhere"},
+    ]
+    scheduler, clock = __scheduler(rules, concurrency=2)
+
+    # the oldest changes go first
+    for clock.now, name in enumerate("dcba"):
+        scheduler.changed(f"cid_{name}")
+
+    clock.now = 10
+    assert scheduler.get_due() == [2, 3]
+    assert scheduler.get_due() == []
+
+    # copies can run alongside each other, but not remove_deleted on their dst
+    scheduler.finished([3])
+    assert scheduler.get_due() == []
+    assert scheduler.get_wait() is None
+
+    scheduler.finished([2])
+    assert scheduler.get_due() == [0, 1]
+
+
+def test_run_forever():
+    rules = [
+        {"method": "copy", "src": "main", "dst": "combined"},
+        {"method": "copy", "src": "work", "dst": "combined"},
+    ]
+    runs = []
+    ran = threading.Event()
+
+    def run(rules):
+        runs.append(rules)
+        ran.set()
+
+    scheduler = ChangeScheduler(rules, __resolve_calendar, run)
+    thread = threading.Thread(target=scheduler.run_forever)
+    thread.start()
+
+    try:
+        scheduler.changed_all()
+        assert ran.wait(5)
+
+        ran.clear()
+        scheduler.changed("cid_work", debounce=0)
+        assert ran.wait(5)
+
+    finally:
+        scheduler.stop()
+        thread.join()
+
+    assert runs == [rules, rules[1:]]
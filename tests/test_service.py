@@ -0,0 +1,197 @@
+from unittest.mock import Mock
+from unittest.mock import patch
+
+import pytest
+
+from calsync.ratelimit import get_error_status
+from calsync.service import CalendarService
+from calsync.service import EVENTS_PAGE_SIZE
+from calsync.service import get_event_fields
+from calsync.service import get_events_fields_mask
+
+from tests.test_ratelimit import http_error
+
+
+def __mock_list(pages):
+    """Returns a mock list method whose requests return each of pages in turn."""
+    requests = [Mock(**{"execute.return_value": page}) for page in pages]
+    return Mock(side_effect=requests)
+
+
+@pytest.fixture
+def paged_events():
+    return [
+        {"items": [{"id": "1"}, {"id": "2"}], "nextPageToken": "page2"},
+        {"items": [{"id": "3"}], "nextPageToken": "page3"},
+        {"items": [{"id": "4"}], "nextSyncToken": "sync1"},
+    ]
+
+
+def test_list_events_follows_pages(paged_events):
+    service = Mock()
+    service.events().list = __mock_list(paged_events)
+
+    result = CalendarService(service=service).list_events(calendarId="calid")
+
+    assert [e["id"] for e in result] == ["1", "2", "3", "4"]
+    assert [c.kwargs.get("pageToken") for c in service.events().list.mock_calls] == [
+        None,
+        "page2",
+        "page3",
+    ]
+    service.events().list.assert_called_with(
+        calendarId="calid", maxResults=EVENTS_PAGE_SIZE, pageToken="page3"
+    )
+
+
+def test_list_events_is_lazy(paged_events):
+    service = Mock()
+    service.events().list = __mock_list(paged_events)
+
+    result = CalendarService(service=service).list_events(calendarId="calid")
+
+    assert next(result) == {"id": "1"}
+    assert service.events().list.call_count == 1
+
+
+def test_sync_events_returns_sync_token(paged_events):
+    service = Mock()
+    service.events().list = __mock_list(paged_events)
+
+    items, sync_token = CalendarService(service=service).sync_events(calendarId="calid")
+
+    assert [e["id"] for e in items] == ["1", "2", "3", "4"]
+    assert sync_token == "sync1"
+
+
+def test_list_calendars_follows_pages():
+    service = Mock()
+    service.calendarList().list = __mock_list(
+        [
+            {"items": [{"id": "foo"}], "nextPageToken": "page2"},
+            {"items": [{"id": "bar"}]},
+        ]
+    )
+
+    result = CalendarService(service=service).list_calendars()
+
+    assert [c["id"] for c in result] == ["foo", "bar"]
+
+
+class FakeBatchHttpRequest:
+    """Stands in for googleapiclient's BatchHttpRequest, failing any request
+    that is the string "fail", and rate limiting those that are "throttled"
+    the first time they're sent."""
+
+    def __init__(self, executed):
+        self.executed = executed
+        self.requests = []
+
+    def add(self, request, callback):
+        self.requests.append((request, callback))
+
+    def execute(self):
+        self.executed.append([r for r, _ in self.requests])
+        for i, (request, callback) in enumerate(self.requests):
+            if request == "fail":
+                callback(str(i), None, Exception("failed"))
+            elif request == "throttled" and not any(
+                request in batch for batch in self.executed[:-1]
+            ):
+                callback(str(i), None, http_error(429))
+            else:
+                callback(str(i), {"id": request}, None)
+
+
+def test_batch_flushes_in_groups():
+    executed = []
+
+    service = Mock()
+    service.new_batch_http_request = lambda: FakeBatchHttpRequest(executed)
+    service.events().import_ = Mock(side_effect=lambda **kw: kw["body"]["id"])
+
+    results = []
+    with CalendarService(service=service).new_batch(batch_size=2) as batch:
+        for id_ in ["1", "2", "fail", "4", "5"]:
+            batch.import_event(
+                callback=lambda r, e: results.append((r, e and str(e))),
+                calendarId="calid",
+                body={"id": id_},
+            )
+
+    assert executed == [["1", "2"], ["fail", "4"], ["5"]]
+    assert results == [
+        ({"id": "1"}, None),
+        ({"id": "2"}, None),
+        (None, "failed"),
+        ({"id": "4"}, None),
+        ({"id": "5"}, None),
+    ]
+
+
+def test_batch_retries_rate_limited_requests():
+    executed = []
+
+    service = Mock()
+    service.new_batch_http_request = lambda: FakeBatchHttpRequest(executed)
+    service.events().import_ = Mock(side_effect=lambda **kw: kw["body"]["id"])
+
+    results = []
+    with patch("calsync.service.time.sleep"):
+        with CalendarService(service=service).new_batch(batch_size=2) as batch:
+            for id_ in ["1", "throttled", "3"]:
+                batch.import_event(
+                    callback=lambda r, e: results.append((r, e)),
+                    calendarId="calid",
+                    body={"id": id_},
+                )
+
+    assert executed == [["1", "throttled"], ["throttled"], ["3"]]
+    assert results == [
+        ({"id": "1"}, None),
+        ({"id": "throttled"}, None),
+        ({"id": "3"}, None),
+    ]
+
+
+def test_batch_retries_failed_batch_requests():
+    executed = []
+
+    class FailingBatchHttpRequest(FakeBatchHttpRequest):
+        def execute(self):
+            # the batch endpoint fails the first batch, and any with "broken"
+            if len(executed) == 0 or "broken" in [r for r, _ in self.requests]:
+                executed.append([r for r, _ in self.requests])
+                raise http_error(503 if len(executed) == 1 else 400)
+            super().execute()
+
+    service = Mock()
+    service.new_batch_http_request = lambda: FailingBatchHttpRequest(executed)
+    service.events().import_ = Mock(side_effect=lambda **kw: kw["body"]["id"])
+
+    results = []
+    with patch("calsync.service.time.sleep"):
+        with CalendarService(service=service).new_batch(batch_size=2) as batch:
+            for id_ in ["1", "2", "broken"]:
+                batch.import_event(
+                    callback=lambda r, e: results.append(
+                        (r, e and get_error_status(e))
+                    ),
+                    calendarId="calid",
+                    body={"id": id_},
+                )
+
+    # the first batch is sent again, and the request in the one that can't be
+    # sent gets its error
+    assert executed == [["1", "2"], ["1", "2"], ["broken"]]
+    assert results == [({"id": "1"}, None), ({"id": "2"}, None), (None, 400)]
+
+
+def test_get_events_fields_mask():
+    assert get_events_fields_mask(None) is None
+    assert (
+        get_events_fields_mask({"summary", "id", "start"})
+        == "nextPageToken,nextSyncToken,items(id,start,summary)"
+    )
+
+    assert {"id", "summary", "attendees", "extendedProperties"} <= get_event_fields()
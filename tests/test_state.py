@@ -0,0 +1,63 @@
+from calsync.state import StateStore
+
+
+def test_sync_token_roundtrip(tmp_path):
+    state = StateStore(tmp_path / "state.db")
+
+    assert state.get_sync_token("foo") is None
+
+    state.set_sync_token("foo", "token1")
+    state.set_sync_token("foo", "token2")
+    assert state.get_sync_token("foo") == "token2"
+
+    state.set_sync_token("foo", None)
+    assert state.get_sync_token("foo") is None
+
+
+def test_sync_token_persists(tmp_path):
+    state = StateStore(tmp_path / "state.db")
+    state.set_sync_token("foo", "token1")
+    state.close()
+
+    assert StateStore(tmp_path / "state.db").get_sync_token("foo") == "token1"
+
+
+def test_event_mappings(tmp_path):
+    state = StateStore(tmp_path / "state.db")
+
+    state.set_event_mapping("src", "1", "dst", "d1", "hash1")
+    state.set_event_mapping("src", "2", "dst", "d2", "hash2")
+    state.set_event_mapping("src", "1", "other", "o1", "hash1")
+
+    assert state.get_event_mapping("src", "1", "dst") == ("d1", "hash1")
+    assert state.get_event_mapping("src", "3", "dst") is None
+    assert state.get_event_sources("dst") == {
+        "d1": ("src", "1"),
+        "d2": ("src", "2"),
+    }
+
+    state.delete_event_mapping("dst", "d1")
+    assert state.get_event_mapping("src", "1", "dst") is None
+    assert state.get_event_mapping("src", "1", "other") == ("o1", "hash1")
+
+
+def test_event_content(tmp_path):
+    state = StateStore(tmp_path / "state.db")
+
+    state.set_event_mapping("src", "1", "dst", "d1", "hash1", {"summary": "foo"})
+    state.set_event_mapping("src", "2", "dst", "d2", "hash2")
+
+    assert state.get_event_content("src", "1", "dst") == {"summary": "foo"}
+    assert state.get_event_content("src", "2", "dst") is None
+    assert state.get_event_content("src", "3", "dst") is None
+
+
+def test_event_content_column_added(tmp_path):
+    state = StateStore(tmp_path / "state.db")
+    with state.conn:
+        state.conn.execute("ALTER TABLE event_mappings DROP COLUMN content")
+    state.close()
+
+    state = StateStore(tmp_path / "state.db")
+    state.set_event_mapping("src", "1", "dst", "d1", "hash1", {"summary": "foo"})
+    assert state.get_event_content("src", "1", "dst") == {"summary": "foo"}
@@ -0,0 +1,55 @@
+import threading
+
+import pytest
+
+from calsync.stream import chunked
+from calsync.stream import prefetch
+
+
+def test_chunked():
+    assert list(chunked(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(chunked([], 2)) == []
+
+
+def test_prefetch_reads_ahead():
+    second_read = threading.Event()
+
+    def items():
+        yield 0
+        second_read.set()
+        yield 1
+
+    iterator = prefetch(items(), buffered=1)
+    assert next(iterator) == 0
+
+    # the next item is read before the caller asks for it
+    assert second_read.wait(timeout=5)
+    assert list(iterator) == [1]
+
+
+def test_prefetch_raises_errors():
+    def items():
+        yield 1
+        raise ValueError("listing failed")
+
+    iterator = prefetch(items())
+    assert next(iterator) == 1
+
+    with pytest.raises(ValueError, match="listing failed"):
+        next(iterator)
+
+
+def test_prefetch_stops_when_caller_stops():
+    finished = threading.Event()
+
+    def items():
+        try:
+            yield from range(100)
+        finally:
+            finished.set()
+
+    iterator = prefetch(items())
+    assert next(iterator) == 0
+    iterator.close()
+
+    assert finished.wait(timeout=5)